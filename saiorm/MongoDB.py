@@ -5,11 +5,11 @@ Support MongoDB
 
 bases on torndb
 """
+import io
 import logging
+import math
 import time
 
-import pymongo
-
 try:
     from . import utility
 except ImportError:
@@ -20,19 +20,48 @@ try:
 except ImportError:
     import base
 
+try:
+    from . import errors
+except ImportError:
+    import errors
+
+try:
+    from . import forksafe
+except ImportError:
+    import forksafe
+
+try:
+    from . import scan
+except ImportError:
+    import scan
+
+try:
+    from . import blob
+except ImportError:
+    import blob
+
+try:
+    from . import columnar
+except ImportError:
+    import columnar
+
 Row = utility.Row
 GraceDict = utility.GraceDict
 is_array = utility.is_array
 to_unicode = utility.to_unicode
 
+pymongo = utility.LazyModule("pymongo")  # imported on first connection
+gridfs = utility.LazyModule("gridfs")  # installed with pymongo
+
 
 class ConnectionMongoDB(object):
     def __init__(self, host, port, database, user=None, password=None,
-                 max_idle_time=7 * 3600, return_query=False):
+                 max_idle_time=7 * 3600, return_query=False, timeout=None):
         self.host = host
         self.database = database
         self.max_idle_time = float(max_idle_time)
         self._return_query = return_query
+        self.timeout = timeout  # default seconds of query,by max_time_ms
         self.condition = {}  # like WHERE, ORDER BY, LIMIT etc. in SQL
         self.client = None  # Mongo client
 
@@ -46,18 +75,16 @@ class ConnectionMongoDB(object):
 
         self._db = None
         self._db_args = args
-        self._last_use_time = time.time()
-        try:
-            self.reconnect()
-        except Exception:
-            logging.error("Cannot connect to PostgreSQL on {}:{}".format(self.host, port),
-                          exc_info=True)
+        self._last_use_time = time.time()  # connect on the first statement
+        forksafe.register(self)
 
     def __del__(self):
         self.close()
 
     def close(self):
         """Closes this database connection."""
+        if forksafe.is_inherited(self):  # opened by parent process,never close it on the wire
+            forksafe.discard(self)
         if getattr(self, "_db", None) is not None:
             self.client.close()
             self._db = None
@@ -74,6 +101,28 @@ class ConnectionMongoDB(object):
         self._db = getattr(client, database)
         self.client = client
 
+    def _ensure_connected(self):
+        if forksafe.is_inherited(self):  # opened by parent process,never close it on the wire
+            forksafe.discard(self)
+        if self._db is None:
+            self.reconnect()
+        self._last_use_time = time.time()
+
+    def _collection(self):
+        """return the collection of current table"""
+        self._ensure_connected()
+        return getattr(self._db, self.condition["table"])
+
+    def _max_time_ms(self):
+        """max_time_ms of the query,None for no limit"""
+        seconds = self.condition.get("timeout") or self.timeout
+        return int(seconds * 1000) if seconds else None
+
+    def _check_timeout(self, exception):
+        """raise QueryTimeoutError if exception is caused by max_time_ms"""
+        if isinstance(exception, pymongo.errors.ExecutionTimeout):
+            raise errors.QueryTimeoutError("Query cancelled by timeout:" + str(exception)) from exception
+
     def _log_exception(self, exception, query, parameters):
         """log exception when execute query"""
         logging.error("Error on MongoDB:" + self.host)
@@ -88,9 +137,15 @@ class ConnectionMongoDB(object):
         sort = self.condition.get("sort", "")
         skip = self.condition.get("skip", "")
         limit = self.condition.get("limit", "")
+        hint = self.condition.get("hint")
+        max_time_ms = self._max_time_ms()
 
         try:
-            eval_str = """getattr(self._db, self.condition["table"]).find(condition)"""
+            eval_str = """self._collection().find(condition)"""
+            if max_time_ms:
+                eval_str += ".max_time_ms(" + str(max_time_ms) + ")"
+            if hint:
+                eval_str += ".hint(hint)"
             if sort:
                 eval_str += ".sort(" + str(sort) + ")"
             if skip:
@@ -125,11 +180,185 @@ class ConnectionMongoDB(object):
             }
         except Exception as e:
             self._log_exception(e, "select", self.condition)
+            self._check_timeout(e)
+            raise
+
+    def count(self):
+        where = self.condition["where"]
+        try:
+            max_time_ms = self._max_time_ms()
+            kwargs = {"maxTimeMS": max_time_ms} if max_time_ms else {}
+            res = self._collection().count_documents(where, **kwargs)
+            query = "{}.count_documents({})".format(self.condition["table"],
+                                                    str(where)) if self._return_query else ""
+            self.condition = {}  # reset condition
+            return {
+                "data": res,
+                "query": query
+            }
+        except Exception as e:
+            self._log_exception(e, "count", self.condition)
+            self._check_timeout(e)
+            raise
+
+    def exists(self):
+        where = self.condition["where"]
+        try:
+            kwargs = {"hint": self.condition["hint"]} if self.condition.get("hint") else {}
+            res = self._collection().find_one(where, {"_id": 1}, max_time_ms=self._max_time_ms(), **kwargs)
+            query = "{}.find_one({})".format(self.condition["table"],
+                                             str(where)) if self._return_query else ""
+            self.condition = {}  # reset condition
+            return {
+                "data": res is not None,
+                "query": query
+            }
+        except Exception as e:
+            self._log_exception(e, "exists", self.condition)
+            self._check_timeout(e)
+            raise
+
+    def aggregate(self, operator, field):
+        """
+        :param operator: str,$sum $avg $min $max
+        """
+        pipeline = [
+            {"$match": self.condition["where"]},
+            {"$group": {"_id": None, "value": {operator: "$" + field}}}
+        ]
+        try:
+            max_time_ms = self._max_time_ms()
+            kwargs = {"maxTimeMS": max_time_ms} if max_time_ms else {}
+            res = list(self._collection().aggregate(pipeline, **kwargs))
+            query = "{}.aggregate({})".format(self.condition["table"],
+                                              str(pipeline)) if self._return_query else ""
+            self.condition = {}  # reset condition
+            return {
+                "data": res[0]["value"] if res else None,
+                "query": query
+            }
+        except Exception as e:
+            self._log_exception(e, "aggregate", self.condition)
+            self._check_timeout(e)
+            raise
+
+    def sample(self, size):
+        """
+        $sample for number of documents,$rand for fraction
+
+        :param size: int or float,see ChainDB.sample
+        """
+        pipeline = [{"$match": self.condition["where"]}]
+        if isinstance(size, float):
+            pipeline.append({"$match": {"$expr": {"$lt": [{"$rand": {}}, size]}}})
+        else:
+            pipeline.append({"$sample": {"size": size}})
+        try:
+            max_time_ms = self._max_time_ms()
+            kwargs = {"maxTimeMS": max_time_ms} if max_time_ms else {}
+            res = list(self._collection().aggregate(pipeline, **kwargs))
+            query = "{}.aggregate({})".format(self.condition["table"],
+                                              str(pipeline)) if self._return_query else ""
+            self.condition = {}  # reset condition
+            return {
+                "data": res,
+                "query": query
+            }
+        except Exception as e:
+            self._log_exception(e, "sample", self.condition)
+            self._check_timeout(e)
+            raise
+
+    def pluck(self, field):
+        where = self.condition["where"]
+        sort = self.condition.get("sort", "")
+        skip = int(self.condition.get("skip") or 0)
+        limit = int(self.condition.get("limit") or 0)
+        try:
+            cursor = self._collection().find(where, {field: 1}, max_time_ms=self._max_time_ms())
+            if self.condition.get("hint"):
+                cursor = cursor.hint(self.condition["hint"])
+            if sort:
+                cursor = cursor.sort(sort)
+            if skip:
+                cursor = cursor.skip(skip)
+            if limit:
+                cursor = cursor.limit(limit)
+            query = "{}.find({}, {})".format(self.condition["table"], str(where),
+                                             str({field: 1})) if self._return_query else ""
+            self.condition = {}  # reset condition
+            return {
+                "data": [i.get(field) for i in cursor],
+                "query": query
+            }
+        except Exception as e:
+            self._log_exception(e, "pluck", self.condition)
+            self._check_timeout(e)
+            raise
+
+    def split_buckets(self, key, chunk_rows):
+        """split range of key with the conditions to conditions of chunks by $bucketAuto"""
+        where = self.condition["where"]
+        try:
+            count = self._collection().count_documents(where)
+            buckets = []
+            if count:
+                buckets = list(self._collection().aggregate([
+                    {"$match": where},
+                    {"$bucketAuto": {"groupBy": "$" + key, "buckets": int(math.ceil(count / float(chunk_rows)))}}
+                ]))
+        except Exception as e:
+            self._log_exception(e, "split_buckets", self.condition)
+            raise
+        self.condition = {}  # reset condition
+
+        conditions = []
+        for index, bucket in enumerate(buckets):
+            end = "$lte" if index == len(buckets) - 1 else "$lt"  # max of the last bucket is inclusive
+            conditions.append({"$and": [where, {key: {"$gte": bucket["_id"]["min"], end: bucket["_id"]["max"]}}]})
+        return conditions
+
+    def open_blob(self, field):
+        """open the GridFS file whose id is the value of field in the first document"""
+        where = self.condition["where"]
+        try:
+            document = self._collection().find_one(where, {field: 1})
+            self.condition = {}  # reset condition
+            if not document or document.get(field) is None:
+                return io.BytesIO()
+            return gridfs.GridFSBucket(self._db).open_download_stream(document[field])
+        except Exception as e:
+            self._log_exception(e, "open_blob", self.condition)
+            raise
+
+    def write_blob(self, field, data, chunk_size, filename):
+        """upload data to GridFS by chunks,set field of the documents to the file id"""
+        where = self.condition["where"]
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if isinstance(data, (bytes, bytearray)):
+            data = io.BytesIO(data)
+        try:
+            self._ensure_connected()
+            file_id = gridfs.GridFSBucket(self._db).upload_from_stream(
+                filename or field, data, chunk_size_bytes=chunk_size)
+            res = self._collection().update_many(where, {"$set": {field: file_id}})
+            query = "{}.update_many({}, {})".format(self.condition["table"], str(where),
+                                                    str({"$set": {field: file_id}})) if self._return_query else ""
+            self.condition = {}  # reset condition
+            return {
+                "lastrowid": file_id,  # id of the GridFS file
+                "rowcount": res.modified_count,  # number of rows affected
+                "rownumber": 0,  # line number
+                "query": query  # query executed
+            }
+        except Exception as e:
+            self._log_exception(e, "write_blob", self.condition)
             raise
 
     def insert(self, parameters):
         try:
-            getattr(self._db, self.condition["table"]).insert_one(parameters)
+            self._collection().insert_one(parameters)
             return {
                 "lastrowid": 0,  # the primary key id affected
                 "rowcount": 0,  # number of rows affected
@@ -143,7 +372,7 @@ class ConnectionMongoDB(object):
 
     def insert_many(self, parameters):
         try:
-            getattr(self._db, self.condition["table"]).insert_many(parameters)
+            self._collection().insert_many(parameters)
             return {
                 "lastrowid": 0,  # the primary key id affected
                 "rowcount": 0,  # number of rows affected
@@ -159,7 +388,7 @@ class ConnectionMongoDB(object):
         where = self.condition["where"]
 
         try:
-            res = getattr(self._db, self.condition["table"]).update(where, parameters)
+            res = self._collection().update(where, parameters)
             # returns  {'n': 1, 'nModified': 1, 'ok': 1.0, 'updatedExisting': True}
             query = "{}.update({}, {})".format(self.condition["table"], str(where),
                                                str(parameters)) if self._return_query else ""
@@ -175,10 +404,61 @@ class ConnectionMongoDB(object):
             self._log_exception(e, "update", self.condition)
             raise
 
+    def update_many(self, requests):
+        """
+        :param requests: list of tuple,filter and update document
+        """
+        try:
+            res = self._collection().bulk_write(
+                [pymongo.UpdateOne(f, u) for f, u in requests], ordered=False)
+            query = "{}.bulk_write({})".format(self.condition["table"],
+                                               str(requests)) if self._return_query else ""
+            self.condition = {}  # reset condition
+            return {
+                "lastrowid": 0,  # the primary key id affected
+                "rowcount": res.modified_count,  # number of rows affected
+                "rownumber": 0,  # line number
+                "query": query  # query executed
+            }
+        except Exception as e:
+            self._log_exception(e, "update_many", self.condition)
+            raise
+
+    def upsert(self, requests):
+        """
+        update one document or insert it if not exists
+
+        :param requests: list of tuple,filter and update document
+        """
+        try:
+            collection = self._collection()
+            if len(requests) == 1:
+                res = collection.update_one(requests[0][0], requests[0][1], upsert=True)
+                lastrowid = res.upserted_id or 0
+                rowcount = res.modified_count + (1 if res.upserted_id is not None else 0)
+                query_tmpl = "{}.update_one({}, upsert=True)"
+            else:
+                res = collection.bulk_write([pymongo.UpdateOne(f, u, upsert=True) for f, u in requests],
+                                            ordered=False)
+                lastrowid = 0
+                rowcount = res.modified_count + res.upserted_count
+                query_tmpl = "{}.bulk_write({}, upsert=True)"
+            query = query_tmpl.format(self.condition["table"], str(requests)) if self._return_query else ""
+            self.condition = {}  # reset condition
+            return {
+                "lastrowid": lastrowid,  # the primary key id affected
+                "rowcount": rowcount,  # number of rows affected
+                "rownumber": 0,  # line number
+                "query": query  # query executed
+            }
+        except Exception as e:
+            self._log_exception(e, "upsert", self.condition)
+            raise
+
     def delete(self):
         where = self.condition["where"]
         try:
-            res = getattr(self._db, self.condition["table"]).remove(where)
+            res = self._collection().remove(where)
             # returns {'n': 2, 'ok': 1.0}
             query = "{}.remove({})".format(self.condition["table"],
                                            str(self.condition["where"])) if self._return_query else ""
@@ -203,6 +483,7 @@ class ChainDB(base.ChainDB):
         if return_query:
             config_dict["return_query"] = return_query
         self.db = ConnectionMongoDB(**config_dict)
+        self._connect_config = config_dict  # used by clone
 
     def execute(self, *args, **kwargs):
         logging.warning("Saiorm does not support execute in MongoDB")
@@ -216,6 +497,26 @@ class ChainDB(base.ChainDB):
         logging.warning("Saiorm does not support query in MongoDB")
         return self
 
+    def batch(self):
+        logging.warning("Saiorm does not support batch in MongoDB,statements will be executed immediately")
+        return super().batch()
+
+    def iter_batches(self, fields="*", batch_size=10000):
+        logging.warning("Saiorm does not support iter_batches in MongoDB")
+        return self
+
+    def defer(self, *args, **kwargs):
+        logging.warning("Saiorm does not support defer in MongoDB,select fields instead")
+        return self
+
+    def select_arrow(self, *args, **kwargs):
+        logging.warning("Saiorm does not support select_arrow in MongoDB")
+        return self
+
+    def select_dataframe(self, *args, **kwargs):
+        logging.warning("Saiorm does not support select_dataframe in MongoDB")
+        return self
+
     def group_by(self, condition):
         logging.warning("Saiorm does not support group_by in MongoDB")
         return self
@@ -249,12 +550,114 @@ class ChainDB(base.ChainDB):
         self.last_query = res["query"]
         return res["data"]
 
+    def count(self, field="*"):
+        self.set_condition()
+        res = self.db.count()
+        self.last_query = res["query"]
+        return res["data"]
+
+    def exists(self):
+        self.set_condition()
+        res = self.db.exists()
+        self.last_query = res["query"]
+        return res["data"]
+
+    def sum(self, field):
+        return self.aggregate("$sum", field)
+
+    def avg(self, field):
+        return self.aggregate("$avg", field)
+
+    def min(self, field):
+        return self.aggregate("$min", field)
+
+    def max(self, field):
+        return self.aggregate("$max", field)
+
+    def aggregate(self, operator, field=None):
+        self.set_condition()
+        res = self.db.aggregate(operator, field)
+        self.last_query = res["query"]
+        return res["data"]
+
+    def sample(self, size, seed=None):
+        """$sample,the documents are different every time"""
+        self.check_sample_size(size)
+        if seed is not None:
+            logging.warning("Saiorm does not support seed of sample in MongoDB")
+        self.set_condition()
+        res = self.db.sample(size)
+        self.last_query = res["query"]
+        return res["data"]
+
+    def parallel_scan(self, fields="*", key="_id", workers=4, chunk_rows=10000, ordered=False):
+        """
+        split the range of key with the conditions by $bucketAuto,find the chunks in parallel,
+        MongoClient is thread safe and shared by the threads.
+
+        :param fields: list of field names,all fields if not list
+        """
+        self.set_condition()
+        collection = self.db._collection()
+        sort = self.db.condition["sort"]
+        conditions = self.db.split_buckets(key, chunk_rows)
+        projection = {f: 1 for f in fields} if is_array(fields) else None
+
+        def find(condition):
+            cursor = collection.find(condition, projection)
+            if sort:
+                cursor = cursor.sort(sort)
+            return list(cursor)
+
+        return scan.run_parallel(find, conditions, workers, ordered)
+
+    def pluck(self, field):
+        self.set_condition()
+        res = self.db.pluck(field)
+        self.last_query = res["query"]
+        return res["data"]
+
+    def open_blob(self, field, chunk_size=blob.CHUNK_SIZE):
+        """
+        return GridOut of the GridFS file whose id is the value of field in the first document,
+        chunks are read as needed
+        """
+        self.set_condition()
+        return self.db.open_blob(field)
+
+    def write_blob(self, field, data, chunk_size=blob.CHUNK_SIZE, filename=None):
+        """
+        upload bytes,str or binary file object to GridFS by chunks,
+        set field of the documents with the conditions to the file id,the old file is kept
+
+        :param filename: str,name of GridFS file,field by default
+        """
+        self.set_condition()
+        res = self.db.write_blob(field, data, chunk_size, filename)
+        self.last_query = res["query"]
+        return res
+
     def update(self, dict_data=None):
         self.set_condition()
         res = self.db.update(dict_data)
         self.last_query = res["query"]
         return res
 
+    def update_many(self, dict_data=None, key="_id"):
+        if not dict_data:
+            return False
+        self.set_condition()
+        where = self.db.condition["where"]
+        requests = []
+        for i in dict_data:
+            condition = dict(where)
+            condition[key] = i[key]
+            requests.append((condition, {"$set": {k: v for k, v in i.items() if k != key}}))
+
+        res = self.db.update_many(requests)
+        self.last_query = res["query"]
+        return res
+
     def insert(self, dict_data=None):
         self.set_condition()
         if "fields" in dict_data and "values" in dict_data:  # split dict
@@ -266,6 +669,8 @@ class ChainDB(base.ChainDB):
         return res
 
     def insert_many(self, dict_data=None):
+        if columnar.is_columnar(dict_data):
+            return self.insert_columns(dict_data)
         self.set_condition()
         if isinstance(dict_data, dict):
             keys = dict_data.keys()
@@ -278,6 +683,65 @@ class ChainDB(base.ChainDB):
         self.last_query = res["query"]
         return res
 
+    def bulk_rows(self, fields, rows):
+        self.set_condition()
+        res = self.db.insert_many([dict(zip(fields, i)) for i in rows])
+        res["rowcount"] = len(rows)
+        return res
+
+    def upsert(self, dict_data=None, conflict_keys=None, update_fields=None):
+        """
+        conflict_keys is _id by default.
+        update_fields as dict is $set of the values,or update operators like {"$inc": {"n": 1}},
+        they are applied on insert too,other fields are $setOnInsert
+        """
+        if not dict_data:
+            return False
+        return self.upsert_many([dict_data], conflict_keys, update_fields)
+
+    def upsert_many(self, dict_data=None, conflict_keys=None, update_fields=None):
+        if not dict_data:
+            return False
+        self.set_condition()
+        if isinstance(dict_data, dict):  # split dict
+            dict_data = [dict(zip(dict_data["fields"], v)) for v in dict_data["values"]]
+
+        conflict_keys = conflict_keys or ["_id"]
+        if isinstance(conflict_keys, str):
+            conflict_keys = [conflict_keys]
+
+        requests = []
+        for i in dict_data:
+            keys = [k for k in i.keys() if k not in conflict_keys]
+            if isinstance(update_fields, dict):
+                update = self.gen_upsert_update(update_fields)
+            else:
+                fields = keys if update_fields is None else [k for k in keys if k in update_fields]
+                update = {"$set": {k: i[k] for k in fields}} if fields else {}
+            updated = set(k for v in update.values() for k in v)
+            insert_only = {k: i[k] for k in keys if k not in updated}
+            if insert_only:
+                update["$setOnInsert"] = insert_only
+            if not update:  # conflict keys only,update document must not be empty
+                update["$setOnInsert"] = {k: i[k] for k in conflict_keys}
+            requests.append(({k: i[k] for k in conflict_keys}, update))
+
+        res = self.db.upsert(requests)
+        self.last_query = res["query"]
+        return res
+
+    def gen_upsert_update(self, update_fields):
+        """update document of dict update_fields,fields are $set,keys start with $ are operators"""
+        update = {}
+        for k, v in update_fields.items():
+            if k.startswith("$"):
+                update.setdefault(k, {}).update(v)
+            elif isinstance(v, str) and v.startswith("`"):
+                logging.warning("Saiorm does not support native function in MongoDB:" + k)
+            else:
+                update.setdefault("$set", {})[k] = v
+        return update
+
     def delete(self):
         self.set_condition()
         res = self.db.delete()
@@ -298,9 +762,28 @@ class ChainDB(base.ChainDB):
         self.last_query = res["query"]
         return res
 
+    def increase_many(self, field, deltas, key="_id"):
+        """increase field of many documents by different steps,by $inc in one bulk write"""
+        if not deltas:
+            return False
+        self.set_condition()
+        where = self.db.condition["where"]
+        requests = []
+        for k, step in deltas.items():
+            condition = dict(where)
+            condition[key] = k
+            requests.append((condition, {"$inc": {field: step}}))
+
+        res = self.db.update_many(requests)
+        self.last_query = res["query"]
+        return res
+
     def get_fields_name(self):
         logging.warning("Saiorm does not support get_fields_name in MongoDB")
 
+    def get_schema(self, table_name=""):
+        logging.warning("Saiorm does not support get_schema in MongoDB")
+
     def set_condition(self):
         """
         set condition to MongoDB
@@ -311,8 +794,12 @@ class ChainDB(base.ChainDB):
             "where": {},
             "sort": [],  # pymongo needs list type
             "limit": "0",
-            "skip": "0"
+            "skip": "0",
+            "timeout": self._timeout,
+            "hint": self._hint["index"][0] if self._hint and self._hint["index"] else None  # index name
         }
+        self._timeout = None  # for the next statement only
+        self._hint = None
         sql = ""
         sql_values = []
         if self._where:
@@ -4,9 +4,11 @@
 Support MySQL
 """
 import ast
+import contextlib
+import functools
+import os
+import tempfile
 import time
-from pymysql import cursors
-from pymysql import connect
 
 import logging
 
@@ -20,19 +22,59 @@ try:
 except ImportError:
     import base
 
+try:
+    from . import batch
+except ImportError:
+    import batch
+
+try:
+    from . import errors
+except ImportError:
+    import errors
+
+try:
+    from . import forksafe
+except ImportError:
+    import forksafe
+
+try:
+    from . import columnar
+except ImportError:
+    import columnar
+
+try:
+    from . import guard
+except ImportError:
+    import guard
+
+try:
+    from . import csvio
+except ImportError:
+    import csvio
+
 Row = utility.Row
+LRUCache = utility.LRUCache
 GraceDict = utility.GraceDict
 is_array = utility.is_array
 to_unicode = utility.to_unicode
+escape_tsv_value = csvio.escape_tsv_value
+
+pymysql = utility.LazyModule("pymysql")  # imported on first connection
 
 
 class Connection(object):
     def __init__(self, host, port, database, user=None, password=None,
                  max_idle_time=7 * 3600, connect_timeout=60,
-                 time_zone="+0:00", charset="utf8", **kwargs):
+                 time_zone="+0:00", charset="utf8", multi_statements=False, retry_policy=None, timeout=None,
+                 result_guard=None, **kwargs):
         self.host = host
         self.database = database
         self.max_idle_time = float(max_idle_time)
+        self.retry_policy = retry_policy or errors.RetryPolicy()
+        self.multi_statements = multi_statements  # send batch in one round trip
+        self.local_infile = kwargs.get("local_infile", False)  # LOAD DATA LOCAL INFILE is allowed
+        self.timeout = timeout  # default seconds of SELECT,by max_execution_time of session
+        self.result_guard = result_guard  # bound the rows of query_return_detail
 
         args = dict(
             host=host,
@@ -42,41 +84,45 @@ class Connection(object):
             db=database,
             charset=charset,
             use_unicode=True,
-            init_command=('SET time_zone = "%s"' % time_zone),
+            init_command=('SET time_zone = "%s"' % time_zone) + (
+                ", max_execution_time = %d" % (timeout * 1000) if timeout else ""),
             connect_timeout=connect_timeout,
             **kwargs
         )
 
         self._db = None
         self._db_args = args
-        self._last_use_time = time.time()
-        try:
-            self.reconnect()
-        except Exception:
-            # logging.error("Cannot connect to MySQL on %s", self.host,
-            #               exc_info=True)
-            pass
+        self._last_use_time = time.time()  # connect on the first statement
+        forksafe.register(self)
 
     def __del__(self):
         self.close()
 
     def close(self):
         """Closes this database connection."""
+        if forksafe.is_inherited(self):  # opened by parent process,never close it on the wire
+            forksafe.discard(self)
         if getattr(self, "_db", None) is not None:
-            self._db.close()
+            try:
+                self._db.close()
+            except Exception:
+                pass  # broken connection
             self._db = None
 
     def reconnect(self):
         """Closes the existing database connection and re-opens it.
         改用 pymysql 实现"""
         self.close()
-        self._db = connect(**self._db_args)
+        args = self._db_args
+        if self.multi_statements:
+            args = dict(args, client_flag=args.get("client_flag", 0) | pymysql.constants.CLIENT.MULTI_STATEMENTS)
+        self._db = pymysql.connect(**args)
         self._db.autocommit(True)
 
     def iter(self, query, *parameters, **kwparameters):
         """Returns an iterator for the given query and parameters."""
         self._ensure_connected()
-        cursor = cursors.SSCursor(self._db)
+        cursor = pymysql.cursors.SSCursor(self._db)
         try:
             self._execute(cursor, query, parameters, kwparameters)
             column_names = [d[0] for d in cursor.description]
@@ -85,12 +131,28 @@ class Connection(object):
         finally:
             cursor.close()
 
+    def iter_batches(self, batch_size, query, *parameters, **kwparameters):
+        """
+        Returns an iterator of column names and list of row tuples,
+        fetched by batch_size with server side cursor.
+        """
+        self._ensure_connected()
+        cursor = pymysql.cursors.SSCursor(self._db)
+        try:
+            self._execute(cursor, query, parameters, kwparameters)
+            for res in columnar.fetch_batches(cursor, batch_size):
+                yield res
+        finally:
+            cursor.close()
+
     def _ensure_connected(self):
         # Mysql by default closes client connections that are idle for
         # 8 hours, but the client library does not report this fact until
         # you try to perform a query and it fails.  Protect against this
         # case by preemptively closing and reopening the connection
         # if it has been idle for too long (7 hours by default).
+        if forksafe.is_inherited(self):  # opened by parent process,never close it on the wire
+            forksafe.discard(self)
         if (self._db is None or
                 (time.time() - self._last_use_time > self.max_idle_time)):
             self.reconnect()
@@ -100,35 +162,113 @@ class Connection(object):
         self._ensure_connected()
         return self._db.cursor()
 
+    def _query_cursor(self):
+        """server side cursor when result_guard is set,rows are checked before buffered in client"""
+        if self.result_guard is None:
+            return self._cursor()
+        self._ensure_connected()
+        return pymysql.cursors.SSCursor(self._db)
+
+    def _drop_result(self, cursor):
+        """
+        drop the unread rows of server side cursor by closing the connection,
+        closing the cursor would read all of them,it's reopened on the next statement
+        """
+        cursor._result = None  # cursor.close does not read the rows
+        self.close()
+
     def _log_exception(self, exception, query, parameters):
         """log exception when execute SQL"""
         logging.error("Error on MySQL Server:" + self.host)
-        logging.error("Error query:", query)
-        logging.error("Error parameters:", parameters)
-        logging.error("Error Exception:", str(exception))
+        logging.error("Error query:" + str(query))
+        logging.error("Error parameters:" + str(parameters))
+        logging.error("Error Exception:" + str(exception))
+
+    def classify_error(self, exception):
+        """return kind of exception,see saiorm.errors"""
+        code = errors.error_code(exception)
+        if isinstance(exception, pymysql.err.MySQLError) and code in (1317, 3024):  # interrupted,max time
+            return errors.TIMEOUT
+        if isinstance(exception, (pymysql.err.OperationalError, pymysql.err.InternalError)):
+            if code in (1205, 1213):  # lock wait timeout,deadlock
+                return errors.DEADLOCK
+            if code in (2003, 2006, 2013, 2055):  # can not connect,gone away,lost
+                return errors.CONNECTION_LOST
+        if isinstance(exception, (pymysql.err.InterfaceError, ConnectionError, OSError)):
+            return errors.CONNECTION_LOST
+        return errors.STATEMENT
+
+    @contextlib.contextmanager
+    def deadline(self, seconds=None):
+        """
+        cancel the statements in with block by KILL QUERY from another connection after seconds,
+        QueryTimeoutError is raised. Do nothing if seconds is empty.
+        """
+        watchdog = None
+        if seconds:
+            self._ensure_connected()
+            watchdog = utility.Watchdog(seconds, functools.partial(self._kill_query, self._db.thread_id()))
+        try:
+            yield
+        finally:
+            if watchdog is not None:
+                watchdog.stop()
+
+    def _kill_query(self, thread_id):
+        db = pymysql.connect(**self._db_args)
+        try:
+            with db.cursor() as cursor:
+                cursor.execute("KILL QUERY %s", (thread_id,))
+        finally:
+            db.close()
 
     def _execute(self, cursor, query, parameters, kwparameters):
         try:
             return cursor.execute(query, kwparameters or parameters)
         except Exception as e:
             self._log_exception(e, query, parameters)
-            self.close()
+            kind = self.classify_error(e)
+            if kind == errors.CONNECTION_LOST:
+                self.close()
+            if kind == errors.TIMEOUT:
+                raise errors.QueryTimeoutError("Query cancelled by timeout:" + str(e)) from e
             raise
 
+    @errors.retryable
     def query_return_detail(self, query, *parameters, **kwparameters):
         """return_detail"""
-        cursor = self._cursor()
+        cursor = self._query_cursor()
         try:
             self._execute(cursor, query, parameters, kwparameters)
-            column_names = [d[0] for d in cursor.description]
+            try:
+                column_names, data = guard.collect(self.result_guard, cursor)
+            except errors.ResultTooLargeError:
+                self._drop_result(cursor)
+                raise
+            if getattr(data, "truncated", False):
+                self._drop_result(cursor)
             return {
-                "data": [Row(zip(column_names, row)) for row in cursor],
+                "data": data,
                 "column_names": column_names,
                 "query": to_unicode(cursor._executed)  # query executed
             }
         finally:
             cursor.close()
 
+    @errors.retryable
+    def query_column(self, query, *parameters, **kwparameters):
+        """return values of the first column only,without building Row"""
+        cursor = self._cursor()
+        try:
+            self._execute(cursor, query, parameters, kwparameters)
+            return {
+                "data": [row[0] for row in cursor],
+                "query": to_unicode(cursor._executed)  # query executed
+            }
+        finally:
+            cursor.close()
+
+    @errors.retryable
     def execute_return_detail(self, query, *parameters, **kwparameters):
         """return_detail"""
         cursor = self._cursor()
@@ -143,6 +283,50 @@ class Connection(object):
         finally:
             cursor.close()
 
+    def execute_batch(self, items):
+        """
+        send statements in one round trip when multi_statements is enabled,
+        executemany is still executed alone.
+
+        MySQL stops at the failed statement,the statements after it will be sent again.
+        """
+        if not self.multi_statements:
+            batch.run_sequential(self, items)
+            return
+
+        for joined, group in batch.group_items(items, lambda i: i.kind != "executemany"):
+            if not joined:
+                batch.run_sequential(self, group)
+                continue
+
+            while group:
+                cursor = self._cursor()
+                index = 0
+                try:
+                    statements = [to_unicode(cursor.mogrify(i.sql, i.kwparameters or i.parameters))
+                                  for i in group]
+                    cursor.execute(batch.join_statements(statements))
+                    while True:
+                        item = group[index]
+                        if cursor.description:
+                            column_names = [d[0] for d in cursor.description]
+                            item["data"] = [Row(zip(column_names, row)) for row in cursor.fetchall()]
+                            item["column_names"] = column_names
+                        item["lastrowid"] = cursor.lastrowid
+                        item["rowcount"] = cursor.rowcount
+                        item["query"] = statements[index]
+                        index += 1
+                        if index >= len(group) or not cursor.nextset():
+                            break
+                    group = []
+                except Exception as e:
+                    batch.log_error("MySQL Server:" + self.host, e, group[index])
+                    group[index]["error"] = e
+                    group = group[index + 1:]
+                finally:
+                    cursor.close()
+
+    @errors.retryable
     def executemany_return_detail(self, query, parameters):
         """return_detail"""
         cursor = self._cursor()
@@ -156,15 +340,120 @@ class Connection(object):
             }
         except Exception as e:
             self._log_exception(e, query, parameters)
-            self.close()
+            kind = self.classify_error(e)
+            if kind == errors.CONNECTION_LOST:
+                self.close()
+            if kind == errors.TIMEOUT:
+                raise errors.QueryTimeoutError("Query cancelled by timeout:" + str(e)) from e
             raise
         finally:
             cursor.close()
 
+    def load_data(self, query, *parameters):
+        """execute LOAD DATA,return_detail with warnings"""
+        cursor = self._cursor()
+        try:
+            self._execute(cursor, query, parameters, {})
+            return {
+                "lastrowid": cursor.lastrowid,
+                "rowcount": cursor.rowcount,  # number of rows loaded
+                "rownumber": cursor.rownumber,
+                "query": to_unicode(cursor._executed),  # query executed
+                "warnings": list(self._db.show_warnings())  # tuples of level,code and message
+            }
+        finally:
+            cursor.close()
+
 
 class ChainDB(base.ChainDB):
     def connect(self, config_dict=None):
         self.db = Connection(**config_dict)
+        self._connect_config = config_dict  # used by clone
+        self.insert_many_in_one_statement = True  # executemany of pymysql sends multiple-row INSERT
+
+    def build_select(self, fields="*"):
+        """add optimizer hints,and MAX_EXECUTION_TIME hint when timeout is set"""
+        optimizer = self._hint["optimizer"] if self._hint else None
+        sql, condition_values = super().build_select(fields)
+        hints = []
+        if self._timeout:
+            hints.append("MAX_EXECUTION_TIME({})".format(int(self._timeout * 1000)))
+        if optimizer:
+            hints.append(optimizer)
+        if hints and sql.startswith("SELECT "):
+            sql = "SELECT /*+ {} */ ".format(" ".join(hints)) + sql[7:]
+        return sql, condition_values
+
+    def gen_table_hint(self):
+        """USE INDEX or FORCE INDEX"""
+        if not self._hint or not self._hint["index"]:
+            return ""
+        return " {} INDEX ({})".format("FORCE" if self._hint["force"] else "USE", ",".join(self._hint["index"]))
+
+    def gen_random_order(self, seed=None):
+        return "RAND({})".format(int(seed)) if seed is not None else "RAND()"
+
+    def consecutive_insert_ids(self):
+        """
+        ids of a multiple-row INSERT are consecutive with innodb_autoinc_lock_mode 0 or 1,
+        not with 2 (the default of MySQL 8) when inserted concurrently
+        """
+        try:
+            row = self.db.query_return_detail("SELECT @@innodb_autoinc_lock_mode AS lock_mode, "
+                                              "@@auto_increment_increment AS increment;")["data"][0]
+        except Exception as e:
+            logging.warning("Cannot check innodb_autoinc_lock_mode:" + str(e))
+            return False
+        return int(row["lock_mode"]) in (0, 1) and int(row["increment"]) == 1
+
+    def bulk_load(self, rows, fields=None, on_duplicate=None, batch_size=10000):
+        """
+        insert rows by LOAD DATA LOCAL INFILE,much faster than insert_many for large data.
+        Rows are written to a temporary file in escaped TSV format first.
+
+        Pass local_infile=True to connect to enable it.
+
+        :param rows: iterable of dict or list/tuple,could be a generator
+        :param fields: list,field names,use keys of the first dict if empty
+        :param on_duplicate: str,replace or ignore the rows with duplicate unique key
+        :param batch_size: int,number of lines in one write to the file
+        :return: dict,lastrowid,rowcount,rownumber,query and warnings
+        """
+        if on_duplicate not in (None, "replace", "ignore"):
+            raise ValueError("on_duplicate must be replace or ignore")
+
+        f = tempfile.NamedTemporaryFile(mode="wb", prefix="saiorm_", suffix=".tsv", delete=False)
+        try:
+            with f:
+                lines = []
+                for row in rows:
+                    if isinstance(row, dict):
+                        if fields is None:
+                            fields = list(row.keys())
+                        row = [row[k] for k in fields]
+                    lines.append(b"\t".join([escape_tsv_value(v) for v in row]))
+                    if len(lines) >= batch_size:
+                        f.write(b"\n".join(lines) + b"\n")
+                        lines = []
+                if lines:
+                    f.write(b"\n".join(lines) + b"\n")
+
+            sql = "LOAD DATA LOCAL INFILE %s {}INTO TABLE {} CHARACTER SET utf8mb4 " \
+                  "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n'{};".format(
+                      on_duplicate.upper() + " " if on_duplicate else "", self._table,
+                      " ({})".format(",".join(fields)) if fields else "")
+            res = self.db.load_data(sql, f.name)
+        finally:
+            os.remove(f.name)
+        self._reset()
+        self.last_query = res["query"]
+        return res
+
+    def bulk_rows(self, fields, rows):
+        """insert one chunk of rows by LOAD DATA when local_infile is enabled"""
+        if not self.db.local_infile:
+            return super().bulk_rows(fields, rows)
+        return self.bulk_load(rows, fields)
 
 
 class PositionDB(Connection):
@@ -222,23 +511,49 @@ class PositionDB(Connection):
     >>>select("user", "COUNT(id) AS rows_count", "")
     equals to:
     >>>count("user", "id", "")
+
+    **Statement cache**
+
+    Generated statements are cached by table, field and condition,
+    the table name prefix is replaced when compiling,not on every execution.
+    Raw queries are not cached,the prefix is replaced on every execution.
+    The size is statement_cache_size,call cache_info to get the stats.
     """
 
     def __init__(self, host, port, database, user=None, password=None,
                  max_idle_time=7 * 3600, connect_timeout=60, time_zone="+0:00",
-                 prefix="", prefix_sign="###", grace_result=True):
+                 prefix="", prefix_sign="###", grace_result=True, statement_cache_size=256,
+                 retry_policy=None, timeout=None):
         super().__init__(host, port, database, user, password,
-                         max_idle_time, connect_timeout, time_zone)
+                         max_idle_time, connect_timeout, time_zone, retry_policy=retry_policy, timeout=timeout)
         self.prefix = prefix  # table name prefix
         self.prefix_sign = prefix_sign  # 替换表前缀的字符
         self.grace_result = grace_result
+        self._statement_cache = LRUCache(statement_cache_size)
+
+    def cache_info(self):
+        """return stats of statement cache,dict of hits, misses, size, maxsize"""
+        return self._statement_cache.info()
+
+    def clear_cache(self):
+        self._statement_cache.clear()
+
+    def _compile(self, key, func, *args):
+        """return cached statement,or generate it by func and replace table name prefix"""
+        query = self._statement_cache.get(key)
+        if query is None:
+            query = func(*args)
+            if self.prefix_sign in query:
+                query = query.replace(self.prefix_sign, self.prefix)
+            self._statement_cache.set(key, query)
+        return query
 
     def _execute(self, cursor, query, parameters, kwparameters):
-        if self.prefix_sign in query:
+        if self.prefix_sign in query:  # raw query,generated statements are replaced in compiling
             query = query.replace(self.prefix_sign, self.prefix)
-
         super()._execute(cursor, query, parameters, kwparameters)
 
+    @errors.retryable
     def query(self, query, *parameters, **kwparameters):
         """Returns a row list for the given query and parameters."""
         cursor = self._cursor()
@@ -253,6 +568,7 @@ class PositionDB(Connection):
         finally:
             cursor.close()
 
+    @errors.retryable
     def execute_both(self, query, *parameters, **kwparameters):
         """return lastrowid and rowcount"""
         cursor = self._cursor()
@@ -262,6 +578,7 @@ class PositionDB(Connection):
         finally:
             cursor.close()
 
+    @errors.retryable
     def executemany_both(self, query, parameters):
         """return lastrowid and rowcount"""
         cursor = self._cursor()
@@ -275,6 +592,10 @@ class PositionDB(Connection):
         """
         :param many: bool,the sign of inserting many data in one line
         """
+        key = ("insert", table, field if isinstance(field, str) else tuple(field), many)
+        return self._compile(key, self._mk_insert_query, table, field, many)
+
+    def _mk_insert_query(self, table, field, many=False):
         table = self.prefix + table
         if isinstance(field, str):
             field = [i.strip() for i in field.split(",")]
@@ -306,12 +627,19 @@ class PositionDB(Connection):
         return query
 
     def mk_delete_query(self, table, condition):
+        return self._compile(("delete", table, condition), self._mk_delete_query, table, condition)
+
+    def _mk_delete_query(self, table, condition):
         # 生成 delete 语句
         table = self.prefix + table
         query = "DELETE FROM " + table + " " + condition
         return query
 
     def mk_update_query(self, table, field, condition):
+        key = ("update", table, field if isinstance(field, str) else tuple(field), condition)
+        return self._compile(key, self._mk_update_query, table, field, condition)
+
+    def _mk_update_query(self, table, field, condition):
         # 生成 update 语句
         table = self.prefix + table
         if isinstance(field, str):
@@ -327,7 +655,7 @@ class PositionDB(Connection):
                 field_str += (iks[0] + "=" + str(ivs[0]) + ", ")
             elif "=" in i:  # native mysql function
                 k, v = i.split("=")
-                field_str += (k + "=" + v)
+                field_str += (k + "=" + v + ", ")
             else:
                 field_str += (i + "=%s, ")
 
@@ -372,11 +700,16 @@ class PositionDB(Connection):
 
         :return: list
         """
-        table = self.prefix + table
-        query = "SELECT " + field + " FROM " + table + " " + condition
-
+        query = self.mk_select_query(table, field, condition)
         return self.query(query, *parameters, **kwparameters)
 
+    def mk_select_query(self, table, field, condition):
+        return self._compile(("select", table, field, condition), self._mk_select_query, table, field, condition)
+
+    def _mk_select_query(self, table, field, condition):
+        table = self.prefix + table
+        return "SELECT " + field + " FROM " + table + " " + condition
+
     def get(self, table, field, condition, *parameters, **kwparameters):
         """
         return the latest line of data with the conditions
@@ -392,9 +725,7 @@ class PositionDB(Connection):
 
         :return: int
         """
-        table = self.prefix + table
-        field = 'COUNT(' + field + ') AS rows_count'
-        query = "SELECT " + field + " FROM " + table + " " + condition
+        query = self.mk_select_query(table, 'COUNT(' + field + ') AS rows_count', condition)
         rows_count = self.query(query, *parameters, **kwparameters)
         if rows_count:
             return int(rows_count[0]["rows_count"])
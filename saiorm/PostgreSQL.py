@@ -5,10 +5,10 @@ Support PostgreSQL
 
 bases on torndb
 """
+import contextlib
 import logging
 import time
-
-import psycopg2
+import uuid
 
 try:
     from . import utility
@@ -20,18 +20,53 @@ try:
 except ImportError:
     import base
 
+try:
+    from . import batch
+except ImportError:
+    import batch
+
+try:
+    from . import errors
+except ImportError:
+    import errors
+
+try:
+    from . import forksafe
+except ImportError:
+    import forksafe
+
+try:
+    from . import columnar
+except ImportError:
+    import columnar
+
+try:
+    from . import guard
+except ImportError:
+    import guard
+
+try:
+    from . import csvio
+except ImportError:
+    import csvio
+
 Row = utility.Row
 GraceDict = utility.GraceDict
 is_array = utility.is_array
 to_unicode = utility.to_unicode
 
+psycopg2 = utility.LazyModule("psycopg2")  # imported on first connection
+
 
 class Connection(object):
     def __init__(self, host, port, database, user=None, password=None,
-                 max_idle_time=7 * 3600):
+                 max_idle_time=7 * 3600, retry_policy=None, timeout=None, result_guard=None):
         self.host = host
         self.database = database
         self.max_idle_time = float(max_idle_time)
+        self.retry_policy = retry_policy or errors.RetryPolicy()
+        self.timeout = timeout  # default seconds of statement,by statement_timeout of session
+        self.result_guard = result_guard  # bound the rows of query_return_detail
 
         args = dict(
             host=host,
@@ -40,23 +75,26 @@ class Connection(object):
             password=password,
             database=database,
         )
+        if timeout:
+            args["options"] = "-c statement_timeout=%d" % (timeout * 1000)
 
         self._db = None
         self._db_args = args
-        self._last_use_time = time.time()
-        try:
-            self.reconnect()
-        except Exception:
-            logging.error("Cannot connect to PostgreSQL on {}:{}".format(self.host, port),
-                          exc_info=True)
+        self._last_use_time = time.time()  # connect on the first statement
+        forksafe.register(self)
 
     def __del__(self):
         self.close()
 
     def close(self):
         """Closes this database connection."""
+        if forksafe.is_inherited(self):  # opened by parent process,never close it on the wire
+            forksafe.discard(self)
         if getattr(self, "_db", None) is not None:
-            self._db.close()
+            try:
+                self._db.close()
+            except Exception:
+                pass  # broken connection
             self._db = None
 
     def reconnect(self):
@@ -79,12 +117,29 @@ class Connection(object):
         finally:
             cursor.close()
 
+    def iter_batches(self, batch_size, query, *parameters, **kwparameters):
+        """
+        Returns an iterator of column names and list of row tuples,
+        fetched by batch_size with server side cursor.
+        """
+        self._ensure_connected()
+        # named cursor is server side,withhold to use it in autocommit mode
+        cursor = self._db.cursor(name="saiorm_" + uuid.uuid4().hex, withhold=True)
+        try:
+            self._execute(cursor, query, parameters, kwparameters)
+            for res in columnar.fetch_batches(cursor, batch_size):
+                yield res
+        finally:
+            cursor.close()
+
     def _ensure_connected(self):
         # Mysql by default closes client connections that are idle for
         # 8 hours, but the client library does not report this fact until
         # you try to perform a query and it fails.  Protect against this
         # case by preemptively closing and reopening the connection
         # if it has been idle for too long (7 hours by default).
+        if forksafe.is_inherited(self):  # opened by parent process,never close it on the wire
+            forksafe.discard(self)
         if (self._db is None or
                 (time.time() - self._last_use_time > self.max_idle_time)):
             self.reconnect()
@@ -94,35 +149,96 @@ class Connection(object):
         self._ensure_connected()
         return self._db.cursor()
 
+    def _query_cursor(self, query):
+        """
+        server side cursor when result_guard is set and query is SELECT,
+        rows are fetched by itersize and checked before buffered in client
+        """
+        if self.result_guard is None or not guard.is_select(query):
+            return self._cursor()
+        self._ensure_connected()
+        # named cursor is server side,withhold to use it in autocommit mode
+        return self._db.cursor(name="saiorm_" + uuid.uuid4().hex, withhold=True)
+
     def _log_exception(self, exception, query, parameters):
         """log exception when execute SQL"""
         logging.error("Error on postgresSQL:" + self.host)
-        logging.error("Error query:", query.replace("%s", "{}").format(*parameters))
+        logging.error("Error query:" + str(query))
+        logging.error("Error parameters:" + str(parameters))
         logging.error("Error Exception:" + str(exception))
 
+    def classify_error(self, exception):
+        """return kind of exception,see saiorm.errors"""
+        pgcode = getattr(exception, "pgcode", None) or ""
+        if pgcode == "57014":  # query canceled
+            return errors.TIMEOUT
+        if pgcode in ("40001", "40P01"):  # serialization failure,deadlock
+            return errors.DEADLOCK
+        if pgcode.startswith("08") or pgcode in ("57P01", "57P02", "57P03"):  # connection exception,shutdown
+            return errors.CONNECTION_LOST
+        if isinstance(exception, (psycopg2.InterfaceError, psycopg2.OperationalError)):
+            if self._db is None or self._db.closed:
+                return errors.CONNECTION_LOST
+        return errors.STATEMENT
+
+    @contextlib.contextmanager
+    def deadline(self, seconds=None):
+        """
+        cancel the statements in with block by cancel() after seconds,
+        QueryTimeoutError is raised. Do nothing if seconds is empty.
+        """
+        watchdog = None
+        if seconds:
+            self._ensure_connected()
+            watchdog = utility.Watchdog(seconds, self._db.cancel)
+        try:
+            yield
+        finally:
+            if watchdog is not None:
+                watchdog.stop()
+
     def _execute(self, cursor, query, parameters, kwparameters):
         try:
             return cursor.execute(query, kwparameters or parameters)
         except Exception as e:
             self._log_exception(e, query, parameters)
-            self.close()
+            kind = self.classify_error(e)
+            if kind == errors.CONNECTION_LOST:
+                self.close()
+            if kind == errors.TIMEOUT:
+                raise errors.QueryTimeoutError("Query cancelled by timeout:" + str(e)) from e
             raise
 
+    @errors.retryable
     def query_return_detail(self, query, *parameters, **kwparameters):
         """return_detail"""
-        cursor = self._cursor()
+        cursor = self._query_cursor(query)
         try:
             self._execute(cursor, query, parameters, kwparameters)
-            column_names = [d[0] for d in cursor.description]
+            column_names, data = guard.collect(self.result_guard, cursor)
 
             return {
-                "data": [Row(zip(column_names, row)) for row in cursor],
+                "data": data,
                 "column_names": column_names,
                 "query": to_unicode(cursor.query)  # query executed
             }
         finally:
             cursor.close()
 
+    @errors.retryable
+    def query_column(self, query, *parameters, **kwparameters):
+        """return values of the first column only,without building Row"""
+        cursor = self._cursor()
+        try:
+            self._execute(cursor, query, parameters, kwparameters)
+            return {
+                "data": [row[0] for row in cursor],
+                "query": to_unicode(cursor.query)  # query executed
+            }
+        finally:
+            cursor.close()
+
+    @errors.retryable
     def execute_return_detail(self, query, *parameters, **kwparameters):
         """return_detail"""
         cursor = self._cursor()
@@ -137,6 +253,35 @@ class Connection(object):
         finally:
             cursor.close()
 
+    def execute_batch(self, items):
+        """
+        join consecutive execute statements with semicolon and send them in one round trip,
+        psycopg2 returns the last result only,so query is executed alone
+        and rowcount of joined statements is -1.
+
+        Joined statements run in one implicit transaction,
+        when one failed,they will be executed one by one to isolate the error.
+        """
+        for joined, group in batch.group_items(items, lambda i: i.kind == "execute"):
+            if not joined or len(group) == 1:
+                batch.run_sequential(self, group)
+                continue
+
+            cursor = self._cursor()
+            try:
+                statements = [to_unicode(cursor.mogrify(i.sql, i.kwparameters or i.parameters))
+                              for i in group]
+                cursor.execute(batch.join_statements(statements))
+                for index, item in enumerate(group):
+                    item["rowcount"] = -1
+                    item["query"] = statements[index]
+                group[-1]["rowcount"] = cursor.rowcount
+            except Exception:
+                batch.run_sequential(self, group)
+            finally:
+                cursor.close()
+
+    @errors.retryable
     def executemany_return_detail(self, query, parameters):
         """return_detail"""
         cursor = self._cursor()
@@ -150,15 +295,196 @@ class Connection(object):
             }
         except Exception as e:
             self._log_exception(e, query, parameters)
-            self.close()
+            kind = self.classify_error(e)
+            if kind == errors.CONNECTION_LOST:
+                self.close()
+            if kind == errors.TIMEOUT:
+                raise errors.QueryTimeoutError("Query cancelled by timeout:" + str(e)) from e
+            raise
+        finally:
+            cursor.close()
+
+    def copy_expert(self, query, file):
+        """execute COPY FROM STDIN or COPY TO STDOUT with file object"""
+        cursor = self._cursor()
+        try:
+            cursor.copy_expert(query, file)
+            return {
+                "lastrowid": 0,
+                "rowcount": cursor.rowcount,  # number of rows copied
+                "rownumber": 0,
+                "query": query
+            }
+        except Exception as e:
+            self._log_exception(e, query, ())
+            kind = self.classify_error(e)
+            if kind == errors.CONNECTION_LOST:
+                self.close()
+            if kind == errors.TIMEOUT:
+                raise errors.QueryTimeoutError("Query cancelled by timeout:" + str(e)) from e
             raise
         finally:
             cursor.close()
 
 
 class ChainDB(base.ChainDB):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.in_chunk_size = None  # array param has no length limit
+
     def connect(self, config_dict=None):
         self.db = Connection(**config_dict)
+        self._connect_config = config_dict  # used by clone
+
+    def import_rows(self, fields, rows):
+        """insert one chunk of import_csv by COPY"""
+        sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(self._table, ",".join(fields))
+        res = self.db.copy_expert(sql, csvio.to_csv_file(rows))
+        self._reset()
+        self.last_query = res["query"]
+        return res
+
+    def bulk_rows(self, fields, rows):
+        """insert one chunk of rows by COPY in text format"""
+        sql = "COPY {} ({}) FROM STDIN".format(self._table, ",".join(fields))
+        res = self.db.copy_expert(sql, csvio.to_tsv_file(rows))
+        self._reset()
+        self.last_query = res["query"]
+        return res
+
+    def build_select(self, fields="*"):
+        """add hints in comment for pg_hint_plan"""
+        hints = []
+        if self._hint:
+            if self._hint["index"]:
+                alias = self._table.split()[-1]  # hint refers to the alias if table has one
+                hints.append("IndexScan({} {})".format(alias, " ".join(self._hint["index"])))
+            if self._hint["optimizer"]:
+                hints.append(self._hint["optimizer"])
+        sql, condition_values = super().build_select(fields)
+        if hints:
+            sql = "/*+ {} */ ".format(" ".join(hints)) + sql
+        return sql, condition_values
+
+    def gen_table_hint(self):
+        return self._table_sample
+
+    def sample(self, size, seed=None):
+        """TABLESAMPLE SYSTEM for number of lines,BERNOULLI for fraction"""
+        return self.sample_by_table(size, seed)
+
+    def gen_table_sample(self, percent, seed=None, by_line=False):
+        repeatable = " REPEATABLE ({})".format(int(seed)) if seed is not None else ""
+        return " TABLESAMPLE {} ({}){}".format("BERNOULLI" if by_line else "SYSTEM", percent, repeatable)
+
+    def gen_row_estimate(self):
+        return "SELECT reltuples FROM pg_class WHERE oid = to_regclass(%s);"
+
+    def gen_random_order(self, seed=None):
+        """hash of ctid with seed is the same for the same seed"""
+        if seed is None:
+            return "random()"
+        return "md5(ctid::text || '{}')".format(int(seed))
+
+    def gen_in_condition(self, field, sign, values):
+        """
+        a = ANY(%s),pass list as one array param,
+        cast it by types in schema metadata
+        """
+        cast = ""
+        try:
+            data_type = self.get_schema()["types"].get(field.split(".")[-1])
+            if data_type and not data_type.startswith("_"):
+                cast = "::{}[]".format(data_type)
+        except Exception:
+            pass
+
+        if sign.lower() == "in":
+            return "{} = ANY({}{})".format(field, self.param_place_holder, cast), [list(values)]
+        else:
+            return "{} <> ALL({}{})".format(field, self.param_place_holder, cast), [list(values)]
+
+    def gen_schema_columns(self):
+        return "SELECT c.table_name, c.column_name, c.udt_name AS data_type, c.is_nullable, " \
+               "CASE WHEN pk.column_name IS NULL THEN 0 ELSE 1 END AS is_primary " \
+               "FROM information_schema.columns c LEFT JOIN (" \
+               "SELECT kcu.table_name, kcu.column_name FROM information_schema.table_constraints tc " \
+               "JOIN information_schema.key_column_usage kcu " \
+               "ON tc.constraint_name = kcu.constraint_name AND tc.table_schema = kcu.table_schema " \
+               "WHERE tc.constraint_type = 'PRIMARY KEY' AND tc.table_schema = current_schema()" \
+               ") pk ON pk.table_name = c.table_name AND pk.column_name = c.column_name " \
+               "WHERE c.table_schema = current_schema() " \
+               "ORDER BY c.table_name, c.ordinal_position;"
+
+    def gen_schema_indexes(self):
+        return "SELECT t.relname AS table_name, i.relname AS index_name, a.attname AS column_name, " \
+               "CASE WHEN ix.indisunique THEN 1 ELSE 0 END AS is_unique " \
+               "FROM pg_catalog.pg_index ix " \
+               "JOIN pg_catalog.pg_class t ON t.oid = ix.indrelid " \
+               "JOIN pg_catalog.pg_class i ON i.oid = ix.indexrelid " \
+               "JOIN pg_catalog.pg_namespace n ON n.oid = t.relnamespace " \
+               "JOIN LATERAL unnest(ix.indkey::int2[]) WITH ORDINALITY AS k(attnum, position) ON TRUE " \
+               "JOIN pg_catalog.pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum " \
+               "WHERE n.nspname = current_schema() " \
+               "ORDER BY t.relname, i.relname, k.position;"
+
+    def gen_update_many(self, dict_data, key, fields, condition):
+        """
+        join a VALUES list,cast values by types in schema metadata
+
+        UPDATE xxx SET a=v.c1 FROM (VALUES (1,'a')) AS v(c0,c1) WHERE xxx.id=v.c0
+        """
+        if any(len(i) != len(fields) + 1 for i in dict_data):  # fields missing in some lines
+            return super().gen_update_many(dict_data, key, fields, condition)
+
+        try:
+            types = self.get_schema()["types"]
+        except Exception:
+            types = {}
+
+        def column(index, field):
+            name = "saiorm_v.c{}".format(index)
+            return name + "::" + types[field] if types.get(field) else name
+
+        values_signs = []
+        values = []
+        for i in dict_data:
+            signs = []
+            for f in [key] + fields:
+                sign, sign_values = self.split_insert_value(i[f])
+                signs.append(sign)
+                values += sign_values
+            values_signs.append("(" + ",".join(signs) + ")")
+
+        sql = "UPDATE {} SET {} FROM (VALUES {}) AS saiorm_v({}) WHERE {}.{}={}".format(
+            self._table,
+            ",".join(["{}={}".format(f, column(index + 1, f)) for index, f in enumerate(fields)]),
+            ",".join(values_signs),
+            ",".join(["c{}".format(index) for index in range(len(fields) + 1)]),
+            self._table.split()[-1], key, column(0, key))  # refer to the alias if table has one
+        if condition:
+            sql += " AND (" + condition[len("WHERE"):] + ")"
+        return sql + ";", values
+
+    def gen_upsert(self, fields, values_signs, conflict_keys, update_sql):
+        if not conflict_keys:
+            raise ValueError("conflict_keys is required when table has no primary key")
+        if update_sql:
+            action = "DO UPDATE SET " + update_sql
+        else:
+            action = "DO NOTHING"
+        return "INSERT INTO {} ({}) VALUES {} ON CONFLICT ({}) {};".format(
+            self._table, ",".join(fields), ",".join(values_signs), ",".join(conflict_keys), action)
+
+    def gen_upsert_field(self, field):
+        return "{}=EXCLUDED.{}".format(field, field)
+
+    def gen_blob_read(self, field, condition):
+        return "SELECT SUBSTRING({} FROM %s FOR %s) FROM {} {} LIMIT 1;".format(field, self._table, condition)
+
+    def gen_blob_write(self, field, condition, text=False):
+        return ("UPDATE {} SET {}=%s {};".format(self._table, field, condition),
+                "UPDATE {} SET {}={} || %s {};".format(self._table, field, field, condition))
 
     def parse_condition(self):
         """
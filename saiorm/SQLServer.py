@@ -5,11 +5,11 @@ Support SQLServer
 
 bases on torndb
 """
+import contextlib
 import logging
+import math
 import time
 
-import pymssql
-
 try:
     from . import utility
 except ImportError:
@@ -20,18 +20,50 @@ try:
 except ImportError:
     import base
 
+try:
+    from . import batch
+except ImportError:
+    import batch
+
+try:
+    from . import errors
+except ImportError:
+    import errors
+
+try:
+    from . import forksafe
+except ImportError:
+    import forksafe
+
+try:
+    from . import columnar
+except ImportError:
+    import columnar
+
+try:
+    from . import guard
+except ImportError:
+    import guard
+
 Row = utility.Row
 GraceDict = utility.GraceDict
 is_array = utility.is_array
 to_unicode = utility.to_unicode
 
+pymssql = utility.LazyModule("pymssql")  # imported on first connection
+
 
 class Connection(object):
     def __init__(self, host, port, database, user=None, password=None,
-                 max_idle_time=7 * 3600, return_query=False):
+                 max_idle_time=7 * 3600, return_query=False, retry_policy=None, timeout=None,
+                 result_guard=None):
         self.host = host
         self.database = database
         self.max_idle_time = float(max_idle_time)
+        self.retry_policy = retry_policy or errors.RetryPolicy()
+        self.timeout = timeout  # default seconds of statement,by query timeout of pymssql
+        self.result_guard = result_guard  # bound the rows of query_return_detail
+        self._in_deadline = False
         self._return_query = return_query
 
         args = dict(
@@ -41,23 +73,26 @@ class Connection(object):
             password=password,
             database=database,
         )
+        if timeout:
+            args["timeout"] = int(math.ceil(timeout))
 
         self._db = None
         self._db_args = args
-        self._last_use_time = time.time()
-        try:
-            self.reconnect()
-        except Exception:
-            logging.error("Cannot connect to SQLServer on {}:{}".format(self.host, port),
-                          exc_info=True)
+        self._last_use_time = time.time()  # connect on the first statement
+        forksafe.register(self)
 
     def __del__(self):
         self.close()
 
     def close(self):
         """Closes this database connection."""
+        if forksafe.is_inherited(self):  # opened by parent process,never close it on the wire
+            forksafe.discard(self)
         if getattr(self, "_db", None) is not None:
-            self._db.close()
+            try:
+                self._db.close()
+            except Exception:
+                pass  # broken connection
             self._db = None
 
     def reconnect(self):
@@ -81,12 +116,27 @@ class Connection(object):
         finally:
             cursor.close()
 
+    def iter_batches(self, batch_size, query, *parameters, **kwparameters):
+        """
+        Returns an iterator of column names and list of row tuples,
+        fetched by batch_size.
+        """
+        cursor = self._cursor()
+        try:
+            self._execute(cursor, query, parameters, kwparameters)
+            for res in columnar.fetch_batches(cursor, batch_size):
+                yield res
+        finally:
+            cursor.close()
+
     def _ensure_connected(self):
         # Mysql by default closes client connections that are idle for
         # 8 hours, but the client library does not report this fact until
         # you try to perform a query and it fails.  Protect against this
         # case by preemptively closing and reopening the connection
         # if it has been idle for too long (7 hours by default).
+        if forksafe.is_inherited(self):  # opened by parent process,never close it on the wire
+            forksafe.discard(self)
         if (self._db is None or
                 (time.time() - self._last_use_time > self.max_idle_time)):
             self.reconnect()
@@ -99,31 +149,85 @@ class Connection(object):
     def _log_exception(self, exception, query, parameters):
         """log exception when execute SQL"""
         logging.error("Error on SQL Server:" + self.host)
-        logging.error("Error query:", query.replace("%s", "{}").format(*parameters))
+        logging.error("Error query:" + str(query))
+        logging.error("Error parameters:" + str(parameters))
         logging.error("Error Exception:" + str(exception))
 
+    def classify_error(self, exception):
+        """return kind of exception,see saiorm.errors"""
+        code = errors.error_code(exception)
+        if code == 1205:  # deadlock victim
+            return errors.DEADLOCK
+        if code == 20003 and (self.timeout or self._in_deadline):  # query timeout
+            return errors.TIMEOUT
+        if code in (20003, 20004, 20006, 20009, 20047):  # timeout,read/write failed,dead dbprocess
+            return errors.CONNECTION_LOST
+        if isinstance(exception, (pymssql.InterfaceError, ConnectionError)):
+            return errors.CONNECTION_LOST
+        return errors.STATEMENT
+
+    @contextlib.contextmanager
+    def deadline(self, seconds=None):
+        """
+        set query timeout of the statements in with block,QueryTimeoutError is raised.
+        Do nothing if seconds is empty.
+        """
+        if not seconds:
+            yield
+            return
+        self._ensure_connected()
+        conn = self._db._conn  # _mssql connection
+        query_timeout = conn.query_timeout
+        conn.query_timeout = int(math.ceil(seconds))
+        self._in_deadline = True
+        try:
+            yield
+        finally:
+            self._in_deadline = False
+            if self._db is not None and self._db._conn is conn:
+                conn.query_timeout = query_timeout
+
     def _execute(self, cursor, query, parameters, kwparameters):
         try:
             return cursor.execute(query, kwparameters or parameters)
         except Exception as e:
             self._log_exception(e, query, parameters)
-            self.close()
+            kind = self.classify_error(e)
+            if kind == errors.CONNECTION_LOST:
+                self.close()
+            if kind == errors.TIMEOUT:
+                raise errors.QueryTimeoutError("Query cancelled by timeout:" + str(e)) from e
             raise
 
+    @errors.retryable
     def query_return_detail(self, query, *parameters, **kwparameters):
         """return_detail"""
         cursor = self._cursor()
         try:
             self._execute(cursor, query, parameters, kwparameters)
-            column_names = [d[0] for d in cursor.description]
+            column_names, data = guard.collect(self.result_guard, cursor)
             return {
-                "data": [Row(zip(column_names, row)) for row in cursor.fetchall()],
+                "data": data,
                 "column_names": column_names,
                 "query": query.replace("%s", "{}").format(*parameters) if self._return_query else ""  # query executed
             }
         finally:
             cursor.close()
 
+    @errors.retryable
+    def query_column(self, query, *parameters, **kwparameters):
+        """return values of the first column only,without building Row"""
+        cursor = self._cursor()
+        try:
+            self._execute(cursor, query, parameters, kwparameters)
+            return {
+                "data": [row[0] for row in cursor],
+                "query": query.replace("%s", "{}").format(*parameters) if self._return_query else ""  # query executed
+            }
+        finally:
+            cursor.close()
+
+    @errors.retryable
     def execute_return_detail(self, query, *parameters, **kwparameters):
         """return_detail"""
         cursor = self._cursor()
@@ -138,6 +242,11 @@ class Connection(object):
         finally:
             cursor.close()
 
+    def execute_batch(self, items):
+        """pymssql can not return results of joined statements,execute them one by one"""
+        batch.run_sequential(self, items)
+
+    @errors.retryable
     def executemany_return_detail(self, query, parameters):
         """return_detail"""
         cursor = self._cursor()
@@ -151,7 +260,11 @@ class Connection(object):
             }
         except Exception as e:
             self._log_exception(e, query, parameters)
-            self.close()
+            kind = self.classify_error(e)
+            if kind == errors.CONNECTION_LOST:
+                self.close()
+            if kind == errors.TIMEOUT:
+                raise errors.QueryTimeoutError("Query cancelled by timeout:" + str(e)) from e
             raise
         finally:
             cursor.close()
@@ -159,15 +272,17 @@ class Connection(object):
 
 class ChainDB(base.ChainDB):
     def __init__(self, table_name_prefix="", debug=False, strict=True,
-                 cache_fields_name=True, grace_result=True, primary_key=""):
+                 cache_fields_name=True, grace_result=True, primary_key="", **kwargs):
         self._primary_key = primary_key  # For SQL Server
         self._return_query = None
         super().__init__(table_name_prefix=table_name_prefix, debug=debug, strict=strict,
-                         cache_fields_name=cache_fields_name, grace_result=grace_result)
+                         cache_fields_name=cache_fields_name, grace_result=grace_result, **kwargs)
+        self.max_params = 2100
 
     def connect(self, config_dict=None, return_query=False):
         config_dict["return_query"] = return_query
         self.db = Connection(**config_dict)
+        self._connect_config = config_dict  # used by clone
 
     def table(self, table_name="", primary_key=""):
         """
@@ -177,10 +292,11 @@ class ChainDB(base.ChainDB):
         super().table(table_name=table_name)
         return self
 
-    def select(self, fields="*"):
+    def build_select(self, fields="*"):
         """
-        fields is fields or native sql function,
-        ,use DB().select("=now()") will run SELECT now()
+        generate SELECT SQL by conditions without executing it,implement LIMIT with TOP
+
+        :return: tuple,SQL and values
         """
         condition_values = []
         pre_sql = ""
@@ -202,7 +318,7 @@ class ChainDB(base.ChainDB):
                 # SELECT * FROM xxx ORDER BY id OFFSET 5 ROWS FETCH NEXT 5 ROWS ONLY
 
                 if "," not in _limit:
-                    pre_sql = "SELECT TOP {} {} FROM {} ".format(_limit, fields, self._table)
+                    pre_sql = "SELECT TOP {} {} FROM {}{} ".format(_limit, fields, self._table, self.gen_table_hint())
                 else:
                     m, n = _limit.split(",")
                     if self._where:
@@ -220,13 +336,14 @@ class ChainDB(base.ChainDB):
                             "n": n,
                             "fields": fields,
                             "table": self._table,
+                            "hint": self.gen_table_hint(),
                             "pk": self._primary_key
                         }
-                        pre_sql = "SELECT TOP ({n}-{m}+1) {fields} FROM {table} " \
+                        pre_sql = "SELECT TOP ({n}-{m}+1) {fields} FROM {table}{hint} " \
                                   "WHERE {pk} NOT IN (SELECT TOP {m}-1 {pk} FROM {table})".format(**param)
                 self._limit = None  # clean self._limit
             else:
-                pre_sql = "SELECT {} FROM {} ".format(fields, self._table)
+                pre_sql = "SELECT {} FROM {}{} ".format(fields, self._table, self.gen_table_hint())
 
             condition_sql, condition_values = self.parse_condition()
 
@@ -237,14 +354,86 @@ class ChainDB(base.ChainDB):
                     condition_sql = pre_where + " AND " + condition_sql
 
             sql = pre_sql + condition_sql
-
-        res = self.query(sql, *condition_values)
-        self.last_query = res["query"]
-        if self.grace_result:
-            res["data"] = [GraceDict(i) for i in res["data"]]
-
-        return res["data"]
+            if self._hint and self._hint["optimizer"]:
+                sql += " OPTION ({})".format(self._hint["optimizer"])
+
+        return sql, condition_values
+
+    def gen_exists(self, condition):
+        return "SELECT TOP 1 1 FROM {}{} {};".format(self._table, self.gen_table_hint(), condition)
+
+    def gen_table_hint(self):
+        """TABLESAMPLE and WITH (INDEX(...), NOLOCK)"""
+        if not self._hint:
+            return self._table_sample
+        hints = []
+        if self._hint["index"]:
+            hints.append("INDEX({})".format(",".join(self._hint["index"])))
+        if self._hint["nolock"]:
+            hints.append("NOLOCK")
+        return self._table_sample + (" WITH ({})".format(", ".join(hints)) if hints else "")
+
+    def sample(self, size, seed=None):
+        """TABLESAMPLE of pages,for both number of lines and fraction"""
+        return self.sample_by_table(size, seed)
+
+    def gen_table_sample(self, percent, seed=None, by_line=False):
+        """SQL Server samples pages only,by_line is ignored"""
+        repeatable = " REPEATABLE ({})".format(int(seed)) if seed is not None else ""
+        return " TABLESAMPLE ({} PERCENT){}".format(percent, repeatable)
+
+    def gen_row_estimate(self):
+        return "SELECT SUM(row_count) FROM sys.dm_db_partition_stats " \
+               "WHERE object_id = OBJECT_ID(%s) AND index_id IN (0, 1);"
+
+    def gen_random_order(self, seed=None):
+        return "NEWID()"
+
+    def gen_upsert(self, fields, values_signs, conflict_keys, update_sql):
+        """MERGE statement must be terminated by a semicolon"""
+        if not conflict_keys:
+            raise ValueError("conflict_keys is required when table has no primary key")
+        on = " AND ".join(["target.{}=source.{}".format(k, k) for k in conflict_keys])
+        sql = "MERGE INTO {} AS target USING (VALUES {}) AS source ({}) ON ({})".format(
+            self._table, ",".join(values_signs), ",".join(fields), on)
+        if update_sql:
+            sql += " WHEN MATCHED THEN UPDATE SET " + update_sql
+        sql += " WHEN NOT MATCHED THEN INSERT ({}) VALUES ({});".format(
+            ",".join(fields), ",".join(["source." + f for f in fields]))
+        return sql
+
+    def gen_upsert_field(self, field):
+        return "target.{}=source.{}".format(field, field)
 
     def gen_get_fields_name(self):
         """get one line from table"""
         return "SELECT TOP 1 * FROM {};".format(self._table)
+
+    def gen_blob_read(self, field, condition):
+        return "SELECT TOP 1 SUBSTRING({}, %s, %s) FROM {} {};".format(field, self._table, condition)
+
+    def gen_blob_write(self, field, condition, text=False):
+        """.WRITE appends to varbinary(max) and nvarchar(max) in place"""
+        return ("UPDATE {} SET {}=%s {};".format(self._table, field, condition),
+                "UPDATE {} SET {}.WRITE(%s, NULL, 0) {};".format(self._table, field, condition))
+
+    def gen_schema_columns(self):
+        return "SELECT c.TABLE_NAME AS table_name, c.COLUMN_NAME AS column_name, " \
+               "c.DATA_TYPE AS data_type, c.IS_NULLABLE AS is_nullable, " \
+               "CASE WHEN pk.COLUMN_NAME IS NULL THEN 0 ELSE 1 END AS is_primary " \
+               "FROM INFORMATION_SCHEMA.COLUMNS c LEFT JOIN (" \
+               "SELECT kcu.TABLE_NAME, kcu.COLUMN_NAME FROM INFORMATION_SCHEMA.TABLE_CONSTRAINTS tc " \
+               "JOIN INFORMATION_SCHEMA.KEY_COLUMN_USAGE kcu " \
+               "ON tc.CONSTRAINT_NAME = kcu.CONSTRAINT_NAME AND tc.TABLE_SCHEMA = kcu.TABLE_SCHEMA " \
+               "WHERE tc.CONSTRAINT_TYPE = 'PRIMARY KEY'" \
+               ") pk ON pk.TABLE_NAME = c.TABLE_NAME AND pk.COLUMN_NAME = c.COLUMN_NAME " \
+               "ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION;"
+
+    def gen_schema_indexes(self):
+        return "SELECT t.name AS table_name, i.name AS index_name, c.name AS column_name, " \
+               "CAST(i.is_unique AS int) AS is_unique " \
+               "FROM sys.indexes i JOIN sys.tables t ON t.object_id = i.object_id " \
+               "JOIN sys.index_columns ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id " \
+               "JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id " \
+               "WHERE i.name IS NOT NULL AND ic.is_included_column = 0 " \
+               "ORDER BY t.name, i.name, ic.key_ordinal;"
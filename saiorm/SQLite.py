@@ -5,7 +5,11 @@ Support PostgreSQL
 
 bases on torndb
 """
+import contextlib
+import io
+import itertools
 import logging
+import os
 import time
 
 import sqlite3
@@ -20,38 +24,68 @@ try:
 except ImportError:
     import base
 
+try:
+    from . import errors
+except ImportError:
+    import errors
+
+try:
+    from . import forksafe
+except ImportError:
+    import forksafe
+
+try:
+    from . import columnar
+except ImportError:
+    import columnar
+
+try:
+    from . import guard
+except ImportError:
+    import guard
+
+try:
+    from . import blob
+except ImportError:
+    import blob
+
 Row = utility.Row
 GraceDict = utility.GraceDict
 is_array = utility.is_array
 to_unicode = utility.to_unicode
 
+_memory_ids = itertools.count(1)  # in-memory databases in schema cache
+
 
 class Connection(object):
-    def __init__(self, host, return_query=False):
+    def __init__(self, host, return_query=False, retry_policy=None, timeout=None, result_guard=None):
         self.host = host
         self._return_query = return_query
+        self.retry_policy = retry_policy or errors.RetryPolicy()
+        self.timeout = timeout  # default seconds of statement,by progress handler
+        self.result_guard = result_guard  # bound the rows of query_return_detail
 
         self._db = None
-        self._last_use_time = time.time()
-        try:
-            self.reconnect()
-        except Exception:
-            logging.error("Cannot connect to SQLite on {}".format(self.host),
-                          exc_info=True)
+        self._last_use_time = time.time()  # connect on the first statement
+        forksafe.register(self)
 
     def __del__(self):
         self.close()
 
     def close(self):
         """Closes this database connection."""
+        if forksafe.is_inherited(self):  # opened by parent process,never close it on the wire
+            forksafe.discard(self)
         if getattr(self, "_db", None) is not None:
-            self._db.close()
+            try:
+                self._db.close()
+            except Exception:
+                pass  # broken connection
             self._db = None
 
     def reconnect(self):
         """Closes the existing database connection and re-opens it."""
         self.close()
-
         self._db = sqlite3.connect(self.host)
 
     def iter(self, query, *parameters, **kwparameters):
@@ -67,6 +101,19 @@ class Connection(object):
         finally:
             cursor.close()
 
+    def iter_batches(self, batch_size, query, *parameters, **kwparameters):
+        """
+        Returns an iterator of column names and list of row tuples,
+        fetched by batch_size.
+        """
+        cursor = self._cursor()
+        try:
+            self._execute(cursor, query, parameters, kwparameters)
+            for res in columnar.fetch_batches(cursor, batch_size):
+                yield res
+        finally:
+            cursor.close()
+
     #
     # def _ensure_connected(self):
     #     # Mysql by default closes client connections that are idle for
@@ -79,15 +126,54 @@ class Connection(object):
     #         self.reconnect()
     #     self._last_use_time = time.time()
 
+    def _ensure_connected(self):
+        if forksafe.is_inherited(self):  # opened by parent process,never close it on the wire
+            forksafe.discard(self)
+        if self._db is None:
+            self.reconnect()
+        self._last_use_time = time.time()
+
     def _cursor(self):
+        self._ensure_connected()
         return self._db.cursor()
 
     def _log_exception(self, exception, query, parameters):
         """log exception when execute SQL"""
         logging.error("Error on SQLite:" + self.host)
-        logging.error("Error query:", query.replace("%s", "{}").format(*parameters))
+        logging.error("Error query:" + str(query))
+        logging.error("Error parameters:" + str(parameters))
         logging.error("Error Exception:" + str(exception))
 
+    def classify_error(self, exception):
+        """return kind of exception,see saiorm.errors"""
+        message = str(exception).lower()
+        if isinstance(exception, sqlite3.OperationalError) and "interrupted" in message:
+            return errors.TIMEOUT
+        if isinstance(exception, sqlite3.OperationalError) and ("locked" in message or "busy" in message):
+            return errors.DEADLOCK
+        if isinstance(exception, sqlite3.ProgrammingError) and "closed" in message:
+            return errors.CONNECTION_LOST
+        return errors.STATEMENT
+
+    @contextlib.contextmanager
+    def deadline(self, seconds=None):
+        """
+        interrupt the statements in with block by progress handler after seconds,
+        QueryTimeoutError is raised. Use self.timeout if seconds is empty.
+        """
+        seconds = seconds or self.timeout
+        if not seconds:
+            yield
+            return
+        self._ensure_connected()
+        db = self._db
+        end = time.monotonic() + seconds
+        db.set_progress_handler(lambda: time.monotonic() > end, 1000)
+        try:
+            yield
+        finally:
+            db.set_progress_handler(None, 1000)
+
     def _execute(self, cursor, query, parameters, kwparameters):
         try:
             res = cursor.execute(query, kwparameters or parameters)
@@ -95,17 +181,22 @@ class Connection(object):
             return res
         except Exception as e:
             self._log_exception(e, query, parameters)
-            self.close()
+            kind = self.classify_error(e)
+            if kind == errors.CONNECTION_LOST:
+                self.close()
+            if kind == errors.TIMEOUT:
+                raise errors.QueryTimeoutError("Query cancelled by timeout:" + str(e)) from e
             raise
 
+    @errors.retryable
     def query_return_detail(self, query, *parameters, **kwparameters):
         """return_detail"""
         cursor = self._cursor()
         try:
             self._execute(cursor, query, parameters, kwparameters)
-            column_names = [d[0] for d in cursor.description]
+            column_names, data = guard.collect(self.result_guard, cursor)
             return {
-                "data": [Row(zip(column_names, row)) for row in cursor.fetchall()],
+                "data": data,
                 "column_names": column_names,
                 "query": query.replace("?", "{}").format(*parameters) if self._return_query else ""  # query executed
             }
@@ -113,6 +204,21 @@ class Connection(object):
             # cursor.close()
             pass
 
+    @errors.retryable
+    def query_column(self, query, *parameters, **kwparameters):
+        """return values of the first column only,without building Row"""
+        cursor = self._cursor()
+        try:
+            self._execute(cursor, query, parameters, kwparameters)
+            return {
+                "data": [row[0] for row in cursor],
+                "query": query.replace("?", "{}").format(*parameters) if self._return_query else ""  # query executed
+            }
+        finally:
+            # cursor.close()
+            pass
+
+    @errors.retryable
     def execute_return_detail(self, query, *parameters, **kwparameters):
         """return_detail"""
         cursor = self._cursor()
@@ -128,6 +234,32 @@ class Connection(object):
             # cursor.close()
             pass
 
+    def execute_batch(self, items):
+        """execute statements in one transaction,every statement in a savepoint to isolate errors"""
+        cursor = self._cursor()
+        cursor.execute("SAVEPOINT saiorm_batch")
+        for item in items:
+            cursor.execute("SAVEPOINT saiorm_item")
+            try:
+                if item.kind == "executemany":
+                    cursor.executemany(item.sql, item.parameters)
+                else:
+                    cursor.execute(item.sql, item.kwparameters or item.parameters)
+                if cursor.description:
+                    column_names = [d[0] for d in cursor.description]
+                    item["data"] = [Row(zip(column_names, row)) for row in cursor.fetchall()]
+                    item["column_names"] = column_names
+                item["lastrowid"] = cursor.lastrowid
+                item["rowcount"] = cursor.rowcount
+                if self._return_query and item.kind != "executemany":
+                    item["query"] = item.sql.replace("?", "{}").format(*item.parameters)
+            except Exception as e:
+                item["error"] = e
+                cursor.execute("ROLLBACK TO saiorm_item")
+            cursor.execute("RELEASE saiorm_item")
+        cursor.execute("RELEASE saiorm_batch")
+
+    @errors.retryable
     def executemany_return_detail(self, query, parameters):
         """return_detail"""
         cursor = self._cursor()
@@ -137,11 +269,16 @@ class Connection(object):
                 "lastrowid": cursor.lastrowid,  # the primary key id affected
                 "rowcount": cursor.rowcount,  # number of rows affected
                 "rownumber": 0,  # line number
-                "query": query.replace("?", "{}").format(*parameters) if self._return_query else ""  # query executed
+                # query of the first line
+                "query": query.replace("?", "{}").format(*parameters[0]) if self._return_query and parameters else ""
             }
         except Exception as e:
             self._log_exception(e, query, parameters)
-            self.close()
+            kind = self.classify_error(e)
+            if kind == errors.CONNECTION_LOST:
+                self.close()
+            if kind == errors.TIMEOUT:
+                raise errors.QueryTimeoutError("Query cancelled by timeout:" + str(e)) from e
             raise
         finally:
             # cursor.close()
@@ -152,7 +289,123 @@ class ChainDB(base.ChainDB):
     def connect(self, config_dict=None, return_query=False):
         config_dict["return_query"] = return_query
         self.db = Connection(**config_dict)
+        self._connect_config = config_dict  # used by clone
         self.param_place_holder = "?"
+        self.max_params = 999  # SQLITE_MAX_VARIABLE_NUMBER of old versions
+        self.in_chunk_size = 500
+
+    def get_schema_key(self):
+        """file of database,every in-memory database is a different one"""
+        if self.db.host in ("", ":memory:"):
+            if not getattr(self.db, "memory_id", None):
+                self.db.memory_id = next(_memory_ids)
+            return "{}://memory/{}".format(self.__class__.__module__, self.db.memory_id)
+        return "{}://{}".format(self.__class__.__module__, os.path.abspath(self.db.host))
+
+    def warmup(self):
+        """SQLite connection is cheap to open,connect on the first statement"""
+        return self
+
+    def gen_table_hint(self):
+        """INDEXED BY,SQLite accepts one index only"""
+        if not self._hint:
+            return ""
+        if self._hint["optimizer"]:
+            logging.warning("Saiorm does not support optimizer hint in SQLite")
+        if not self._hint["index"]:
+            return ""
+        return " INDEXED BY " + self._hint["index"][0]
+
+    def gen_schema_columns(self):
+        return "SELECT m.name AS table_name, p.name AS column_name, p.type AS data_type, " \
+               "CASE WHEN p.\"notnull\" = 0 THEN 'YES' ELSE 'NO' END AS is_nullable, " \
+               "p.pk > 0 AS is_primary " \
+               "FROM sqlite_master m JOIN pragma_table_info(m.name) p " \
+               "WHERE m.type = 'table' ORDER BY m.name, p.cid;"
+
+    def gen_schema_indexes(self):
+        return "SELECT m.name AS table_name, il.name AS index_name, ii.name AS column_name, " \
+               "il.\"unique\" AS is_unique " \
+               "FROM sqlite_master m JOIN pragma_index_list(m.name) il " \
+               "JOIN pragma_index_info(il.name) ii " \
+               "WHERE m.type = 'table' ORDER BY m.name, il.name, ii.seqno;"
+
+    def gen_upsert(self, fields, values_signs, conflict_keys, update_sql):
+        if not conflict_keys:
+            raise ValueError("conflict_keys is required when table has no primary key")
+        if update_sql:
+            action = "DO UPDATE SET " + update_sql
+        else:
+            action = "DO NOTHING"
+        return "INSERT INTO {} ({}) VALUES {} ON CONFLICT ({}) {};".format(
+            self._table, ",".join(fields), ",".join(values_signs), ",".join(conflict_keys), action)
+
+    def gen_upsert_field(self, field):
+        return "{}=EXCLUDED.{}".format(field, field)
+
+    def open_blob(self, field, chunk_size=blob.CHUNK_SIZE):
+        """read by incremental BLOB I/O of sqlite3 blobopen,SUBSTR if it's not available"""
+        self.db._ensure_connected()
+        if not hasattr(self.db._db, "blobopen"):
+            return super().open_blob(field, chunk_size)
+        condition_sql, condition_values = self.parse_where_condition()
+        sql = "SELECT rowid AS row_id, typeof({}) AS value_type FROM {} {} LIMIT 1;".format(
+            field, self._table, condition_sql)
+        table_name = self._table.split()[0]  # blobopen does not accept alias
+        self._reset()
+        self.last_query = sql
+        res = self.db.query_return_detail(sql, *condition_values)
+        if not res["data"] or res["data"][0]["value_type"] == "null":
+            return blob.BlobReader(lambda offset, size: None, chunk_size)
+        rowid = res["data"][0]["row_id"]
+        db = self.db
+
+        def read_chunk(offset, size):
+            with db._db.blobopen(table_name, field, rowid, readonly=True) as f:
+                f.seek(offset)
+                return f.read(size)
+
+        return blob.BlobReader(read_chunk, chunk_size)
+
+    def gen_blob_read(self, field, condition):
+        return "SELECT SUBSTR({}, ?, ?) FROM {} {} LIMIT 1;".format(field, self._table, condition)
+
+    def write_blob(self, field, data, chunk_size=blob.CHUNK_SIZE):
+        """
+        allocate the value by zeroblob and write by incremental BLOB I/O of sqlite3 blobopen,
+        data must be bytes or seekable binary file,appending chunks if not
+        """
+        self.db._ensure_connected()
+        size = None if isinstance(data, str) else blob.data_size(data)  # str is written as TEXT
+        if size is None or not hasattr(self.db._db, "blobopen"):
+            return super().write_blob(field, data, chunk_size)
+
+        condition_sql, condition_values = self.parse_where_condition()
+        table = self._table
+        table_name = table.split()[0]  # blobopen does not accept alias
+        self._reset()
+        # select the lines before resizing,the conditions could refer to the value itself
+        rowids = self.db.query_column("SELECT rowid FROM {} {};".format(table, condition_sql),
+                                      *condition_values)["data"]
+        res = self.db.executemany_return_detail(
+            "UPDATE {} SET {}=zeroblob(?) WHERE rowid=?;".format(table_name, field),
+            [(size, i) for i in rowids])
+        blobs = [self.db._db.blobopen(table_name, field, i) for i in rowids]
+        try:
+            for chunk in blob.iter_chunks(data, chunk_size):
+                for i in blobs:
+                    i.write(chunk)
+        finally:
+            for i in blobs:
+                i.close()
+        self.last_query = res["query"]
+        return res
+
+    def gen_blob_write(self, field, condition, text=False):
+        """|| of SQLite returns text,cast it back for BLOB"""
+        append = "{} || ?" if text else "CAST({} || ? AS BLOB)"
+        return ("UPDATE {} SET {}=? {};".format(self._table, field, condition),
+                "UPDATE {} SET {}={} {};".format(self._table, field, append.format(field), condition))
 
     def parse_condition(self):
         """
@@ -24,3 +24,17 @@ def init(driver="MySQL", **kwargs):
         return ChainDB(**kwargs)
     else:
         raise ValueError("Init saiorm with wrong database driver type")
+
+
+def warmup(*dbs):
+    """
+    open connections of many ChainDB in parallel,
+    raise the first error after all of them finished
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if not dbs:
+        return
+    with ThreadPoolExecutor(max_workers=len(dbs)) as executor:
+        futures = [executor.submit(db.warmup) for db in dbs]
+    for future in futures:
+        future.result()
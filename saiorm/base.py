@@ -1,17 +1,79 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 
+import copy
+import csv
+import itertools
 import logging
+import math
+import random
+import threading
 
 try:
     from . import utility
 except ImportError:
     import utility
 
+try:
+    from . import schema
+except ImportError:
+    import schema
+
+try:
+    from . import batch
+except ImportError:
+    import batch
+
+try:
+    from . import singleflight
+except ImportError:
+    import singleflight
+
+try:
+    from . import columnar
+except ImportError:
+    import columnar
+
+try:
+    from . import csvio
+except ImportError:
+    import csvio
+
+try:
+    from . import scan
+except ImportError:
+    import scan
+
+try:
+    from . import guard
+except ImportError:
+    import guard
+
+try:
+    from . import blob
+except ImportError:
+    import blob
+
+try:
+    from . import deferred
+except ImportError:
+    import deferred
+
+Row = utility.Row
 GraceDict = utility.GraceDict
 is_array = utility.is_array
 
 
+def combine_not_none(func):
+    """combine results of chunks by func,ignore None of the chunks without lines"""
+
+    def combine(results):
+        results = [i for i in results if i is not None]
+        return func(results) if results else None
+
+    return combine
+
+
 class BaseDB(object):
     """
     Implement database chain  operation.
@@ -22,11 +84,15 @@ class BaseDB(object):
 
     If use SQL Server, param primary_key is necessary,used in the LIMIT implement tec.
 
+    If single_flight is True,concurrent identical queries in the process wait on the first one
+    and share copies of its result,see saiorm.singleflight.
+
     """
 
     def __init__(self, table_name_prefix="", debug=False, strict=True,
-                 cache_fields_name=True, grace_result=True):
+                 cache_fields_name=True, grace_result=True, single_flight=False):
         self.db = None
+        self._connect_config = None  # config of connect
         self.table_name_prefix = table_name_prefix
         self.debug = debug
         self.strict = strict
@@ -34,7 +100,13 @@ class BaseDB(object):
         self.cache_fields_name = cache_fields_name  # when call get_fields_name
         self._cached_fields_name = {}  # cached fields name
         self.grace_result = grace_result
+        self.single_flight = single_flight
         self.param_place_holder = "%s"  # SQLite will use ?
+        self.max_params = 65535  # max number of params in one statement
+        self.in_chunk_size = 1000  # split select with longer IN list to many queries
+        self.insert_many_in_one_statement = False  # lastrowid of insert_many is id of the first line
+        self._batch = None  # collecting statements when in batch
+        self._deferred = {}  # table name and deferred columns
 
         self._table = ""
         self._where = ""
@@ -45,6 +117,9 @@ class BaseDB(object):
         self._left_join = ""
         self._right_join = ""
         self._on = ""
+        self._timeout = None  # seconds,cancel the statement after it
+        self._hint = None  # index and optimizer hints of SELECT
+        self._table_sample = ""  # TABLESAMPLE clause of SELECT
 
     def _reset(self):
         """reset param when call again"""
@@ -57,8 +132,21 @@ class BaseDB(object):
         self._left_join = ""
         self._right_join = ""
         self._on = ""
+        self._timeout = None
+        self._hint = None
+        self._table_sample = ""
         self.last_query = ""  # latest executed sql
 
+    def _save_condition(self):
+        """return all condition params,restore them by _restore_condition"""
+        return {k: getattr(self, k) for k in ("_table", "_where", "_order_by", "_group_by", "_limit",
+                                               "_inner_join", "_left_join", "_right_join", "_on", "_timeout",
+                                               "_hint", "_table_sample")}
+
+    def _restore_condition(self, condition):
+        for k, v in condition.items():
+            setattr(self, k, v)
+
     def connect(self, config_dict=None):
         """
         set a connected torndb.Connection
@@ -67,24 +155,87 @@ class BaseDB(object):
         """
         raise NotImplementedError("You must implement it in subclass")
 
+    def warmup(self):
+        """
+        open the connection now,connection is opened on the first statement by default.
+        Use saiorm.warmup to open many connections in parallel.
+        """
+        self.db._ensure_connected()
+        return self
+
+    def clone(self):
+        """return a copy with its own connection and the same conditions,for using in another thread"""
+        db = copy.copy(self)
+        db.db = self.db.__class__(**self._connect_config)
+        db._batch = None
+        return db
+
     def execute(self, *args, **kwargs):
         """execute SQL"""
-        res = self.db.execute_return_detail(*args, **kwargs)
-        self._reset()  # reset param
-        return res
+        try:
+            self.check_params_count(args[1:])
+            if self._batch is not None:
+                return self._batch.add("execute", args[0], args[1:], kwargs)
+            with self.db.deadline(self._timeout):
+                return self.db.execute_return_detail(*args, **kwargs)
+        finally:
+            self._reset()  # reset param
 
     def executemany(self, *args, **kwargs):
         """execute SQL with many lines"""
-        res = self.db.executemany_return_detail(*args, **kwargs)
-        self._reset()  # reset param
-        return res
+        try:
+            if self._batch is not None:
+                return self._batch.add("executemany", args[0], args[1])
+            with self.db.deadline(self._timeout):
+                return self.db.executemany_return_detail(*args, **kwargs)
+        finally:
+            self._reset()  # reset param
 
     def query(self, *args, **kwargs):
         """query SQL"""
-        res = self.db.query_return_detail(*args, **kwargs)
-        self._reset()  # reset param
+        try:
+            self.check_params_count(args[1:])
+            if self._batch is not None:
+                return self._batch.add("query", args[0], args[1:], kwargs)
+            with self.db.deadline(self._timeout):
+                if self.single_flight:
+                    return self.query_single_flight(*args, **kwargs)
+                return self.db.query_return_detail(*args, **kwargs)
+        finally:
+            self._reset()  # reset param
+
+    def check_params_count(self, parameters):
+        """raise ValueError before sending a statement with more params than the database accepts"""
+        if len(parameters) > self.max_params:
+            raise ValueError("{} params exceed max_params {},split the IN list or the lines".format(
+                len(parameters), self.max_params))
+
+    def query_single_flight(self, *args, **kwargs):
+        """
+        query SQL,share result with the concurrent identical queries of the same database,
+        every caller gets its own copy of the rows
+        """
+        key = repr((self.get_schema_key(), args, sorted(kwargs.items())))
+        res, shared = singleflight.group.do(key, lambda: self.db.query_return_detail(*args, **kwargs))
         return res
 
+    def batch(self):
+        """
+        collect statements without executing them,
+        then send them in as few round trips as the driver allows::
+
+            with DB.batch():
+                a = DB.table("a").select()
+                b = DB.table("b").get()
+            a.result()
+
+        In batch,select,get,count,exists,sum/avg/min/max,pluck and the writes
+        (insert,update,upsert,delete,increase etc.) return saiorm.batch.BatchItem,
+        call result() to get the data after the with block.
+        Other methods like sample,open_blob,iter_batches and export_csv are executed immediately.
+        """
+        return batch.Batch(self)
+
     def table(self, table_name="", *args):
         """
         If table_name is empty,use DB().select("now()") will run SELECT now()
@@ -112,6 +263,43 @@ class BaseDB(object):
         self._group_by = condition
         return self
 
+    def timeout(self, seconds):
+        """
+        cancel the next statement if it runs longer than seconds,saiorm.errors.QueryTimeoutError is raised.
+        Pass timeout to connect to set the default of all statements.
+        """
+        self._timeout = seconds
+        return self
+
+    def hint(self, index=None, force=False, optimizer=None, nolock=False):
+        """
+        hint the plan of the next SELECT,rendered by the backend:
+
+        - MySQL: USE INDEX or FORCE INDEX,optimizer hints in /*+ */
+        - PostgreSQL: IndexScan and optimizer hints in /*+ */ for pg_hint_plan
+        - SQL Server: WITH (INDEX(...), NOLOCK),optimizer hints in OPTION (...)
+        - SQLite: INDEXED BY the first index
+        - MongoDB: cursor.hint by the first index
+
+        exists takes the hints after the table name only,like INDEX of MySQL,SQLite and SQL Server,
+        and the index hint of MongoDB.
+        :param index: str or list,index names
+        :param force: bool,FORCE INDEX instead of USE INDEX in MySQL
+        :param optimizer: str,optimizer hints as they are,like "NO_ICP(t)" in MySQL or "RECOMPILE" in SQL Server
+        :param nolock: bool,read uncommitted by WITH (NOLOCK) in SQL Server
+        """
+        self._hint = {
+            "index": [index] if isinstance(index, str) else list(index or []),
+            "force": force,
+            "optimizer": optimizer,
+            "nolock": nolock
+        }
+        return self
+
+    def gen_table_hint(self):
+        """hints after the table name of SELECT,empty str if no hint"""
+        return ""
+
     def join(self, condition):
         if self.table_name_prefix and "###" in condition:
             condition = condition.replace("###", self.table_name_prefix)
@@ -142,19 +330,204 @@ class BaseDB(object):
         fields is fields or native sql function,
         ,use DB().select("=now()") will run SELECT now()
         """
+        chunks = self.split_in_condition()
+        if chunks:
+            return self.run_in_chunks(chunks, lambda: self.select(fields),
+                                      lambda results: list(itertools.chain(*results)))
+
+        loader = None
+        if fields == "*" and self._batch is None:
+            fields, loader = self._defer_fields()
+        sql, condition_values = self.build_select(fields)
+        res = self.query(sql, *condition_values)
+        if self._batch is not None:  # data will be filled after the batch executed
+            return res
+        self.last_query = res["query"]
+        if loader is not None:
+            data = deferred.lazy_rows(res["data"], loader, self.grace_result)
+            if isinstance(res["data"], guard.GuardedList):
+                data = guard.GuardedList(data)
+                data.truncated = res["data"].truncated
+            res["data"] = data
+        elif self.grace_result:
+            res["data"] = guard.convert_rows(res["data"], GraceDict)  # spilled rows are converted on read
+
+        return res["data"]
+
+    def defer(self, table_name, fields=None):
+        """
+        configure deferred columns of table,select("*") selects the other columns
+        and loads them on the first access,see saiorm.deferred
+
+        :param fields: list,deferred columns,clear the configuration if empty
+        """
+        if fields:
+            self._deferred[table_name] = list(fields)
+        else:
+            self._deferred.pop(table_name, None)
+        return self
+
+    def _defer_fields(self):
+        """return fields to select instead of * and Loader of deferred columns,None if not deferred"""
+        deferred_fields = self._deferred.get(self._table)
+        if not deferred_fields or self._inner_join or self._left_join or self._right_join or self._group_by:
+            return "*", None
+        result_guard = getattr(self.db, "result_guard", None)
+        if result_guard is not None and result_guard.mode == "spill":  # spilled rows are built on read
+            return "*", None
+        primary_key = self.get_primary_key()
+        if len(primary_key) != 1:
+            logging.warning("Deferred columns need a primary key of one field:" + self._table)
+            return "*", None
+
+        primary_key = primary_key[0]
+        fields = [f for f in self.get_fields_name() if f not in deferred_fields]
+        if primary_key not in fields:
+            fields.insert(0, primary_key)
+        db = self.db
+        sql = "SELECT {} FROM {} WHERE ".format(",".join([primary_key] + deferred_fields), self._table)
+        target = copy.copy(self)  # IN condition is generated by the table of now,not of the time loaded
+        target._batch = None
+        chunk_size = self.in_chunk_size or None  # one statement if empty,like ANY of PostgreSQL
+
+        def fetch(keys):
+            rows = []
+            for i in range(0, len(keys), chunk_size or max(len(keys), 1)):
+                condition_sql, condition_values = target.gen_in_condition(
+                    primary_key, "IN", keys[i:i + chunk_size] if chunk_size else keys)
+                rows += db.query_return_detail(sql + condition_sql + ";", *condition_values)["data"]
+            return rows
+
+        return ",".join(fields), deferred.Loader(deferred_fields, primary_key, fetch)
+
+    def split_in_condition(self):
+        """
+        split where condition with an IN list longer than self.in_chunk_size to many conditions,
+        used by select,pluck,count,exists,sum,avg,min,max,update,delete,increase and decrease
+        to run one statement for every chunk and combine the results.
+        Duplicate values are removed,so a line is matched by one chunk only.
+
+        Only for IN in AND condition without order_by, limit and group_by,
+        other statements with too many params raise ValueError by check_params_count.
+
+        :return: list of where conditions,empty when no need to split
+        """
+        if not self.in_chunk_size or not isinstance(self._where, dict) or self._batch is not None:
+            return []
+        if self._order_by or self._limit or self._group_by:
+            return []
+
+        for k, v in self._where.items():
+            if (is_array(v) and len(v) == 2 and isinstance(v[0], str) and v[0].strip().lower() == "in"
+                    and is_array(v[1]) and len(v[1]) > self.in_chunk_size):
+                if any(is_array(i) and i and isinstance(i[0], str) and i[0].lower() == "or"
+                       for i in self._where.values()):
+                    return []
+
+                try:
+                    values = list(dict.fromkeys(v[1]))  # a value in two chunks would match twice
+                except TypeError:  # unhashable
+                    values = list(v[1])
+                chunks = []
+                for i in range(0, len(values), self.in_chunk_size):
+                    where = dict(self._where)
+                    where[k] = (v[0], values[i:i + self.in_chunk_size])
+                    chunks.append(where)
+                return chunks
+        return []
+
+    def run_in_chunks(self, chunks, run, combine):
+        """
+        run the statement for every where condition from split_in_condition
+
+        :param run: function,run the statement with self._where,it resets the conditions
+        :param combine: function,receive the list of results and return the final result
+        """
+        condition = self._save_condition()
+        results = []
+        try:
+            for where in chunks:
+                self._restore_condition(condition)
+                self._where = where
+                results.append(run())
+        finally:
+            self._reset()
+        return combine(results)
+
+    def run_writes_in_chunks(self, chunks, run):
+        """run a write statement by chunks,rowcount is the sum"""
+        results = self.run_in_chunks(chunks, run, list)
+        res = dict(results[-1])
+        res["rowcount"] = sum(i["rowcount"] for i in results)
+        self.last_query = res["query"]
+        return res
+
+    def chunk_by_params(self, lines, count, reserved=0):
+        """
+        split lines to chunks,params of every chunk are at most self.max_params,
+        a line with more params is a chunk by itself
+
+        :param count: function,number of params of a line
+        :param reserved: int,params of the statement besides the lines,like where condition
+        :return: list of line list
+        """
+        chunks = []
+        chunk = []
+        params = reserved
+        for line in lines:
+            number = count(line)
+            if chunk and params + number > self.max_params:
+                chunks.append(chunk)
+                chunk = []
+                params = reserved
+            chunk.append(line)
+            params += number
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def execute_chunks(self, statements):
+        """
+        execute statements of chunks with the same timeout,reset the conditions after the last one,
+        rowcount is the sum
+
+        :param statements: iterable of tuple,SQL and lists of values
+        """
+        condition = self._save_condition()
+        res = None
+        rowcount = 0
+        try:
+            for statement in statements:
+                self._restore_condition(condition)
+                res = self.execute(statement[0], *itertools.chain(*statement[1:]))
+                rowcount += res["rowcount"] if res["rowcount"] and res["rowcount"] > 0 else 0
+        finally:
+            self._reset()
+        res["rowcount"] = rowcount
+        self.last_query = res["query"]
+        return res
+
+    def gen_in_condition(self, field, sign, values):
+        """
+        generate IN / NOT IN condition with params
+
+        :return: tuple,SQL and values
+        """
+        raise NotImplementedError("You must implement it in subclass")
+
+    def build_select(self, fields="*"):
+        """
+        generate SELECT SQL by conditions without executing it
+
+        :return: tuple,SQL and values
+        """
         condition_values = []
         if fields.startswith("`"):  # native function
             sql = self.gen_select_without_fields(fields[1:])  # 用于直接执行 mysql 函数
         else:
             condition_sql, condition_values = self.parse_condition()
             sql = self.gen_select_with_fields(fields, condition_sql)
-
-        res = self.query(sql, *condition_values)
-        self.last_query = res["query"]
-        if self.grace_result:
-            res["data"] = [GraceDict(i) for i in res["data"]]
-
-        return res["data"]
+        return sql, condition_values
 
     def gen_select_with_fields(self, fields, condition):
         raise NotImplementedError("You must implement it in subclass")
@@ -166,11 +539,422 @@ class BaseDB(object):
         """will replace self._limit to 1"""
         self._limit = 1
         res = self.select(fields)
+        if self._batch is not None:
+            res.first = True
+            return res
         return res[0] if res else {}  # return dit type
 
+    def count(self, field="*"):
+        """number of lines with the conditions,ignore order_by and limit"""
+        chunks = self.split_in_condition() if not field.lower().startswith("distinct") else []
+        if chunks:
+            return self.run_in_chunks(chunks, lambda: self.count(field), sum)
+        return self.aggregate("COUNT({})".format(field), convert=lambda v: int(v or 0))
+
+    def exists(self):
+        """whether any line matches the conditions,ignore order_by and limit"""
+        chunks = self.split_in_condition()
+        if chunks:
+            return self.run_in_chunks(chunks, self.exists, any)
+        try:
+            self._order_by = ""
+            self._limit = ""
+            condition_sql, condition_values = self.parse_condition()
+            res = self.query(self.gen_exists(condition_sql), *condition_values)
+        finally:
+            self._reset()
+        return self.convert_result(res, bool)
+
+    def sum(self, field):
+        chunks = self.split_in_condition()
+        if chunks:
+            return self.run_in_chunks(chunks, lambda: self.sum(field), combine_not_none(sum))
+        return self.aggregate("SUM({})".format(field))
+
+    def avg(self, field):
+        """by SUM and COUNT of every chunk if the IN list is split,sum of sums divided by sum of counts"""
+        chunks = self.split_in_condition()
+        if chunks:
+            def run():
+                try:
+                    sql, condition_values = self.build_select("SUM({0}), COUNT({0})".format(field))
+                    res = self.query(sql, *condition_values)
+                finally:
+                    self._reset()
+                return self.convert_result(res, lambda rows: tuple(rows[0].values()))
+
+            def combine(results):
+                number = sum(i[1] or 0 for i in results)
+                return sum(i[0] for i in results if i[0] is not None) / number if number else None
+
+            return self.run_in_chunks(chunks, run, combine)
+        return self.aggregate("AVG({})".format(field))
+
+    def min(self, field):
+        chunks = self.split_in_condition()
+        if chunks:
+            return self.run_in_chunks(chunks, lambda: self.min(field), combine_not_none(min))
+        return self.aggregate("MIN({})".format(field))
+
+    def max(self, field):
+        chunks = self.split_in_condition()
+        if chunks:
+            return self.run_in_chunks(chunks, lambda: self.max(field), combine_not_none(max))
+        return self.aggregate("MAX({})".format(field))
+
+    def aggregate(self, function, convert=None):
+        """
+        return the scalar of aggregate function with the conditions,ignore order_by and limit
+
+        :param function: str,like COUNT(*),SUM(a)
+        :param convert: function to convert the scalar
+        """
+        try:
+            self._order_by = ""
+            self._limit = ""
+            sql, condition_values = self.build_select(function)
+            res = self.query(sql, *condition_values)
+        finally:
+            self._reset()
+
+        def scalar(rows):
+            value = next(iter(rows[0].values())) if rows else None
+            return convert(value) if convert else value
+
+        return self.convert_result(res, scalar)
+
+    def pluck(self, field):
+        """return list of values of one field with the conditions"""
+        chunks = self.split_in_condition()
+        if chunks:
+            return self.run_in_chunks(chunks, lambda: self.pluck(field),
+                                      lambda results: list(itertools.chain(*results)))
+        try:
+            sql, condition_values = self.build_select(field)
+            res = self.query(sql, *condition_values)
+        finally:
+            self._reset()
+        return self.convert_result(res, lambda rows: [next(iter(i.values())) for i in rows])
+
+    def convert_result(self, res, convert):
+        """
+        return convert(rows) of the result of self.query,
+        in batch return the BatchItem,result() of it returns the converted rows
+        """
+        if isinstance(res, batch.BatchItem):
+            res.convert = convert
+            return res
+        self.last_query = res["query"]
+        return convert(res["data"])
+
+    def sample(self, size, seed=None):
+        """
+        return random lines with the conditions without sorting the table,order_by and limit are ignored.
+        Probe random values of an integer primary key between its min and max,
+        fall back to ORDER BY a random value if the table has no such key or too few lines are found.
+
+        :param size: int,number of lines,or float between 0 and 1,fraction of lines
+        :param seed: int,the same lines for the same seed while the table is not changed
+        """
+        try:
+            self.check_sample_size(size)
+            rng = random.Random(seed)
+            condition_sql, condition_values = self.parse_where_condition()
+            with self.db.deadline(self._timeout):
+                if isinstance(size, float):
+                    res = self.db.query_column(self.gen_select_with_fields("COUNT(*)", condition_sql),
+                                               *condition_values)
+                    size = int(math.ceil(res["data"][0] * size))
+                data = self.sample_by_key(size, rng, condition_sql, condition_values)
+                if data is None:
+                    sql = self.gen_select_with_fields("*", "{} ORDER BY {} LIMIT {}".format(
+                        condition_sql, self.gen_random_order(seed), size))
+                    data = self.db.query_return_detail(sql, *condition_values)["data"]
+                    self.last_query = sql
+        finally:
+            last_query = self.last_query
+            self._reset()
+            self.last_query = last_query
+        if self.grace_result:
+            data = guard.convert_rows(data, GraceDict)
+        return data
+
+    def check_sample_size(self, size):
+        if isinstance(size, float):
+            if not 0 < size <= 1:
+                raise ValueError("Fraction of sample must be between 0 and 1")
+        elif size < 0:
+            raise ValueError("Size of sample must not be negative")
+
+    def sample_by_key(self, size, rng, condition_sql, condition_values):
+        """
+        select lines of random values of the primary key in a few rounds,
+        every line with the conditions has the same chance
+
+        :return: list of rows,None if the table has no integer primary key or too few lines are found
+        """
+        primary_key = self.get_primary_key()
+        if len(primary_key) != 1 or not schema.is_integer_type(self.get_schema()["types"].get(primary_key[0])):
+            return None
+        primary_key = primary_key[0]
+        res = self.db.query_return_detail(self.gen_select_with_fields(
+            "MIN({0}) AS low,MAX({0}) AS high".format(primary_key), condition_sql), *condition_values)
+        self.last_query = res["query"]
+        low, high = res["data"][0]["low"], res["data"][0]["high"]
+        if low is None or size == 0:
+            return []
+        span = high - low + 1
+        where = "WHERE ({}) AND ".format(condition_sql[len("WHERE"):]) if condition_sql else "WHERE "
+
+        chunk_size = self.in_chunk_size or None  # one statement if empty,like ANY of PostgreSQL
+        found = {}
+        probed = set()
+        draw = size * 2
+        for _ in range(4):
+            if (span - len(probed)) < draw * 2:  # dense enough to sort instead
+                return None
+            keys = []
+            while len(keys) < draw:
+                key = rng.randint(low, high)
+                if key not in probed:
+                    probed.add(key)
+                    keys.append(key)
+            keys.sort()
+            for i in range(0, len(keys), chunk_size or len(keys)):
+                in_sql, in_values = self.gen_in_condition(
+                    primary_key, "IN", keys[i:i + chunk_size] if chunk_size else keys)
+                res = self.db.query_return_detail(self.gen_select_with_fields("*", where + in_sql),
+                                                  *(list(condition_values) + in_values))
+                self.last_query = res["query"]
+                for row in res["data"]:
+                    found[row[primary_key]] = row
+            if len(found) >= size:
+                return [found[k] for k in rng.sample(sorted(found), size)]
+            if not found:
+                return None
+            # probe more keys by the rate of hits
+            draw = min(int((size - len(found)) * len(probed) / len(found) * 1.2) + 1, (chunk_size or 1000) * 10)
+        return None
+
+    def gen_random_order(self, seed=None):
+        """random value to order by,seeded if the database supports"""
+        raise NotImplementedError("You must implement it in subclass")
+
+    def open_blob(self, field, chunk_size=blob.CHUNK_SIZE):
+        """
+        return a file-like object reading the value of field in the first line with the conditions,
+        chunk_size of it is in memory at the same time,see saiorm.blob
+        """
+        condition_sql, condition_values = self.parse_where_condition()
+        sql = self.gen_blob_read(field, condition_sql)
+        self._reset()
+        self.last_query = sql
+        db = self.db
+
+        def read_chunk(offset, size):
+            res = db.query_column(sql, *([offset + 1, size] + list(condition_values)))
+            return res["data"][0] if res["data"] else None
+
+        return blob.BlobReader(read_chunk, chunk_size)
+
+    def gen_blob_read(self, field, condition):
+        """SELECT a chunk of field,params are start from 1 and length"""
+        raise NotImplementedError("You must implement it in subclass")
+
+    def write_blob(self, field, data, chunk_size=blob.CHUNK_SIZE):
+        """
+        write bytes,str or file object to field of the lines with the conditions by chunks,
+        one statement for every chunk
+
+        :return: dict,result of the last statement
+        """
+        condition_sql, condition_values = self.parse_where_condition()
+        sql, append_sql = self.gen_blob_write(field, condition_sql, isinstance(data, str))
+        timeout = self._timeout
+        self._reset()
+        res = None
+        for chunk in blob.iter_chunks(data, chunk_size):
+            with self.db.deadline(timeout):
+                res = self.db.execute_return_detail(sql, *([chunk] + list(condition_values)))
+            sql = append_sql
+        self.last_query = res["query"]
+        return res
+
+    def gen_blob_write(self, field, condition, text=False):
+        """
+        :param text: bool,data is str
+        :return: tuple,UPDATE setting field to the first chunk and UPDATE appending a chunk to field
+        """
+        raise NotImplementedError("You must implement it in subclass")
+
+    def iter_batches(self, fields="*", batch_size=10000):
+        """
+        return an iterator of column names and list of row tuples with the conditions,
+        rows are streamed from the server by batch_size
+        """
+        sql, condition_values = self.build_select(fields)
+        self._reset()
+        self.last_query = sql
+        return self.db.iter_batches(batch_size, sql, *condition_values)
+
+    def select_arrow(self, fields="*", batch_size=10000, path=None, file_format="ipc", schema=None):
+        """
+        select as pyarrow.Table,see saiorm.columnar
+
+        :param path: str,write to this file batch by batch and return number of rows instead
+        :param file_format: str,ipc or parquet,used with path
+        :param schema: pyarrow.Schema,inferred from the first batch if empty
+        """
+        batches = columnar.record_batches(self.iter_batches(fields, batch_size), schema)
+        if path:
+            return columnar.write_file(batches, path, file_format)
+        return columnar.to_table(batches)
+
+    def select_dataframe(self, fields="*", batch_size=10000):
+        """select as pandas.DataFrame,built by pyarrow if installed"""
+        if columnar.has_arrow():
+            return self.select_arrow(fields, batch_size).to_pandas()
+        return columnar.to_dataframe(self.iter_batches(fields, batch_size))
+
+    def parallel_scan(self, fields="*", key="id", workers=4, chunk_rows=10000, ordered=False):
+        """
+        split the integer key range with the conditions to chunks,select them in parallel
+        on cloned connections,see saiorm.scan.limit is ignored.
+
+        :param key: str,integer key field,should be indexed
+        :param workers: int,number of threads and connections
+        :param chunk_rows: int,about number of rows in one chunk
+        :param ordered: bool,yield chunks in key order,otherwise as they complete
+        :return: iterator of row list
+        """
+        where_sql, where_values = self.parse_where_condition()
+        if where_sql:
+            where_sql = "WHERE (" + where_sql[len("WHERE"):].strip() + ")"
+        range_sql = "{} >= {} AND {} < {}".format(key, self.param_place_holder, key, self.param_place_holder)
+        range_sql = (where_sql + " AND " if where_sql else "WHERE ") + range_sql
+        if self._order_by:
+            range_sql += " ORDER BY " + self._order_by
+        sql = self.gen_select_with_fields(fields, range_sql)
+
+        res = self.query(self.gen_select_with_fields(
+            "MIN({0}) AS low, MAX({0}) AS high, COUNT(*) AS count".format(key), where_sql), *where_values)
+        self.last_query = res["query"]
+        row = res["data"][0]
+        if not row["count"]:
+            return iter([])
+        if not isinstance(row["low"], int):
+            raise ValueError("parallel_scan needs an integer key")
+
+        local = threading.local()  # one cloned connection for every thread
+
+        def select(chunk):
+            db = getattr(local, "db", None)
+            if db is None:
+                db = local.db = self.clone()
+            data = db.query(sql, *(list(where_values) + list(chunk)))["data"]
+            if self.grace_result:
+                data = guard.convert_rows(data, GraceDict)
+            return data
+
+        def close():  # in the worker thread,connections are not shared between threads
+            db = getattr(local, "db", None)
+            if db is not None:
+                db.db.close()
+
+        chunks = scan.split_range(row["low"], row["high"], row["count"], chunk_rows)
+        return scan.run_parallel(select, chunks, workers, ordered, close)
+
+    def export_csv(self, path_or_file, fields="*", header=True, batch_size=10000, progress=None, compress=None):
+        """
+        write rows with the conditions to CSV,rows are streamed from the server by batch_size
+
+        :param path_or_file: str or text file object,path ends with .gz is compressed by gzip
+        :param header: bool,write field names as the first line
+        :param progress: function,receive number of rows written after every batch
+        :param compress: bool,compress by gzip,decided by the extension of path if None
+        :return: int,number of rows
+        """
+        f, should_close = csvio.open_csv(path_or_file, "w", compress)
+        rownumber = 0
+        try:
+            writer = csv.writer(f)
+            for column_names, rows in self.iter_batches(fields, batch_size):
+                if header:
+                    writer.writerow(column_names)
+                    header = False
+                writer.writerows(rows)
+                rownumber += len(rows)
+                if progress:
+                    progress(rownumber)
+        finally:
+            if should_close:
+                f.close()
+        return rownumber
+
+    def import_csv(self, path_or_file, fields=None, chunk_size=1000, header=True, progress=None, compress=None):
+        """
+        insert rows of CSV to current table chunk by chunk,empty value is inserted as NULL
+
+        :param path_or_file: str or text file object,path ends with .gz is decompressed by gzip
+        :param fields: list,field names of CSV columns,use the header if empty
+        :param header: bool,whether the first line is header
+        :param progress: function,receive number of rows inserted after every chunk
+        :param compress: bool,decompress by gzip,decided by the extension of path if None
+        :return: int,number of rows
+        """
+        f, should_close = csvio.open_csv(path_or_file, "r", compress)
+        rownumber = 0
+        try:
+            reader = csv.reader(f)
+            if header:
+                names = next(reader, None)
+                fields = fields or names
+            if not fields:
+                raise ValueError("Param fields is necessary when CSV has no header")
+            for rows in csvio.read_chunks(reader, chunk_size):
+                self.import_rows(fields, rows)
+                rownumber += len(rows)
+                if progress:
+                    progress(rownumber)
+        finally:
+            if should_close:
+                f.close()
+        return rownumber
+
+    def import_rows(self, fields, rows):
+        """insert one chunk of import_csv,empty value is NULL"""
+        return self.bulk_rows(fields, [[None if v == "" else v for v in row] for row in rows])
+
+    def bulk_rows(self, fields, rows):
+        """insert one chunk of rows,None is NULL,override it to use the native bulk path"""
+        return self.insert_many({"fields": fields, "values": rows})
+
+    def insert_columns(self, data, chunk_size=10000):
+        """
+        insert column-oriented data chunk by chunk by the native bulk path,see saiorm.columnar
+
+        :param data: dict of sequences,numpy structured array,pandas.DataFrame or pyarrow.Table
+        """
+        res = None
+        rowcount = 0
+        for fields, rows in columnar.iter_row_chunks(data, chunk_size):
+            res = self.bulk_rows(fields, rows)
+            rowcount += res["rowcount"] if res["rowcount"] and res["rowcount"] > 0 else 0
+        if res is None:
+            return False
+        res["rowcount"] = rowcount
+        self.last_query = res["query"]
+        return res
+
+    def gen_exists(self, condition):
+        raise NotImplementedError("You must implement it in subclass")
+
     def update(self, dict_data=None):
         if not dict_data:
             return False
+        chunks = self.split_in_condition()
+        if chunks:
+            return self.run_writes_in_chunks(chunks, lambda: self.update(dict_data))
         fields, values = self.split_update_fields_value(dict_data)
         condition_sql, condition_values = self.parse_condition()
         sql = self.gen_update(fields, condition_sql)
@@ -183,6 +967,43 @@ class BaseDB(object):
     def gen_update(self, fields, condition):
         raise NotImplementedError("You must implement it in subclass")
 
+    def update_many(self, dict_data=None, key="id"):
+        """
+        update many lines with different values,where condition is also available
+
+        :param dict_data: dict list,every dict must have the key field,
+            other fields are the new values,native function is same as update
+        :param key: str,unique field to locate each line
+
+        Lines are split into a few statements by self.max_params.
+        """
+        if not dict_data:
+            return False
+
+        fields = []  # all fields to update,keep order
+        for i in dict_data:
+            for k in i.keys():
+                if k != key and k not in fields:
+                    fields.append(k)
+        if not fields:
+            return False
+
+        condition_sql, condition_values = self.parse_where_condition()
+
+        def count(line):  # key in IN list,key and value for every field,like CASE id WHEN %s THEN %s
+            return 1 + sum(1 + len(self.split_insert_value(v)[1]) for k, v in line.items() if k != key)
+
+        chunks = self.chunk_by_params(dict_data, count, len(condition_values))
+        return self.execute_chunks(self.gen_update_many(i, key, fields, condition_sql) + (condition_values,)
+                                   for i in chunks)
+
+    def gen_update_many(self, dict_data, key, fields, condition):
+        """
+        :param condition: str,where condition starts with WHERE,or empty str
+        :return: tuple,SQL and values
+        """
+        raise NotImplementedError("You must implement it in subclass")
+
     def split_update_fields_value(self, dict_data):
         raise NotImplementedError("You must implement it in subclass")
 
@@ -231,7 +1052,10 @@ class BaseDB(object):
         insert one line,,support rwo kinds data,such as insert,
         but the values should be wraped with list or tuple
 
+        column-oriented data is inserted by insert_columns
         """
+        if columnar.is_columnar(dict_data):
+            return self.insert_columns(dict_data)
         if not dict_data:
             return False
 
@@ -270,13 +1094,106 @@ class BaseDB(object):
     def gen_insert_many_with_fields(self, fields, condition):
         raise NotImplementedError("You must implement it in subclass")
 
+    def consecutive_insert_ids(self):
+        """whether ids of the lines of insert_many are consecutive from its lastrowid,used by BatchWriter"""
+        return False
+
     def gen_insert_many_without_fields(self, fields):
         raise NotImplementedError("You must implement it in subclass")
 
+    def upsert(self, dict_data=None, conflict_keys=None, update_fields=None):
+        """
+        insert one line,update it when conflict with unique keys,in one statement
+
+        :param dict_data: dict,field name and value,native function is same as update
+        :param conflict_keys: list,unique fields to detect conflict,use primary key by default
+        :param update_fields: fields to update when conflict,use all fields except conflict_keys by default.
+            list means update with the inserting values,dict is the same as update
+        """
+        if not dict_data:
+            return False
+        return self.upsert_many([dict_data], conflict_keys, update_fields)
+
+    def upsert_many(self, dict_data=None, conflict_keys=None, update_fields=None):
+        """
+        insert or update many lines,params same as upsert,
+        dict_data could be dict list or split dict with fields and values
+
+        Lines are split into a few statements by self.max_params.
+        """
+        if not dict_data:
+            return False
+
+        if isinstance(dict_data, dict):  # split dict
+            fields = list(dict_data["fields"])
+            rows = [list(v) for v in dict_data["values"]]
+        else:
+            fields = list(dict_data[0].keys())
+            rows = [[i[f] for f in fields] for i in dict_data]
+
+        if conflict_keys is None:
+            conflict_keys = self.get_primary_key()
+        if isinstance(conflict_keys, str):
+            conflict_keys = [conflict_keys]
+
+        update_values = []
+        if update_fields is None:
+            update_fields = [f for f in fields if f not in conflict_keys]
+        if isinstance(update_fields, dict):
+            update_sql, update_values = self.split_update_fields_value(update_fields)
+        else:
+            update_sql = ",".join([self.gen_upsert_field(f) for f in update_fields])
+
+        def gen_upsert(chunk):
+            values_signs = []
+            values = []
+            for row in chunk:
+                signs = []
+                for v in row:
+                    sign, sign_values = self.split_insert_value(v)
+                    signs.append(sign)
+                    values += sign_values
+                values_signs.append("(" + ",".join(signs) + ")")
+            return self.gen_upsert(fields, values_signs, conflict_keys, update_sql), values, update_values
+
+        chunks = self.chunk_by_params(
+            rows, lambda row: sum(len(self.split_insert_value(v)[1]) for v in row), len(update_values))
+        return self.execute_chunks(gen_upsert(i) for i in chunks)
+
+    def split_insert_value(self, v):
+        """
+        generate placeholder and values of one inserting value,
+        native function is same as update
+
+        :return: tuple,placeholder str and values list
+        """
+        if isinstance(v, str) and v.startswith("`"):  # native function without param
+            return v[1:], []
+        elif is_array(v) and v and isinstance(v[0], str) and v[0].startswith("`"):  # native function with param
+            return v[0][1:].replace("?", self.param_place_holder), list(v[1:])
+        else:
+            return self.param_place_holder, [v]
+
+    def gen_upsert(self, fields, values_signs, conflict_keys, update_sql):
+        """
+        :param fields: list,field names
+        :param values_signs: list,str like (%s,%s) of each line
+        :param conflict_keys: list,unique fields
+        :param update_sql: str like a=%s,b=VALUES(b)
+        """
+        raise NotImplementedError("You must implement it in subclass")
+
+    def gen_upsert_field(self, field):
+        """str to update field with the inserting value"""
+        raise NotImplementedError("You must implement it in subclass")
+
     def delete(self):
         if self.strict and not self._where:
             logging.warning("without where condition,can not delete")
             return False
+        chunks = self.split_in_condition()
+        if chunks:
+            return self.run_writes_in_chunks(chunks, self.delete)
 
         condition_sql, condition_values = self.parse_condition()
         sql = self.gen_delete(condition_sql)
@@ -288,23 +1205,60 @@ class BaseDB(object):
         raise NotImplementedError("You must implement it in subclass")
 
     def increase(self, field, step=1):
-        """number field Increase """
-        sql = self.gen_increase(field, str(step))
-        res = self.execute(sql)
+        """number field Increase with the conditions"""
+        chunks = self.split_in_condition()
+        if chunks:
+            return self.run_writes_in_chunks(chunks, lambda: self.increase(field, step))
+        condition_sql, condition_values = self.parse_where_condition()
+        sql = self.gen_increase(field, str(step), condition_sql)
+        res = self.execute(sql, *condition_values)
         self.last_query = res["query"]
         return res
 
-    def gen_increase(self, field, step):
+    def gen_increase(self, field, step, condition):
         raise NotImplementedError("You must implement it in subclass")
 
     def decrease(self, field, step=1):
-        """number field decrease """
-        sql = self.gen_decrease(field, str(step))
-        res = self.execute(sql)
+        """number field decrease with the conditions"""
+        chunks = self.split_in_condition()
+        if chunks:
+            return self.run_writes_in_chunks(chunks, lambda: self.decrease(field, step))
+        condition_sql, condition_values = self.parse_where_condition()
+        sql = self.gen_decrease(field, str(step), condition_sql)
+        res = self.execute(sql, *condition_values)
         self.last_query = res["query"]
         return res
 
-    def gen_decrease(self, field, step):
+    def gen_decrease(self, field, step, condition):
+        raise NotImplementedError("You must implement it in subclass")
+
+    def increase_many(self, field, deltas, key="id"):
+        """
+        increase field of many lines by different steps,where condition is also available
+
+        :param deltas: dict,value of key to step,negative step to decrease
+        :param key: str,unique field to locate each line
+
+        Lines are updated in order of key to avoid deadlock,split into a few statements by self.max_params.
+        """
+        if not deltas:
+            return False
+
+        items = list(deltas.items())
+        try:
+            items.sort()
+        except TypeError:  # keys of mixed types
+            pass
+        condition_sql, condition_values = self.parse_where_condition()
+        chunks = self.chunk_by_params(items, lambda item: 3, len(condition_values))
+        return self.execute_chunks(self.gen_increase_many(field, i, key, condition_sql) + (condition_values,)
+                                   for i in chunks)
+
+    def gen_increase_many(self, field, items, key, condition):
+        """
+        :param items: list of tuple,value of key and step
+        :return: tuple,SQL and values
+        """
         raise NotImplementedError("You must implement it in subclass")
 
     def get_fields_name(self):
@@ -312,6 +1266,15 @@ class BaseDB(object):
         if not self._table:
             return []
 
+        if self.cache_fields_name:
+            try:
+                table_schema = self.get_schema()
+            except Exception:
+                logging.warning("Cannot load schema metadata,fallback to query fields name")
+                table_schema = None
+            if table_schema:
+                return table_schema["columns"]
+
         if self.cache_fields_name and self._cached_fields_name.get(self._table):
             return self._cached_fields_name.get(self._table)
         else:
@@ -325,6 +1288,69 @@ class BaseDB(object):
         """get one line from table"""
         raise NotImplementedError("You must implement it in subclass")
 
+    def get_schema_key(self):
+        """key of connected database in schema cache,by server,user and database"""
+        args = getattr(self.db, "_db_args", {})
+        return "{}://{}@{}:{}/{}".format(self.__class__.__module__,
+                                         args.get("user") or "",
+                                         getattr(self.db, "host", ""),
+                                         args.get("port") or "",
+                                         getattr(self.db, "database", ""))
+
+    def load_schema(self):
+        """
+        load schema of all tables in connected database by bulk queries,
+        and save them to the shared schema cache
+
+        :return: dict,table name and schema
+        """
+        columns = self.db.query_return_detail(self.gen_schema_columns())["data"]
+        indexes = self.db.query_return_detail(self.gen_schema_indexes())["data"]
+        tables = schema.build_tables(columns, indexes)
+        schema.schema_cache.set(self.get_schema_key(), tables)
+        return tables
+
+    def get_schema(self, table_name=""):
+        """
+        return schema of table,see saiorm.schema,use current table by default
+
+        All tables are loaded once,a table not found is None until it's invalidated.
+        """
+        table_name = table_name or self._table
+        table_name = table_name.split()[0] if table_name.strip() else ""  # strip alias
+        key = self.get_schema_key()
+        tables = schema.schema_cache.get(key)
+        if tables is None or schema.schema_cache.is_stale(key, table_name):
+            tables = self.load_schema()
+        return tables.get(table_name)
+
+    def get_primary_key(self, table_name=""):
+        """return list of primary key fields of table"""
+        table_schema = self.get_schema(table_name)
+        return table_schema["primary_key"] if table_schema else []
+
+    def invalidate_schema(self, table_name=None):
+        """
+        invalidate schema cache of connected database,
+        call it after changing table structure
+        """
+        self._cached_fields_name.clear()
+        schema.schema_cache.invalidate(self.get_schema_key(), table_name)
+
+    def gen_schema_columns(self):
+        """
+        query all columns of database,fields should be:
+        table_name, column_name, data_type, is_nullable, is_primary
+        """
+        raise NotImplementedError("You must implement it in subclass")
+
+    def gen_schema_indexes(self):
+        """
+        query all indexes of database,fields should be:
+        table_name, index_name, column_name, is_unique
+        """
+        raise NotImplementedError("You must implement it in subclass")
+
     # shorthand
     t = table
     w = where
@@ -368,11 +1394,86 @@ class ChainDB(BaseDB):
     """
 
     def gen_select_with_fields(self, fields, condition):
-        return "SELECT {} FROM {} {};".format(fields, self._table, condition)
+        return "SELECT {} FROM {}{} {};".format(fields, self._table, self.gen_table_hint(), condition)
 
     def gen_select_without_fields(self, fields):
         return "SELECT {};".format(fields)
 
+    def gen_exists(self, condition):
+        return "SELECT 1 FROM {}{} {} LIMIT 1;".format(self._table, self.gen_table_hint(), condition)
+
+    def gen_random_order(self, seed=None):
+        return "RANDOM()"
+
+    def sample_by_table(self, size, seed=None):
+        """
+        sample by TABLESAMPLE of gen_table_sample,fraction of the pages or lines in the table.
+        For number of lines,sample twice the fraction by the estimated row count and pick size of them,
+        fall back to ORDER BY a random value if too few lines are sampled.
+        """
+        self.check_sample_size(size)
+        rng = random.Random(seed)
+        condition = self._save_condition()
+        self._order_by = ""
+        self._limit = ""
+        with self.db.deadline(self._timeout):
+            if isinstance(size, float):
+                self._table_sample = self.gen_table_sample(size * 100, seed, by_line=True)
+                sql, condition_values = self.build_select("*")
+                data = self.db.query_return_detail(sql, *condition_values)["data"]
+            else:
+                res = self.db.query_column(self.gen_row_estimate(), self._table.split()[0])
+                estimate = res["data"][0] if res["data"] else None
+                percent = min(100.0, size * 200.0 / estimate) if estimate and estimate > 0 else 100.0
+                self._table_sample = self.gen_table_sample(percent, seed)
+                sql, condition_values = self.build_select("*")
+                data = self.db.query_return_detail(sql, *condition_values)["data"]
+                if len(data) >= size:
+                    data = rng.sample(list(data), size)
+                else:
+                    self._restore_condition(condition)
+                    self._order_by = self.gen_random_order(seed)
+                    self._limit = size
+                    sql, condition_values = self.build_select("*")
+                    data = self.db.query_return_detail(sql, *condition_values)["data"]
+        self._reset()
+        self.last_query = sql
+        if self.grace_result:
+            data = guard.convert_rows(data, GraceDict)
+        return data
+
+    def gen_table_sample(self, percent, seed=None, by_line=False):
+        """
+        TABLESAMPLE clause after the table name
+
+        :param by_line: bool,every line has the chance of percent,or every page if False
+        """
+        raise NotImplementedError("You must implement it in subclass")
+
+    def gen_row_estimate(self):
+        """query the estimated row count of the table from statistics,the param is the table name"""
+        raise NotImplementedError("You must implement it in subclass")
+
+    def gen_in_condition(self, field, sign, values):
+        """
+        a IN (%s,%s,%s,%s)
+
+        Pad values to a few bucket sizes by repeating the last one,
+        so the statements with different length of list have the same shape.
+        """
+        values = list(values)
+        if not values:
+            return ("1=0" if sign.lower() == "in" else "1=1"), []
+
+        size = 1
+        while size < len(values):
+            size *= 2
+        if size > (self.in_chunk_size or len(values)):
+            size = max(self.in_chunk_size or 0, len(values))
+        values += [values[-1]] * (size - len(values))
+
+        return "{} {} ({})".format(field, sign, ",".join([self.param_place_holder] * size)), values
+
     def split_update_fields_value(self, dict_data):
         """
         generate str ike filed_name = %s and values,use for update
@@ -406,6 +1507,27 @@ class ChainDB(BaseDB):
     def gen_update(self, fields, condition):
         return "UPDATE {} SET {} {};".format(self._table, fields, condition)
 
+    def gen_update_many(self, dict_data, key, fields, condition):
+        """UPDATE xxx SET a=CASE id WHEN 1 THEN 'a' ELSE a END WHERE id IN (1)"""
+        sets = []
+        values = []
+        for f in fields:
+            case = ""
+            for i in dict_data:
+                if f in i:
+                    sign, sign_values = self.split_insert_value(i[f])
+                    case += " WHEN {} THEN {}".format(self.param_place_holder, sign)
+                    values += [i[key]] + sign_values
+            if case:  # skip fields missing in all lines
+                sets.append("{}=CASE {}{} ELSE {} END".format(f, key, case, f))
+
+        sql = "UPDATE {} SET {} WHERE {} IN ({})".format(
+            self._table, ",".join(sets), key, ",".join([self.param_place_holder for i in dict_data]))
+        values += [i[key] for i in dict_data]
+        if condition:
+            sql += " AND (" + condition[len("WHERE"):] + ")"
+        return sql + ";", values
+
     def gen_insert_with_fields(self, fields, values_sign):
         return "INSERT INTO {} ({}) VALUES ({});".format(self._table, fields, values_sign)
 
@@ -418,21 +1540,63 @@ class ChainDB(BaseDB):
     def gen_insert_many_without_fields(self, values_sign):
         return "INSERT INTO {}  VALUES ({});".format(self._table, values_sign)
 
+    def gen_upsert(self, fields, values_signs, conflict_keys, update_sql):
+        if not update_sql:  # ignore conflict
+            update_sql = "{}={}".format(fields[0], fields[0])
+        return "INSERT INTO {} ({}) VALUES {} ON DUPLICATE KEY UPDATE {};".format(
+            self._table, ",".join(fields), ",".join(values_signs), update_sql)
+
+    def gen_upsert_field(self, field):
+        return "{}=VALUES({})".format(field, field)
+
     def gen_delete(self, condition):
         return "DELETE FROM {} {};".format(self._table, condition)
 
-    def gen_increase(self, field, step):
+    def gen_increase(self, field, step, condition=""):
         """number field Increase """
-        return "UPDATE {} SET {}={}+{};".format(self._table, field, field, step)
+        return "UPDATE {} SET {}={}+{} {};".format(self._table, field, field, step, condition)
 
-    def gen_decrease(self, field, step=1):
+    def gen_decrease(self, field, step=1, condition=""):
         """number field decrease """
-        return "UPDATE {} SET {}={}-{};".format(self._table, field, field, str(step))
+        return "UPDATE {} SET {}={}-{} {};".format(self._table, field, field, str(step), condition)
+
+    def gen_increase_many(self, field, items, key, condition):
+        """UPDATE xxx SET a=a+CASE id WHEN 1 THEN 2 END WHERE id IN (1)"""
+        case = "".join([" WHEN {} THEN {}".format(self.param_place_holder, self.param_place_holder)
+                        for _ in items])
+        sql = "UPDATE {} SET {}={}+CASE {}{} END WHERE {} IN ({})".format(
+            self._table, field, field, key, case, key, ",".join([self.param_place_holder for _ in items]))
+        values = [v for i in items for v in i] + [i[0] for i in items]
+        if condition:
+            sql += " AND (" + condition[len("WHERE"):] + ")"
+        return sql + ";", values
 
     def gen_get_fields_name(self):
         """get one line from table"""
         return "SELECT * FROM {} LIMIT 1;".format(self._table)
 
+    def gen_blob_read(self, field, condition):
+        return "SELECT SUBSTRING({}, {}, {}) FROM {} {} LIMIT 1;".format(
+            field, self.param_place_holder, self.param_place_holder, self._table, condition)
+
+    def gen_blob_write(self, field, condition, text=False):
+        return ("UPDATE {} SET {}={} {};".format(self._table, field, self.param_place_holder, condition),
+                "UPDATE {} SET {}=CONCAT({}, {}) {};".format(
+                    self._table, field, field, self.param_place_holder, condition))
+
+    def gen_schema_columns(self):
+        return "SELECT TABLE_NAME AS table_name, COLUMN_NAME AS column_name, " \
+               "DATA_TYPE AS data_type, IS_NULLABLE AS is_nullable, " \
+               "COLUMN_KEY = 'PRI' AS is_primary " \
+               "FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() " \
+               "ORDER BY TABLE_NAME, ORDINAL_POSITION;"
+
+    def gen_schema_indexes(self):
+        return "SELECT TABLE_NAME AS table_name, INDEX_NAME AS index_name, " \
+               "COLUMN_NAME AS column_name, NON_UNIQUE = 0 AS is_unique " \
+               "FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() " \
+               "ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX;"
+
     def parse_where_condition(self):
         """parse where condition"""
         sql = ""
@@ -475,12 +1639,13 @@ class ChainDB(BaseDB):
                                 sql_values.append(v[1])
                         elif sign.lower() in ("in", "not in", "is not"):
                             # IN / NOT IN / IS NOT etc.
-                            # JOIN STRING DIRECT
+                            # bind sequence as params,JOIN STRING DIRECT
                             v1 = v[1]
 
                             if is_array(v1):
-                                v1 = ",".join(v1)
-                                where += " {} {} ({}) {}".format(k, sign, v1, and_or)
+                                in_sql, in_values = self.gen_in_condition(k, sign, v1)
+                                where += " {} {}".format(in_sql, and_or)
+                                sql_values += in_values
                             else:
                                 where += " {} {} {} {}".format(k, sign, str(v1), and_or)
 
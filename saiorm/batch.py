@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Collect statements built by ChainDB and send them in as few round trips as the driver allows.
+
+Usage::
+
+    with DB.batch() as batch:
+        users = DB.table("user").where({"id": 1}).get()
+        logs = DB.table("log").order_by("id DESC").limit(10).select()
+        DB.table("user").where({"id": 1}).increase("views")
+
+    users.result()  # returns the same as get,or raises the error of this statement
+    logs.result()
+
+Statements are executed when the with block ends,every statement returns a BatchItem.
+Error of one statement does not stop the others.
+
+select,get,count,exists,sum/avg/min/max,pluck and the writes are collected.
+Methods with their own protocol (sample,open_blob,write_blob,iter_batches,select_arrow,export_csv,
+bulk_load,parallel_scan) are executed immediately.
+"""
+import logging
+
+try:
+    from . import utility
+except ImportError:
+    import utility
+
+Row = utility.Row
+GraceDict = utility.GraceDict
+
+
+class BatchItem(Row):
+    """
+    One statement in batch,filled with the returned dict of
+    query_return_detail or execute_return_detail after the batch executed.
+
+    error is the exception raised by this statement.
+    """
+
+    def __init__(self, kind, query, parameters, kwparameters=None):
+        super().__init__(data=[], column_names=[], lastrowid=0, rowcount=0, rownumber=0,
+                         query="", error=None)
+        self.kind = kind  # query, execute or executemany
+        self.sql = query
+        self.parameters = parameters
+        self.kwparameters = kwparameters or {}
+        self.grace_result = False
+        self.first = False  # return the first line only,used by get
+        self.convert = None  # function to convert the rows,used by count,exists,pluck etc.
+
+    def result(self):
+        """return data like select or get for query,self for others"""
+        if self["error"] is not None:
+            raise self["error"]
+        if self.kind != "query":
+            return self
+        if self.convert is not None:
+            return self.convert(self["data"])
+        if self.first:
+            return self["data"][0] if self["data"] else {}
+        return self["data"]
+
+
+class Batch(object):
+    def __init__(self, db):
+        self.db = db  # ChainDB
+        self.items = []
+
+    def __enter__(self):
+        self.db._batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db._batch = None
+        if exc_type is None:
+            self.run()
+
+    def add(self, kind, query, parameters, kwparameters=None):
+        item = BatchItem(kind, query, parameters, kwparameters)
+        item.grace_result = self.db.grace_result
+        self.items.append(item)
+        return item
+
+    def run(self):
+        """execute all collected statements,return BatchItem list in order"""
+        items, self.items = self.items, []
+        if not items:
+            return items
+
+        self.db.db.execute_batch(items)
+
+        for item in items:
+            if item.kind == "query" and item.grace_result and item["error"] is None:
+                item["data"] = [GraceDict(i) for i in item["data"]]
+        return items
+
+
+def run_item(connection, item):
+    """execute one statement by the normal methods of connection"""
+    if item.kind == "query":
+        res = connection.query_return_detail(item.sql, *item.parameters, **item.kwparameters)
+    elif item.kind == "execute":
+        res = connection.execute_return_detail(item.sql, *item.parameters, **item.kwparameters)
+    else:
+        res = connection.executemany_return_detail(item.sql, item.parameters)
+    item.update(res)
+
+
+def run_sequential(connection, items):
+    """execute statements one by one,for drivers can not send them together"""
+    for item in items:
+        try:
+            run_item(connection, item)
+        except Exception as e:
+            item["error"] = e
+
+
+def group_items(items, can_join):
+    """
+    split items to groups of consecutive statements which can be joined
+
+    :param can_join: function,receive item and return bool
+    :return: list of tuple,bool of joined and item list
+    """
+    groups = []
+    for item in items:
+        joined = can_join(item)
+        if joined and groups and groups[-1][0]:
+            groups[-1][1].append(item)
+        else:
+            groups.append((joined, [item]))
+    return groups
+
+
+def join_statements(statements):
+    """join statements with semicolon"""
+    return "".join([i.strip().rstrip(";") + ";" for i in statements])
+
+
+def log_error(driver, exception, item):
+    logging.error("Error in batch on " + driver)
+    logging.error("Error query:" + str(item.sql))
+    logging.error("Error Exception:" + str(exception))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Read and write large BLOB/TEXT values by chunks,used by ChainDB.open_blob and ChainDB.write_blob.
+
+Usage::
+
+    with DB.table("document").where({"id": 1}).open_blob("content") as f:
+        shutil.copyfileobj(f, out)
+
+    with open("report.pdf", "rb") as f:
+        DB.table("document").where({"id": 1}).write_blob("content", f)
+
+Backends:
+
+- MySQL,SQL Server: SUBSTRING of chunk_size for every read,UPDATE appending a chunk for every write.
+- PostgreSQL: same as above on bytea or text,large objects (lo_*) are not used.
+- SQLite: incremental BLOB I/O by sqlite3 blobopen,SUBSTR for reads if it's not available (Python < 3.11).
+- MongoDB: the field holds the file id of GridFS.
+
+TEXT values are counted in characters by the database,they are read as UTF-8 bytes.
+
+**ATTENTION**
+
+write_blob runs one statement for every chunk,the value is partially written if it fails in the middle,
+run it in a transaction if that matters.
+"""
+import io
+
+CHUNK_SIZE = 256 * 1024
+
+
+class BlobReader(io.RawIOBase):
+    """
+    read-only file-like object of a value,read by chunks from the database.
+    Empty if the line does not exist or the value is NULL.
+    """
+
+    def __init__(self, read_chunk, chunk_size=CHUNK_SIZE):
+        """
+        :param read_chunk: function of offset and size,offset starts from 0,
+            return bytes or str of size at most,None if no line
+        """
+        super().__init__()
+        self.chunk_size = chunk_size
+        self._read_chunk = read_chunk
+        self._offset = 0  # offset in the database,bytes of BLOB or characters of TEXT
+        self._buffer = b""
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._buffer:
+            if self._eof:
+                return 0
+            chunk = self._read_chunk(self._offset, self.chunk_size)
+            if chunk is None:
+                chunk = b""
+            self._offset += len(chunk)
+            if len(chunk) < self.chunk_size:
+                self._eof = True
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            self._buffer = memoryview(bytes(chunk))  # memoryview of psycopg2 bytea is copied once
+            if not self._buffer:
+                return 0
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def iter_chunks(data, chunk_size=CHUNK_SIZE):
+    """
+    yield chunks of bytes,str or file object,yield once at least.
+    str is split by characters,so a chunk is always valid text.
+
+    :param data: bytes,str or file object
+    """
+    if isinstance(data, (str, bytes, bytearray, memoryview)):
+        if not isinstance(data, str):
+            data = memoryview(data)
+        for start in range(0, max(len(data), 1), chunk_size):
+            chunk = data[start:start + chunk_size]
+            yield chunk if isinstance(chunk, str) else bytes(chunk)
+        return
+
+    chunk = data.read(chunk_size)
+    while True:
+        yield chunk
+        chunk = data.read(chunk_size)
+        if not chunk:
+            break
+
+
+def data_size(data):
+    """bytes of data,seek to the end of file object and back,None if it's not seekable"""
+    if isinstance(data, str):
+        return len(data.encode("utf-8"))
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return len(data)
+    if not data.seekable():
+        return None
+    position = data.tell()
+    size = data.seek(0, io.SEEK_END) - position
+    data.seek(position)
+    return size
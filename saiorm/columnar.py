@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Build Arrow tables and pandas DataFrames from cursor tuples in batches,
+without building a dict for every row.
+
+Rows are streamed from the server (server side cursor in MySQL and PostgreSQL,
+fetchmany in others),each batch is transposed to column buffers.
+
+pyarrow and pandas are optional::
+
+    pip install saiorm[arrow]
+    pip install saiorm[pandas]
+
+Usage::
+
+    table = DB.table("log").where({"day": "2018-01-01"}).select_arrow()
+    df = DB.table("log").select_dataframe("id, level, message")
+
+    # write to file batch by batch,result size is not bounded by memory
+    DB.table("log").select_arrow(path="/tmp/log.parquet", file_format="parquet")
+
+Types of columns are inferred from the first batch,pass schema (pyarrow.Schema)
+if a column could be NULL in all rows of the first batch.
+
+Column-oriented data is accepted by insert_many too,a dict of sequences,
+numpy structured array,pandas.DataFrame or pyarrow.Table::
+
+    DB.table("log").insert_many(df)
+    DB.table("log").insert_many({"id": [1, 2], "level": ["info", "error"]})
+
+Rows are built chunk by chunk,NaN and NaT are converted to NULL,numpy scalars to Python values.
+"""
+import importlib.util
+
+try:
+    from . import utility
+except ImportError:
+    import utility
+
+pa = utility.LazyModule("pyarrow")
+pq = utility.LazyModule("pyarrow.parquet")
+pd = utility.LazyModule("pandas")
+pc = utility.LazyModule("pyarrow.compute")
+np = utility.LazyModule("numpy")
+
+
+def has_arrow():
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def fetch_batches(cursor, batch_size):
+    """
+    yield column names and list of row tuples,fetched from an executed cursor by batch_size.
+    Yield once at least,rows is empty if no result.
+    """
+    rows = cursor.fetchmany(batch_size)
+    column_names = [d[0] for d in cursor.description]
+    while True:
+        yield column_names, rows
+        if not rows:
+            break
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+
+
+def record_batches(batches, schema=None):
+    """convert batches of column names and row tuples to pyarrow.RecordBatch"""
+    for column_names, rows in batches:
+        columns = list(zip(*rows)) if rows else [()] * len(column_names)
+        if schema is None:
+            batch = pa.RecordBatch.from_arrays([pa.array(c) for c in columns], names=column_names)
+            schema = batch.schema
+        else:
+            batch = pa.RecordBatch.from_arrays([pa.array(c, type=f.type) for c, f in zip(columns, schema)],
+                                               schema=schema)
+        yield batch
+
+
+def to_table(batches):
+    """build pyarrow.Table from RecordBatch iterator"""
+    return pa.Table.from_batches(list(batches))
+
+
+def write_file(batches, path, file_format="ipc"):
+    """
+    write RecordBatch iterator to file batch by batch
+
+    :param file_format: str,ipc or parquet
+    :return: int,number of rows written
+    """
+    if file_format not in ("ipc", "parquet"):
+        raise ValueError("file_format must be ipc or parquet")
+
+    writer = None
+    rownumber = 0
+    try:
+        for batch in batches:
+            if writer is None:
+                if file_format == "parquet":
+                    writer = pq.ParquetWriter(path, batch.schema)
+                else:
+                    writer = pa.ipc.new_file(path, batch.schema)
+            if file_format == "parquet":
+                writer.write_table(pa.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+            rownumber += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return rownumber
+
+
+def to_dataframe(batches):
+    """build pandas.DataFrame from batches of column names and row tuples,without pyarrow"""
+    frames = [pd.DataFrame.from_records(rows, columns=column_names) for column_names, rows in batches]
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True)
+
+
+def is_columnar(data):
+    """whether data is column-oriented,checked without importing numpy,pandas or pyarrow"""
+    if isinstance(data, dict):  # dict of sequences,not the dict of fields and values
+        if "values" in data or not data:
+            return False
+        first = next(iter(data.values()))
+        return hasattr(first, "__len__") and not isinstance(first, (str, bytes, dict))
+    if hasattr(data, "to_batches") and hasattr(data, "schema"):  # pyarrow.Table
+        return True
+    if hasattr(data, "itertuples") and hasattr(data, "columns"):  # pandas.DataFrame
+        return True
+    return getattr(getattr(data, "dtype", None), "names", None) is not None  # numpy structured array
+
+
+def numpy_values(values):
+    """numpy array to list of Python values,NaN and NaT to None"""
+    values = np.asarray(values)
+    kind = values.dtype.kind
+    if kind == "f":
+        res = values.astype(object)
+        res[np.isnan(values)] = None
+        return res
+    if kind in "mM":
+        res = values.astype("datetime64[us]" if kind == "M" else "timedelta64[us]").astype(object)
+        res[np.isnat(values)] = None
+        return res
+    if kind == "O":
+        res = values.copy()
+        try:
+            res[values != values] = None  # only NaN and NaT are not equal to themselves
+        except (TypeError, ValueError):
+            pass
+        return res
+    return values.tolist()
+
+
+def column_values(column, start, end):
+    """values of column in [start, end) as Python values"""
+    if hasattr(column, "to_numpy"):  # pandas.Series
+        column = column.iloc[start:end]
+        if column.dtype.kind in "mM" and not hasattr(column.dtype, "tz"):
+            return numpy_values(column.to_numpy())
+        return column.to_numpy(dtype=object, na_value=None)
+    if hasattr(column, "dtype"):  # numpy array
+        return numpy_values(column[start:end])
+    return [None if isinstance(v, float) and v != v else v for v in column[start:end]]
+
+
+def iter_row_chunks(data, chunk_size):
+    """
+    yield field names and list of row tuples of column-oriented data,chunk_size rows at most
+    """
+    if hasattr(data, "to_batches") and hasattr(data, "schema"):  # pyarrow.Table
+        fields = list(data.schema.names)
+        for batch in data.to_batches(max_chunksize=chunk_size):
+            columns = []
+            for column in batch.columns:
+                if pa.types.is_floating(column.type):
+                    column = pc.if_else(pc.is_nan(column), None, column)
+                columns.append(column.to_pylist())
+            yield fields, list(zip(*columns))
+        return
+
+    if hasattr(data, "itertuples") and hasattr(data, "columns"):  # pandas.DataFrame
+        fields = [str(i) for i in data.columns]
+        columns = [data.iloc[:, i] for i in range(len(fields))]
+    elif isinstance(data, dict):
+        fields = list(data.keys())
+        columns = list(data.values())
+    else:  # numpy structured array
+        fields = list(data.dtype.names)
+        columns = [data[i] for i in fields]
+
+    rownumber = len(columns[0]) if columns else 0
+    for start in range(0, rownumber, chunk_size):
+        yield fields, list(zip(*[column_values(c, start, start + chunk_size) for c in columns]))
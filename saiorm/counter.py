@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Write-behind buffer of counters,for hot counters like views and likes.
+
+Deltas are added up in memory by table,field and key,a background thread writes them
+every interval seconds,or as soon as max_pending counters are pending,
+by ChainDB.increase_many (one UPDATE with CASE for every table and field,$inc bulk write in MongoDB)::
+
+    counters = saiorm.counter.CounterBuffer(DB, interval=1.0)
+    counters.increase("article", article_id, "views")
+    counters.decrease("article", article_id, "likes")
+    counters.flush()  # write now and wait
+    counters.close()  # write the rest and stop,called at exit too
+
+Loss:
+
+- A normal exit writes the pending deltas by atexit.
+- If the process is killed or crashes,the deltas added in the last interval are lost,
+  max_pending counters at most.
+- A failed write is logged and its deltas are put back,they are written by the next flush.
+  If the connection is lost after the server applied the UPDATE,they are applied twice.
+- Deltas failed in the last flush of close are logged and dropped.
+
+Reads of the database do not include the pending deltas.
+"""
+import atexit
+import collections
+import logging
+import threading
+
+
+class CounterBuffer(object):
+    def __init__(self, db, interval=1.0, max_pending=10000, key="id"):
+        """
+        :param db: ChainDB,cloned for the background thread
+        :param interval: float,seconds between flushes
+        :param max_pending: int,flush as soon as number of pending counters reaches it
+        :param key: str,unique field to locate each line,_id in MongoDB
+        """
+        self.db = db.clone()
+        self.interval = interval
+        self.max_pending = max_pending
+        self.key = key
+        self._pending = collections.defaultdict(int)  # (table, field, value of key) to delta
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._flushed = threading.Condition()
+        self._started = 0  # number of flushes started
+        self._finished = 0  # number of flushes finished
+        self._closed = False
+        # all writes are in this thread,the cloned connection is used by one thread only
+        self._thread = threading.Thread(target=self._run, name="saiorm-counter")
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def increase(self, table, key_value, field, step=1):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("CounterBuffer is closed")
+            self._pending[(table, field, key_value)] += step
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wake.set()
+
+    def decrease(self, table, key_value, field, step=1):
+        self.increase(table, key_value, field, 0 - step)
+
+    def pending(self):
+        """number of pending counters"""
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self, timeout=None):
+        """
+        write the pending deltas in the background thread and wait
+
+        :return: bool,False if not finished in timeout
+        """
+        with self._flushed:
+            target = self._started + 1
+            self._wake.set()
+            return self._flushed.wait_for(lambda: self._finished >= target or not self._thread.is_alive(),
+                                          timeout)
+
+    def close(self, timeout=None):
+        """write the pending deltas and stop the background thread"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        atexit.unregister(self.close)
+        self._wake.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            closed = self._closed  # no more deltas after closed,this is the last flush
+            with self._flushed:
+                self._started += 1
+            self._write(closed)
+            with self._flushed:
+                self._finished += 1
+                self._flushed.notify_all()
+            if closed:
+                break
+        self.db.db.close()
+
+    def _write(self, last=False):
+        with self._lock:
+            pending, self._pending = self._pending, collections.defaultdict(int)
+
+        groups = collections.defaultdict(dict)  # (table, field) to deltas
+        for (table, field, key_value), step in pending.items():
+            if step:
+                groups[(table, field)][key_value] = step
+
+        for (table, field), deltas in groups.items():
+            try:
+                self.db.table(table).increase_many(field, deltas, self.key)
+            except Exception as e:
+                logging.error("Error on flushing counters of {}.{}:{}".format(table, field, e))
+                if last:
+                    logging.error("Counters dropped:" + str(deltas))
+                    continue
+                with self._lock:  # put back,written by the next flush
+                    for key_value, step in deltas.items():
+                        self._pending[(table, field, key_value)] += step
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Streaming CSV import and export,used by ChainDB.export_csv and ChainDB.import_csv.
+
+Path ends with .gz is compressed by gzip,or pass compress=True.
+Empty value in CSV is NULL,same as COPY of PostgreSQL.
+
+Typed rows are written in escaped TSV instead,the default text format of
+LOAD DATA in MySQL and COPY in PostgreSQL,NULL is \\N.
+"""
+import csv
+import datetime
+import gzip
+import io
+
+BUFFER_SIZE = 1024 * 1024
+
+
+def open_csv(path_or_file, mode, compress=None):
+    """
+    open path as text file for csv module
+
+    :param path_or_file: str or text file object,file object is returned as it is
+    :param mode: str,r or w
+    :param compress: bool,compress by gzip,decided by the extension of path if None
+    :return: tuple,file object and bool of whether it should be closed by caller
+    """
+    if not isinstance(path_or_file, str):
+        return path_or_file, False
+    if compress is None:
+        compress = path_or_file.endswith(".gz")
+    if compress:
+        return gzip.open(path_or_file, mode + "t", encoding="utf-8", newline=""), True
+    return open(path_or_file, mode, encoding="utf-8", newline="", buffering=BUFFER_SIZE), True
+
+
+def read_chunks(reader, chunk_size):
+    """yield lists of rows from csv reader,chunk_size rows at most"""
+    chunk = []
+    for row in reader:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def to_csv_file(rows):
+    """write rows to an in-memory CSV file,for the native bulk path like COPY"""
+    f = io.StringIO()
+    csv.writer(f).writerows(rows)
+    f.seek(0)
+    return f
+
+
+def escape_tsv_value(value):
+    """escape value in the default format of LOAD DATA and COPY,return bytes"""
+    if value is None:
+        return b"\\N"
+    if isinstance(value, bool):
+        return b"1" if value else b"0"
+    if isinstance(value, (int, float)):
+        return str(value).encode()
+    if isinstance(value, (bytes, bytearray)):
+        value = bytes(value)
+    else:
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat(" ")
+        value = str(value).encode("utf-8")
+    return value.replace(b"\\", b"\\\\").replace(b"\t", b"\\t").replace(
+        b"\n", b"\\n").replace(b"\r", b"\\r").replace(b"\0", b"\\0")
+
+
+def to_tsv_file(rows):
+    """write typed rows to an in-memory escaped TSV file,None is NULL"""
+    f = io.BytesIO()
+    for row in rows:
+        f.write(b"\t".join([escape_tsv_value(v) for v in row]) + b"\n")
+    f.seek(0)
+    return f
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Deferred columns,wide columns are loaded only when they are accessed.
+
+Configure the deferred columns of a table,select("*") selects the other columns only::
+
+    DB.defer("article", ["content", "extra_json"])
+    articles = DB.table("article").where({"author_id": 1}).select()
+    articles[0]["title"]  # selected
+    articles[0]["content"]  # loads content and extra_json of all articles in one query
+
+Deferred columns of all rows in a result are loaded together by primary key in one query
+(split by in_chunk_size),on the first access of any of them by row[field] or row.get(field),
+also row.field when grace_result is False (GraceDict has no attribute access).
+They are not in keys() or iteration before loaded,call load_deferred(rows) to load them explicitly.
+
+Only select("*") without join and group_by is deferred,MongoDB is not supported.
+"""
+import threading
+
+try:
+    from . import utility
+except ImportError:
+    import utility
+
+Row = utility.Row
+GraceDict = utility.GraceDict
+
+
+class Loader(object):
+    """load deferred columns of the rows of one result"""
+
+    def __init__(self, fields, primary_key, fetch):
+        """
+        :param fields: list,deferred columns
+        :param primary_key: str,primary key field,selected in the rows
+        :param fetch: function of list of primary key values,return rows with primary key and fields
+        """
+        self.fields = fields
+        self.primary_key = primary_key
+        self.rows = []
+        self.loaded = False
+        self._fetch = fetch
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self.loaded:
+                return
+            keys = [dict.get(i, self.primary_key) for i in self.rows]  # bypass GraceDict
+            values = {}
+            for i in self._fetch(keys):
+                values[dict.get(i, self.primary_key)] = i
+            for row in self.rows:
+                found = values.get(dict.get(row, self.primary_key))
+                dict.update(row, {f: dict.get(found, f) if found else None for f in self.fields})
+            self.loaded = True
+
+
+class LazyRow(Row):
+    """Row loading deferred columns on the first access,by row[field],row.get(field) or row.field"""
+
+    def __missing__(self, name):
+        if name in self._loader.fields and not self._loader.loaded:
+            self._loader.load()
+            return dict.__getitem__(self, name)
+        raise KeyError(name)
+
+    def get(self, key, default=None):
+        if key in self._loader.fields and not self._loader.loaded:
+            self._loader.load()
+        return super().get(key, default)
+
+
+class LazyGraceDict(GraceDict):
+    """GraceDict loading deferred columns on the first access,by row[field] or row.get(field)"""
+
+    def __missing__(self, name):
+        if name in self._loader.fields and not self._loader.loaded:
+            self._loader.load()
+            return self[name]
+        return ""
+
+    def get(self, key, default=""):
+        if key in self._loader.fields and not self._loader.loaded:
+            self._loader.load()
+        return super().get(key, default)
+
+
+def lazy_rows(rows, loader, grace_result):
+    """convert rows to lazy rows sharing loader"""
+    row_class = LazyGraceDict if grace_result else LazyRow
+    res = []
+    for i in rows:
+        row = row_class(i)
+        row._loader = loader
+        res.append(row)
+    loader.rows = res
+    return res
+
+
+def load_deferred(rows):
+    """load deferred columns of rows now"""
+    loaders = []
+    for i in rows:
+        loader = getattr(i, "_loader", None)
+        if loader is not None and loader not in loaders:
+            loaders.append(loader)
+    for loader in loaders:
+        loader.load()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Error classification and retry
+
+Every Connection classifies driver exceptions by classify_error:
+
+- CONNECTION_LOST: the connection is broken,it's discarded and reopened on the next statement.
+- DEADLOCK: deadlock,lock wait timeout or serialization failure,the statement is rolled back.
+- TIMEOUT: the statement is cancelled by timeout,QueryTimeoutError is raised instead.
+- STATEMENT: error of the statement itself,like syntax error or duplicate key,
+  the connection is still healthy and kept.
+
+DEADLOCK is retried by RetryPolicy with exponential backoff and jitter,
+CONNECTION_LOST is retried for queries only by default.
+
+**ATTENTION**
+
+If connection is lost after the server committed a write statement,retry will execute it again,
+so execute* statements are not retried on CONNECTION_LOST unless RetryPolicy(retry_writes=True).
+"""
+import functools
+import logging
+import random
+import time
+
+CONNECTION_LOST = "connection_lost"
+DEADLOCK = "deadlock"
+STATEMENT = "statement"
+TIMEOUT = "timeout"
+
+
+class QueryTimeoutError(Exception):
+    """the statement is cancelled because it runs longer than the timeout"""
+
+
+class ResultTooLargeError(Exception):
+    """the result is larger than max_rows or max_bytes of ResultGuard"""
+
+
+class RetryPolicy(object):
+    def __init__(self, max_retries=3, base_delay=0.05, max_delay=2.0, jitter=0.5,
+                 retry_connection_lost=True, retry_writes=False):
+        """
+        :param max_retries: int,max retry times,0 to disable retry
+        :param base_delay: float,seconds to wait before the first retry,doubled for every retry
+        :param max_delay: float,max seconds to wait
+        :param jitter: float,0 to 1,reduce delay by random ratio up to it
+        :param retry_connection_lost: bool,whether to retry queries when connection is lost
+        :param retry_writes: bool,whether to retry writes when connection is lost,
+                             they are executed twice if the server committed them
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retry_connection_lost = retry_connection_lost
+        self.retry_writes = retry_writes
+
+    def should_retry(self, kind, attempt, write=False):
+        if attempt >= self.max_retries:
+            return False
+        if kind == DEADLOCK:  # rolled back,safe to retry
+            return True
+        if kind != CONNECTION_LOST:
+            return False
+        return self.retry_writes if write else self.retry_connection_lost
+
+    def delay(self, attempt):
+        """seconds to wait before retry"""
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return delay * (1 - self.jitter * random.random())
+
+
+def error_code(exception):
+    """return the first int in args of exception,None if not found"""
+    for i in getattr(exception, "args", ()):
+        if isinstance(i, int):
+            return i
+        if isinstance(i, tuple) and i and isinstance(i[0], int):
+            return i[0]
+    return None
+
+
+def retryable(method):
+    """
+    decorator of Connection methods,retry by self.retry_policy
+    when self.classify_error returns DEADLOCK or CONNECTION_LOST,
+    execute* methods are writes
+    """
+    write = method.__name__.startswith("execute")
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return method(self, *args, **kwargs)
+            except Exception as e:
+                kind = self.classify_error(e)
+                if kind == CONNECTION_LOST:
+                    self.close()
+                if not self.retry_policy.should_retry(kind, attempt, write):
+                    raise
+                logging.warning("Retry after {} error:{}".format(kind, e))
+                time.sleep(self.retry_policy.delay(attempt))
+                attempt += 1
+
+    return wrapper
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Fork safety of connections,for pre-fork servers like gunicorn --preload or uwsgi.
+
+A connection opened in the parent process is inherited by the forked children,
+they would share the same socket and corrupt the protocol stream of each other.
+
+Every Connection remembers the pid opened it.In the child process,the inherited
+raw connection is discarded without sending close on the wire (the parent is still using it),
+a new one is opened on the next statement.The socket of the raw connection is replaced by /dev/null
+in the child,so the goodbye sent by the driver when it's closed or garbage collected goes nowhere.
+Raw connections without a known socket (SQLite,MongoDB,pymssql) are kept to never be closed.
+
+Children forked by os.fork are handled by the os.register_at_fork hook,
+children forked by C code (like uwsgi) are found by checking pid before every statement.
+"""
+import os
+import weakref
+
+_connections = weakref.WeakSet()  # all Connection objects in process
+_orphans = []  # raw connections inherited from parent without known socket,kept to never be closed
+
+
+def register(connection):
+    """track connection,it must have _db attribute"""
+    connection._pid = os.getpid()
+    _connections.add(connection)
+
+
+def is_inherited(connection):
+    """whether the connection is opened by parent process"""
+    return getattr(connection, "_pid", None) not in (None, os.getpid())
+
+
+def socket_fileno(raw):
+    """file descriptor of the socket of raw connection,None if unknown"""
+    for obj in (raw, getattr(raw, "_sock", None)):  # psycopg2 has fileno,pymysql has _sock
+        try:
+            return obj.fileno()
+        except Exception:
+            pass
+    return None
+
+
+def detach(raw):
+    """
+    point the socket of raw connection to /dev/null in this process,
+    the socket of parent process is untouched,return False if the socket is unknown
+    """
+    fd = socket_fileno(raw)
+    if fd is None or fd < 0:
+        return False
+    null = os.open(os.devnull, os.O_RDWR)
+    try:
+        os.dup2(null, fd)  # keep fd number taken,the driver closes it later
+    finally:
+        os.close(null)
+    return True
+
+
+def discard(connection):
+    """drop the raw connection inherited from parent process without closing it on the wire"""
+    raw = getattr(connection, "_db", None)
+    if raw is not None:
+        client = getattr(connection, "client", None)  # MongoDB has client
+        if client is not None or not detach(raw):
+            _orphans.append((raw, client))
+        connection._db = None
+    connection._pid = os.getpid()
+
+
+def after_fork_in_child():
+    for connection in list(_connections):
+        discard(connection)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=after_fork_in_child)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Bound the memory of query results.
+
+Pass a ResultGuard to connect,it applies to every query of the connection::
+
+    from saiorm.guard import ResultGuard
+    DB.connect({..., "result_guard": ResultGuard(max_rows=100000, max_bytes=256 * 1024 * 1024, mode="spill")})
+
+When the result is larger than max_rows or max_bytes (estimated):
+
+- raise: saiorm.errors.ResultTooLargeError is raised.
+- truncate: the rows within the limits are returned,the list has truncated=True.
+- spill: the rows beyond the limits are pickled to a temporary file,
+  a SpilledResult is returned.It's re-iterable and sliceable,rows are read by memory-mapped file.
+
+MySQL uses server side cursor when guarded,so the rows are not buffered in client before checking.
+When raised or truncated,the connection is closed to drop the unread rows instead of reading them,
+it's reopened on the next statement.
+PostgreSQL declares SELECT as a named (server side) cursor when guarded,rows are fetched by itersize.
+"""
+import array
+import mmap
+import pickle
+import tempfile
+
+try:
+    from . import utility
+except ImportError:
+    import utility
+
+try:
+    from . import errors
+except ImportError:
+    import errors
+
+Row = utility.Row
+
+MODES = ("raise", "truncate", "spill")
+
+
+def row_size(row):
+    """estimated bytes of a row in memory"""
+    size = 64
+    for v in row:
+        if isinstance(v, (str, bytes, bytearray)):
+            size += 49 + len(v)
+        else:
+            size += 32
+    return size
+
+
+class GuardedList(list):
+    """list of rows,truncated is True if rows beyond the limits are dropped"""
+    truncated = False
+    spilled = False
+
+
+class SpilledResult(object):
+    """
+    Rows in memory and the rest spilled to a temporary file,
+    supports len,iteration,index and slice like list.
+    """
+    truncated = False
+    spilled = True
+
+    def __init__(self, column_names, head, rest, row_class=Row):
+        """
+        :param head: list of row tuples kept in memory
+        :param rest: iterable of row tuples to spill
+        """
+        self.column_names = column_names
+        self.row_class = row_class
+        self._head = head
+        self._offsets = array.array("q")  # start of every spilled row,and end of the last one
+        self._file = tempfile.TemporaryFile(prefix="saiorm_")
+        dump = pickle.Pickler(self._file, pickle.HIGHEST_PROTOCOL)
+        for row in rest:
+            self._offsets.append(self._file.tell())
+            dump.dump(tuple(row))
+            dump.clear_memo()
+        self._offsets.append(self._file.tell())
+        self._file.flush()
+        self._mmap = None
+        if self._offsets[-1]:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self._head) + len(self._offsets) - 1
+
+    def _get(self, index):
+        if index < len(self._head):
+            row = self._head[index]
+        else:
+            index -= len(self._head)
+            row = pickle.loads(self._mmap[self._offsets[index]:self._offsets[index + 1]])
+        return self.row_class(zip(self.column_names, row))
+
+    def __getitem__(self, index):
+        length = len(self)
+        if isinstance(index, slice):
+            return [self._get(i) for i in range(*index.indices(length))]
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("SpilledResult index out of range")
+        return self._get(index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._get(i)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __deepcopy__(self, memo):
+        """copy to a new temporary file,every copy closes its own file"""
+        rest = (pickle.loads(self._mmap[self._offsets[i]:self._offsets[i + 1]])
+                for i in range(len(self._offsets) - 1))
+        return SpilledResult(self.column_names, list(self._head), rest, self.row_class)
+
+    def close(self):
+        """remove the temporary file"""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+    def __del__(self):
+        self.close()
+
+
+class ResultGuard(object):
+    def __init__(self, max_rows=None, max_bytes=None, mode="raise"):
+        """
+        :param max_rows: int,max number of rows in memory
+        :param max_bytes: int,max estimated bytes of rows in memory
+        :param mode: str,raise,truncate or spill
+        """
+        if mode not in MODES:
+            raise ValueError("mode must be one of " + ",".join(MODES))
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.mode = mode
+
+    def collect(self, cursor, column_names):
+        """fetch rows from an executed cursor,return list of Row or SpilledResult"""
+        rows = []
+        size = 0
+        cursor = iter(cursor)
+        for row in cursor:
+            if self.max_bytes:
+                size += row_size(row)
+            if (self.max_rows is not None and len(rows) >= self.max_rows) or (
+                    self.max_bytes and size > self.max_bytes):
+                return self._overflow(column_names, rows, row, cursor)
+            rows.append(row)
+        return GuardedList([Row(zip(column_names, i)) for i in rows])
+
+    def _overflow(self, column_names, rows, row, cursor):
+        if self.mode == "raise":
+            raise errors.ResultTooLargeError("Result is larger than max_rows {} or max_bytes {}".format(
+                self.max_rows, self.max_bytes))
+        if self.mode == "truncate":
+            res = GuardedList([Row(zip(column_names, i)) for i in rows])
+            res.truncated = True
+            return res
+        return SpilledResult(column_names, rows, _chain(row, cursor))
+
+
+def _chain(row, cursor):
+    yield row
+    for i in cursor:
+        yield i
+
+
+def is_select(query):
+    """whether query is SELECT,WITH,VALUES or TABLE after the leading comments,like hints"""
+    query = query.lstrip()
+    while query.startswith("/*") or query.startswith("--"):
+        end = query.find("*/") + 2 if query.startswith("/*") else query.find("\n") + 1
+        if end <= 1:
+            return False
+        query = query[end:].lstrip()
+    words = query.split(None, 1)
+    return bool(words) and words[0].upper() in ("SELECT", "WITH", "VALUES", "TABLE")
+
+
+def collect(result_guard, cursor):
+    """
+    fetch rows from an executed cursor by result_guard,without limit if it's None
+
+    :return: tuple,column names and rows
+    """
+    column_names = [d[0] for d in cursor.description]
+    if result_guard is None:
+        return column_names, [Row(zip(column_names, row)) for row in cursor]
+    return column_names, result_guard.collect(cursor, column_names)
+
+
+def convert_rows(data, row_class):
+    """convert rows to row_class,keep truncated flag and do not load spilled rows"""
+    if isinstance(data, SpilledResult):
+        data.row_class = row_class
+        return data
+    res = [row_class(i) for i in data]
+    if isinstance(data, GuardedList):
+        res = GuardedList(res)
+        res.truncated = data.truncated
+    return res
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Parallel range scan of a large table,used by ChainDB.parallel_scan.
+
+The key range is split into chunks,every chunk is selected on its own connection in a thread pool::
+
+    for rows in DB.table("log").where({"level": "error"}).parallel_scan("id, message", workers=8):
+        handle(rows)
+
+Batches are yielded as they complete,pass ordered=True to get them in key order.
+Only workers * 2 chunks are pending at the same time,a slow consumer does not fill the memory.
+Every worker thread closes its own connection when the scan is finished or the generator is closed.
+
+For CPU-heavy consumers,hand the yielded batches to a process pool,
+connections can not be shared between processes.
+"""
+import collections
+import math
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from queue import Queue
+
+
+def split_range(low, high, count, chunk_rows):
+    """
+    split integer key range [low, high] to chunks of about chunk_rows rows,
+    assuming the rows are distributed evenly
+
+    :param count: int,number of rows in the range
+    :return: list of tuple,start and end of every chunk,end is exclusive
+    """
+    chunks = max(1, int(math.ceil(count / float(chunk_rows))))
+    width = max(1, int(math.ceil((high - low + 1) / float(chunks))))
+    return [(start, min(start + width, high + 1)) for start in range(low, high + 1, width)]
+
+
+def run_parallel(func, tasks, workers, ordered=False, finalize=None):
+    """
+    call func with every task in a pool of worker threads,yield the results
+
+    :param ordered: bool,yield in order of tasks,otherwise as they complete
+    :param finalize: function,called in every worker thread when finished or the generator is closed,
+        to release the resources of that thread,like its connection
+    """
+    tasks = iter(tasks)
+    queue = Queue()  # tuple of future and task,None to stop a worker
+    pending = collections.deque()
+
+    def work():
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    return
+                future, task = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(func(task))
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            if finalize is not None:
+                finalize()
+
+    threads = [threading.Thread(target=work, name="saiorm-scan") for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    def submit():
+        for task in tasks:
+            future = Future()
+            pending.append(future)
+            queue.put((future, task))
+            return True
+        return False
+
+    try:
+        for _ in range(workers * 2):
+            if not submit():
+                break
+
+        while pending:
+            if ordered:
+                future = pending.popleft()
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                future = done.pop()
+                pending.remove(future)
+            submit()
+            yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        for _ in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Scatter-gather,run the same chain on many databases concurrently and merge the results.
+
+Usage::
+
+    tenants = saiorm.scatter.MultiDB([DB1, DB2, DB3], names=["a", "b", "c"], timeout=5)
+    rows = tenants.table("order").where({"status": 1}).order_by("amount DESC").limit(10).select()
+    total = tenants.table("order").where({"status": 1}).sum("amount")
+    tenants.errors  # {"b": QueryTimeoutError(...)},sources failed in the last call
+
+Merging:
+
+- select: concatenated,k-way merged by order_by if set,limit is applied to the merged result.
+- pluck: concatenated in order of sources,limit is applied by every source.
+- count,sum: added, min/max: min/max of the sources, avg: sum of sources divided by count of sources.
+- exists: whether any source has.
+
+Failed sources are left out of the result and reported in errors,
+pass raise_error=True to raise ScatterError instead.
+
+Every source has its own thread,a source timed out in the last call
+runs the next statement after the previous one finished or was cancelled.
+"""
+import functools
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait
+
+CHAIN_METHODS = ("table", "where", "order_by", "group_by", "limit", "join", "inner_join", "left_join",
+                 "right_join", "timeout", "hint")
+
+
+class ScatterError(Exception):
+    def __init__(self, errors):
+        super().__init__("Failed on " + ", ".join([str(i) for i in errors]))
+        self.errors = errors  # source name and exception
+
+
+def parse_order_by(order_by):
+    """return list of tuple,field name and bool of descending"""
+    keys = []
+    for i in order_by.split(","):
+        parts = i.strip().split()
+        if parts:
+            keys.append((parts[0].split(".")[-1], len(parts) > 1 and parts[1].lower() == "desc"))
+    return keys
+
+
+def parse_limit(limit):
+    """return tuple,offset and number of rows"""
+    limit = str(limit)
+    if "," in limit:
+        offset, rownumber = limit.split(",")
+        return int(offset), int(rownumber)
+    return 0, int(limit)
+
+
+def compare_rows(keys, a, b):
+    """compare rows by keys of parse_order_by,NULL is the smallest"""
+    for field, desc in keys:
+        x = dict.get(a, field)  # bypass GraceDict,it returns "" for NULL
+        y = dict.get(b, field)
+        if x == y:
+            continue
+        if x is None:
+            res = -1
+        elif y is None:
+            res = 1
+        else:
+            res = -1 if x < y else 1
+        return -res if desc else res
+    return 0
+
+
+class MultiDB(object):
+    def __init__(self, dbs, names=None, timeout=None, raise_error=False):
+        """
+        :param dbs: list of ChainDB,connected
+        :param names: list,names of sources in errors,index by default
+        :param timeout: float,seconds,cancel the statement and give up the source after it
+        :param raise_error: bool,raise ScatterError when any source failed
+        """
+        self.dbs = list(dbs)
+        self.names = list(names) if names else list(range(len(self.dbs)))
+        self.timeout = timeout
+        self.raise_error = raise_error
+        self.errors = {}  # sources failed in the last call
+        self._calls = []  # chain calls to replay on every source
+        # one thread for every source,statements on the same source never run concurrently
+        self._executors = [ThreadPoolExecutor(max_workers=1) for _ in self.dbs]
+
+    def __getattr__(self, name):
+        if name not in CHAIN_METHODS:
+            raise AttributeError(name)
+
+        def chain(*args, **kwargs):
+            self._calls.append((name, args, kwargs))
+            return self
+
+        return chain
+
+    def _get_call(self, name):
+        """return args of the last chain call with name,None if not called"""
+        for i in reversed(self._calls):
+            if i[0] == name:
+                return i[1]
+        return None
+
+    def gather(self, func):
+        """
+        replay the chain on every source and call func with it concurrently
+
+        :return: list of results of the successful sources
+        """
+        calls, self._calls = self._calls, []
+
+        def run(db):
+            for name, args, kwargs in calls:
+                getattr(db, name)(*args, **kwargs)
+            if self.timeout:
+                db.timeout(self.timeout)
+            return func(db)
+
+        futures = [executor.submit(run, db) for executor, db in zip(self._executors, self.dbs)]
+        wait(futures, timeout=self.timeout)
+
+        results = []
+        self.errors = {}
+        for name, future in zip(self.names, futures):
+            if not future.done():
+                self.errors[name] = TimeoutError("Source does not return in {} seconds".format(self.timeout))
+            elif future.exception() is not None:
+                self.errors[name] = future.exception()
+            else:
+                results.append(future.result())
+        if self.errors and self.raise_error:
+            raise ScatterError(self.errors)
+        return results
+
+    def _merge_rows(self, func):
+        order_by = self._get_call("order_by")
+        limit = self._get_call("limit")
+        offset = rownumber = None
+        if limit:
+            offset, rownumber = parse_limit(limit[0])
+            if offset:  # every source returns the rows before offset too
+                self._calls.append(("limit", (offset + rownumber,), {}))
+
+        results = self.gather(func)
+        if order_by:
+            key = functools.cmp_to_key(functools.partial(compare_rows, parse_order_by(order_by[0])))
+            rows = heapq.merge(*results, key=key)
+        else:
+            rows = itertools.chain(*results)
+        if limit:
+            return list(itertools.islice(rows, offset, offset + rownumber))
+        return list(rows)
+
+    def select(self, fields="*"):
+        return self._merge_rows(lambda db: db.select(fields))
+
+    def pluck(self, field):
+        return list(itertools.chain(*self.gather(lambda db: db.pluck(field))))
+
+    def count(self, field="*"):
+        return sum(self.gather(lambda db: db.count(field)))
+
+    def sum(self, field):
+        values = [i for i in self.gather(lambda db: db.sum(field)) if i is not None]
+        return sum(values) if values else None
+
+    def min(self, field):
+        values = [i for i in self.gather(lambda db: db.min(field)) if i is not None]
+        return min(values) if values else None
+
+    def max(self, field):
+        values = [i for i in self.gather(lambda db: db.max(field)) if i is not None]
+        return max(values) if values else None
+
+    def avg(self, field):
+        def sum_count(db):
+            condition = db._save_condition()
+            total = db.sum(field)
+            db._restore_condition(condition)
+            return total or 0, db.count(field)
+
+        results = self.gather(sum_count)
+        count = sum([i[1] for i in results])
+        return sum([i[0] for i in results]) / count if count else None
+
+    def exists(self):
+        return any(self.gather(lambda db: db.exists()))
+
+    def close(self):
+        for executor in self._executors:
+            executor.shutdown(wait=False)
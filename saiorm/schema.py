@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Schema metadata shared by all ChainDB instances in the process.
+
+Each database is loaded with bulk queries (information_schema, pg_catalog,
+sqlite_master etc.),the result is cached by database key until invalidated or expired by ttl.
+A table not in the loaded database is cached as missing too,it's not reloaded on every lookup,
+invalidate it after creating the table.
+
+A table schema is a Row like::
+
+    {
+        "columns": ["id", "name"],  # by ordinal position
+        "types": {"id": "int", "name": "varchar"},
+        "nullable": {"id": False, "name": True},
+        "primary_key": ["id"],
+        "indexes": {"idx_name": {"columns": ["name"], "unique": False}}
+    }
+
+Set a path to persist loaded schemas in a JSON file,it will be loaded on the next start::
+
+    saiorm.schema.schema_cache.set_path("/tmp/saiorm_schema.json")
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    from . import utility
+except ImportError:
+    import utility
+
+Row = utility.Row
+
+# integer types of MySQL,PostgreSQL (udt_name),SQL Server and SQLite
+INTEGER_TYPES = frozenset(["int", "integer", "bigint", "smallint", "mediumint", "tinyint",
+                           "int2", "int4", "int8", "serial", "bigserial", "smallserial", "unsigned big int"])
+
+
+def is_integer_type(data_type):
+    """whether data_type in schema is an integer type,tinyint(1) is boolean"""
+    data_type = (data_type or "").lower().strip()
+    if data_type.startswith("tinyint(1)"):
+        return False
+    name = data_type.split("(")[0].strip()
+    for suffix in (" unsigned", " signed", " zerofill"):
+        name = name.replace(suffix, "")
+    return name in INTEGER_TYPES
+
+
+def build_tables(columns, indexes):
+    """
+    build table schemas from rows of the bulk queries
+
+    :param columns: rows with table_name, column_name, data_type, is_nullable, is_primary,
+        ordered by table_name and ordinal position
+    :param indexes: rows with table_name, index_name, column_name, is_unique,
+        ordered by table_name, index_name and position in index
+    :return: dict,table name and schema
+    """
+    tables = {}
+    for c in columns:
+        table = tables.setdefault(c["table_name"], new_table())
+        name = c["column_name"]
+        table["columns"].append(name)
+        table["types"][name] = (c["data_type"] or "").lower()
+        table["nullable"][name] = str(c["is_nullable"]).upper() in ("YES", "1", "TRUE")
+        if c["is_primary"] and int(c["is_primary"]):
+            table["primary_key"].append(name)
+
+    for i in indexes:
+        table = tables.get(i["table_name"])
+        if table is None:
+            continue
+        index = table["indexes"].setdefault(i["index_name"], {
+            "columns": [],
+            "unique": bool(i["is_unique"] and int(i["is_unique"]))
+        })
+        index["columns"].append(i["column_name"])
+
+    return tables
+
+
+def new_table():
+    return Row(columns=[], types={}, nullable={}, primary_key=[], indexes={})
+
+
+class SchemaCache(object):
+    """Thread safe schema cache,keyed by database"""
+
+    def __init__(self, path=None, ttl=None):
+        """
+        :param ttl: float,seconds to reload a database,never expired if None
+        """
+        self.path = None
+        self.ttl = ttl
+        self._schemas = {}  # database key -> {table name: schema}
+        self._loaded_time = {}  # database key -> time loaded
+        self._stale = {}  # database key -> table names invalidated,reload on the next lookup
+        self._lock = threading.Lock()
+        if path:
+            self.set_path(path)
+
+    def set_path(self, path):
+        """set the file to persist schemas,load it if exists"""
+        self.path = path
+        if not path:
+            return
+        if not os.path.exists(path):
+            self.dump()
+        else:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    data = json.load(f)
+            except (IOError, ValueError):
+                logging.warning("Cannot load saiorm schema cache from " + path)
+                return
+            with self._lock:
+                for key, tables in data.items():
+                    self._schemas[key] = {k: Row(v) for k, v in tables.items()}
+                    self._loaded_time[key] = time.time()
+
+    def get(self, key):
+        """return all table schemas of the database,None when not loaded or expired"""
+        with self._lock:
+            if self.ttl is not None and time.time() - self._loaded_time.get(key, 0) > self.ttl:
+                return None
+            return self._schemas.get(key)
+
+    def is_stale(self, key, table):
+        """whether table is invalidated after the database is loaded"""
+        return table in self._stale.get(key, ())
+
+    def set(self, key, tables):
+        with self._lock:
+            self._schemas[key] = tables
+            self._loaded_time[key] = time.time()
+            self._stale.pop(key, None)
+        self.dump()
+
+    def invalidate(self, key=None, table=None):
+        """
+        invalidate cached schemas
+
+        :param key: database key,invalidate all databases if empty
+        :param table: table name,invalidate the whole database if empty
+        """
+        with self._lock:
+            if key is None:
+                self._schemas.clear()
+                self._stale.clear()
+            elif table is None:
+                self._schemas.pop(key, None)
+                self._stale.pop(key, None)
+            elif key in self._schemas:
+                self._schemas[key].pop(table, None)
+                self._stale.setdefault(key, set()).add(table)
+        self.dump()
+
+    def dump(self):
+        """write schemas to self.path"""
+        if not self.path:
+            return
+        with self._lock:
+            data = json.dumps(self._schemas)
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError):
+            logging.warning("Cannot write saiorm schema cache to " + self.path)
+
+
+schema_cache = SchemaCache()  # shared in process
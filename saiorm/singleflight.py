@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Single-flight deduplication of concurrent identical reads.
+
+Callers with the same key wait on the first in-flight call and share its result,
+instead of executing the same query again.
+
+ChainDB uses the shared group when initialized with single_flight=True::
+
+    DB = saiorm.init(single_flight=True)
+
+asyncio callers could await do_async,the function is executed in the default executor
+and coalesced with the thread callers too::
+
+    res, shared = await saiorm.singleflight.group.do_async(key, func)
+
+When a result is shared,every caller gets its own deep copy,so a caller changing its rows
+never affects the others.Nothing is copied when no call is coalesced.
+"""
+import copy
+import threading
+
+
+class Call(object):
+    """one in-flight call"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0  # number of callers waiting for it
+
+
+class SingleFlight(object):
+    def __init__(self):
+        self.calls = 0  # number of all calls
+        self.coalesced = 0  # number of calls shared the result of another call
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """
+        execute func,or wait for the in-flight call with the same key
+
+        :return: tuple,result and bool of whether it's shared from another call
+        """
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            if call is None:
+                call = Call()
+                self._calls[key] = call
+                leader = True
+            else:
+                self.coalesced += 1
+                call.waiters += 1
+                leader = False
+
+        if leader:
+            result = None
+            try:
+                result = call.result = func()
+            except Exception as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                    waiters = call.waiters  # no more waiters after popped
+                if waiters and call.error is None:
+                    result = copy.deepcopy(call.result)  # call.result is kept unchanged for the waiters
+                call.event.set()
+            return result, False
+
+        call.event.wait()
+        if call.error is not None:
+            raise call.error
+        return copy.deepcopy(call.result), True
+
+    async def do_async(self, key, func):
+        """same as do,func is executed in the default executor of running loop"""
+        import asyncio  # slow to import,most callers never use it
+        loop = asyncio.get_running_loop()
+        async_key = (id(loop), key)
+        waiting = self._async_calls.get(async_key)
+        if waiting is not None:
+            with self._lock:
+                self.calls += 1
+                self.coalesced += 1
+            waiting[1] += 1
+            result, shared = await asyncio.shield(waiting[0])
+            return copy.deepcopy(result), True
+
+        future = loop.create_future()
+        waiting = [future, 0]  # future and number of waiters
+        self._async_calls[async_key] = waiting
+        try:
+            result = await loop.run_in_executor(None, self.do, key, func)
+        except Exception as e:
+            self._async_calls.pop(async_key, None)
+            future.set_exception(e)
+            future.exception()  # mark retrieved if nobody is waiting
+            raise
+        self._async_calls.pop(async_key, None)
+        future.set_result(result)
+        if waiting[1]:  # the waiters copy from the result in future
+            result = (copy.deepcopy(result[0]), result[1])
+        return result
+
+    def stats(self):
+        """return dict of calls, coalesced, in_flight"""
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._calls)
+        }
+
+
+group = SingleFlight()  # shared in process
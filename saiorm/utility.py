@@ -1,5 +1,9 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
+import collections
+import importlib
+import logging
+import threading
 
 
 class Row(dict):
@@ -42,6 +46,90 @@ class GraceDict(dict):
             return ""
 
 
+class LRUCache(object):
+    """Thread safe dict with bounded size,drop the least recently used item when full."""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """return dict of hits, misses, size, maxsize"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data),
+            "maxsize": self.maxsize
+        }
+
+
+class LazyModule(object):
+    """Import the module on first attribute access,keep import of saiorm fast."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, name):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, name)
+
+
+class Watchdog(object):
+    """Call func in another thread after seconds,unless stopped before."""
+
+    def __init__(self, seconds, func):
+        self.fired = False
+        self._active = True
+        self._lock = threading.Lock()  # stop waits for the running func
+        self._timer = threading.Timer(seconds, self._fire, args=(func,))
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _fire(self, func):
+        with self._lock:
+            if not self._active:
+                return
+            self.fired = True
+            try:
+                func()
+            except Exception:
+                logging.warning("Watchdog failed to call " + repr(func), exc_info=True)
+
+    def stop(self):
+        with self._lock:
+            self._active = False
+        self._timer.cancel()
+
+
 def is_array(obj):
     return isinstance(obj, tuple) or isinstance(obj, list)
 
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Write-behind inserts,for logs and events inserted one line at a time.
+
+Lines are queued and inserted by ChainDB.insert_many in a background thread,
+batch_size lines in one batch,or the lines queued within interval seconds::
+
+    events = saiorm.writer.BatchWriter(DB, "event", batch_size=1000, interval=0.5)
+    events.insert({"kind": "click", "user_id": 1})
+    future = events.insert({"kind": "order", "user_id": 1}, return_id=True)
+    future.result()["lastrowid"]
+    events.close()  # insert the queued lines and stop,called at exit too
+
+insert blocks when max_queue lines are queued (backpressure),pass timeout to raise queue.Full instead.
+
+Every insert returns a concurrent.futures.Future,its result is a dict like insert returns,
+or it raises the error of the line.
+
+- In MySQL,lines with the same fields in a row are inserted in one batch by one multiple-row INSERT,
+  it's all or nothing,a batch failed by a bad line is retried line by line,so only the bad line fails.
+- In other databases,insert_many runs line by line out of a transaction,a failed line would leave
+  the lines before it inserted,so every line is inserted alone and gets its own result.
+- A statement failed by DEADLOCK is retried by retry_policy of the writer,the statement retry of the
+  connection is disabled so retries do not multiply.Statements failed by CONNECTION_LOST are retried
+  only if retry_policy has retry_writes=True,the lines could be inserted twice
+  if the connection is lost after the server committed them.
+- lastrowid of the lines in a MySQL batch is lastrowid of the batch plus the index,only if
+  consecutive ids are verified (innodb_autoinc_lock_mode 0 or 1 and auto_increment_increment 1),
+  otherwise it's 0 and lines with return_id=True are inserted alone.
+- If the process is killed or crashes,the queued lines are lost.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+try:
+    from . import errors
+except ImportError:
+    import errors
+
+
+class BatchWriter(object):
+    def __init__(self, db, table, batch_size=1000, interval=0.5, max_queue=10000, retry_policy=None):
+        """
+        :param db: ChainDB,cloned for the background thread
+        :param table: str,table name
+        :param batch_size: int,max lines in one insert_many
+        :param interval: float,seconds to wait for more lines after the first line of a batch
+        :param max_queue: int,insert blocks when queue is full
+        :param retry_policy: errors.RetryPolicy,retry of failed batches,wait longer than retry of statements
+        """
+        self.db = db.clone()
+        self.db.db.retry_policy = errors.RetryPolicy(max_retries=0)  # retried by the writer only
+        self.table = table
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retry_policy = retry_policy or errors.RetryPolicy(max_retries=5, base_delay=0.5, max_delay=30)
+        self._consecutive_ids = None  # checked in the background thread on the first batch
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._closed = False
+        # all writes are in this thread,the cloned connection is used by one thread only
+        self._thread = threading.Thread(target=self._run, name="saiorm-writer")
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def insert(self, dict_data, return_id=False, timeout=None):
+        """
+        queue one line
+
+        :param return_id: bool,lastrowid of the line is needed
+        :param timeout: float,seconds to wait when queue is full,then raise queue.Full,wait forever if None
+        :return: Future
+        """
+        future = Future()
+        with self._lock:  # never after the stop mark of close
+            if self._closed:
+                raise RuntimeError("BatchWriter is closed")
+            self._queue.put((dict_data, return_id, future), timeout=timeout)
+        return future
+
+    def qsize(self):
+        """number of queued lines"""
+        return self._queue.qsize()
+
+    def flush(self):
+        """wait until the queued lines are inserted"""
+        self._queue.join()
+
+    def close(self, timeout=None):
+        """insert the queued lines and stop the background thread"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)  # after the queued lines
+        atexit.unregister(self.close)
+        self._thread.join(timeout)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            items = [item]
+            deadline = time.time() + self.interval
+            while len(items) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.task_done()
+                    stop = True
+                    break
+                items.append(item)
+
+            try:
+                self._write(items)
+            except Exception as e:  # keep the thread alive
+                logging.error("Error on writing batch:" + str(e))
+                for i in items:
+                    if not i[2].done():
+                        i[2].set_exception(e)
+            for _ in items:
+                self._queue.task_done()
+        self.db.db.close()
+
+    def _write(self, items):
+        items = [i for i in items if i[2].set_running_or_notify_cancel()]  # skip cancelled
+        if not self.db.insert_many_in_one_statement:  # insert_many is not atomic
+            for item in items:
+                self._insert_one(item)
+            return
+
+        if self._consecutive_ids is None:
+            self._consecutive_ids = self.db.consecutive_insert_ids()
+        batch = []
+        for item in items:
+            if batch and list(batch[0][0].keys()) != list(item[0].keys()):
+                self._insert_batch(batch)
+                batch = []
+            if item[1] and not self._consecutive_ids:  # lastrowid is needed
+                if batch:  # keep the order of lines
+                    self._insert_batch(batch)
+                    batch = []
+                self._insert_one(item)
+            else:
+                batch.append(item)
+        if batch:
+            self._insert_batch(batch)
+
+    def _retry(self, func):
+        """call func,retry by retry_policy,the only retry of the statements of writer"""
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except Exception as e:
+                kind = self.db.db.classify_error(e)
+                if not self.retry_policy.should_retry(kind, attempt, write=True):
+                    raise
+                logging.warning("Retry insert after {} error:{}".format(kind, e))
+                time.sleep(self.retry_policy.delay(attempt))
+                attempt += 1
+
+    def _insert_batch(self, batch):
+        try:
+            res = self._retry(lambda: self.db.table(self.table).insert_many([i[0] for i in batch]))
+        except Exception as e:
+            if self.db.db.classify_error(e) == errors.STATEMENT and len(batch) > 1:
+                for i in batch:  # one statement,nothing is inserted,find the bad line
+                    self._insert_one(i)
+                return
+            logging.error("Error on inserting {} lines to {}:{}".format(len(batch), self.table, e))
+            for i in batch:
+                i[2].set_exception(e)
+            return
+
+        first_id = res["lastrowid"] if self._consecutive_ids else None
+        for index, i in enumerate(batch):
+            i[2].set_result({
+                "lastrowid": first_id + index if first_id else 0,  # the primary key id affected
+                "rowcount": 1,  # number of rows affected
+                "rownumber": 0,  # line number
+                "query": res["query"]  # query executed
+            })
+
+    def _insert_one(self, item):
+        try:
+            item[2].set_result(self._retry(lambda: self.db.table(self.table).insert(item[0])))
+        except Exception as e:
+            logging.error("Error on inserting to {}:{}".format(self.table, e))
+            item[2].set_exception(e)
@@ -38,4 +38,8 @@ setup(
         'Topic :: Database',
     ],
     install_requires=requirements,
+    extras_require={
+        "arrow": ["pyarrow"],
+        "pandas": ["pandas"],
+    },
 )
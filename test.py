@@ -27,12 +27,28 @@ def test(DB, table):
     print(DB.last_query)
     # raise
 
+    res = table.where({"a": 1}).count()
+    # print(res)
+    print(DB.last_query)
+
+    res = table.where({"a": 1}).exists()
+    # print(res)
+    print(DB.last_query)
+
+    res = table.where({"a": 1}).max("b")
+    # print(res)
+    print(DB.last_query)
+
+    res = table.order_by("id DESC").limit(3).pluck("a")
+    # print(res)
+    print(DB.last_query)
+
     res = table.where({
         "a": 1,
         "b": ("BETWEEN", "1", "2"),
         "c": ("`ABS(?)", "2"),
         "d": ("!=", 0),
-        "e": ("IN", ["1", "2", "3"]),
+        "e": ("IN", [1, 2, 3]),
         "f": "`ABS(-2)",
     }).select("e,f")
     # print(res)
@@ -43,14 +59,14 @@ def test(DB, table):
         "b": ("OR", "BETWEEN", "1", "2"),
         "c": ("OR", "`ABS(?)", "2"),
         "d": ("OR", "IS NOT", "NULL"),
-        "e": ("NOT IN", ["1", "2", "3"]),
+        "e": ("NOT IN", [1, 2, 3]),
         "f": "`ABS(-2)",
     }).select("e,f")
     # print(res)
     print(DB.last_query)
 
     res = table.where({
-        "a": ("IN", ["1", "2", "3"]),
+        "a": ("IN", [1, 2, 3]),
         "b": ("`ABS(?)", "2"),
     }).update({
         "c": "`ABS(2)",
@@ -60,6 +76,17 @@ def test(DB, table):
     # print(res)
     print(DB.last_query)
 
+    res = table.where({"c": 1}).update_many([{
+        "id": 1,
+        "a": "1",
+    }, {
+        "id": 2,
+        "a": "3",
+        "b": ("`ABS(?)", 3),
+    }], key="id")
+    # print(res)
+    print(DB.last_query)
+
     res = table.insert({
         "a": "1",
         "b": "2",
@@ -100,6 +127,26 @@ def test(DB, table):
     # print(res)
     print(DB.last_query)
 
+    res = table.upsert({
+        "id": 1,
+        "a": "1",
+        "b": "2",
+    }, conflict_keys=["id"])
+    # print(res)
+    print(DB.last_query)
+
+    res = table.upsert_many([{
+        "id": 1,
+        "a": "1",
+        "b": "2",
+    }, {
+        "id": 2,
+        "a": "3",
+        "b": "4",
+    }], conflict_keys=["id"], update_fields=["a"])
+    # print(res)
+    print(DB.last_query)
+
     res = table.where({
         "a": "1",
         "b": "2",
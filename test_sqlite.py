@@ -0,0 +1,990 @@
+# !/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Tests run against SQLite,no server needed.
+
+    python -m pytest -q test_sqlite.py
+    python test_sqlite.py
+"""
+import asyncio
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import types
+
+import saiorm
+from saiorm import schema
+
+
+def connect(path=":memory:", **kwargs):
+    DB = saiorm.init(driver="SQLite")
+    config = {"host": path}
+    config.update(kwargs)
+    DB.connect(config, return_query=True)
+    return DB
+
+
+def create_xxx(DB, rows=0):
+    DB.execute("CREATE TABLE xxx (id INTEGER PRIMARY KEY, a INTEGER, b TEXT)")
+    if rows:
+        DB.table("xxx").insert_many([{"a": i % 5, "b": str(i)} for i in range(1, rows + 1)])
+    DB.invalidate_schema()
+    return DB.table("xxx")
+
+
+def share_memory_db(DB):
+    """open the in-memory database of a background thread's clone for the test thread too"""
+    DB.db._db = sqlite3.connect(":memory:", check_same_thread=False)
+
+
+def test_schema_cache():
+    DB = connect()
+    table = create_xxx(DB)
+    assert table.get_primary_key() == ["id"]
+    assert table.get_fields_name() == ["id", "a", "b"]
+    assert DB.get_schema("xxx x")["columns"] == ["id", "a", "b"]  # alias
+
+    # a missing table is not reloaded on every lookup
+    loads = []
+    load_schema = DB.load_schema
+    DB.load_schema = lambda: loads.append(1) or load_schema()
+    assert DB.get_schema("yyy") is None
+    assert DB.get_schema("yyy") is None
+    assert DB.get_schema("xxx") is not None
+    assert not loads
+
+    DB.execute("CREATE TABLE yyy (id INTEGER PRIMARY KEY)")
+    DB.invalidate_schema("yyy")
+    assert DB.get_schema("yyy")["primary_key"] == ["id"]
+    assert len(loads) == 1
+
+    # every in-memory database has its own cache
+    assert connect().get_schema_key() != DB.get_schema_key()
+
+
+def test_schema_cache_ttl():
+    cache = schema.SchemaCache(ttl=0)
+    cache.set("k", {"t": schema.new_table()})
+    assert cache.get("k") is None
+    cache.ttl = None
+    assert "t" in cache.get("k")
+    cache.invalidate("k", "t")
+    assert cache.is_stale("k", "t")
+
+
+def test_upsert():
+    table = create_xxx(connect(), rows=2)
+    table.upsert({"id": 1, "a": 10, "b": "x"})
+    table.upsert_many([{"id": 2, "a": 20, "b": "y"}, {"id": 3, "a": 30, "b": "z"}], update_fields=["a"])
+    table.upsert({"id": 3, "a": 0, "b": "w"}, update_fields={"a": "`a+1"})
+    rows = {i["id"]: (i["a"], i["b"]) for i in table.order_by("id").select()}
+    assert rows == {1: (10, "x"), 2: (20, "2"), 3: (31, "z")}
+
+
+class FakeMongoConnection(object):
+    """record the requests of upsert and the conditions of exists"""
+
+    def __init__(self):
+        self.condition = {}
+        self.requests = None
+        self.conditions = []
+
+    def upsert(self, requests):
+        self.requests = requests
+        return {"lastrowid": 0, "rowcount": len(requests), "rownumber": 0, "query": ""}
+
+    def exists(self):
+        self.conditions.append(self.condition)
+        return {"data": True, "query": ""}
+
+
+def test_upsert_mongodb_requests():
+    DB = saiorm.init(driver="MongoDB")
+    DB.db = FakeMongoConnection()
+    DB.table("xxx").upsert({"_id": 1})
+    assert DB.db.requests == [({"_id": 1}, {"$setOnInsert": {"_id": 1}})]
+
+    DB.table("xxx").upsert({"_id": 1, "a": 1, "b": 2}, update_fields={"a": 5, "$inc": {"n": 1}})
+    assert DB.db.requests == [({"_id": 1}, {"$set": {"a": 5}, "$inc": {"n": 1}, "$setOnInsert": {"b": 2}})]
+
+    DB.table("xxx").upsert({"_id": 1, "a": 1, "b": 2}, update_fields=["a"])
+    assert DB.db.requests == [({"_id": 1}, {"$set": {"a": 1}, "$setOnInsert": {"b": 2}})]
+
+def test_batch():
+    DB = connect()
+    table = create_xxx(DB, rows=3)
+    with DB.batch():
+        first = table.where({"id": 1}).get()
+        rows = table.order_by("id").select("id")
+        bad = DB.table("no_such_table").select()
+        update = DB.table("xxx").where({"id": 2}).update({"b": "x"})
+        DB.table("xxx").insert({"a": 1, "b": "4"})
+        assert isinstance(first, saiorm.batch.BatchItem)
+    assert first.result()["b"] == "1"
+    assert [i["id"] for i in rows.result()] == [1, 2, 3]
+    assert update.result()["rowcount"] == 1
+    try:
+        bad.result()
+        raise AssertionError("error of the statement is not raised")
+    except sqlite3.OperationalError:
+        pass
+    assert DB.table("xxx").count() == 4  # error of one statement does not stop the others
+
+class FakeCursor(object):
+    """record the executed statements"""
+    lastrowid = 0
+    rowcount = 1
+    description = [("id",)]
+
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, query, parameters):
+        self.executed.append(query)
+
+    def __iter__(self):
+        return iter([])
+
+    def close(self):
+        pass
+
+
+def test_position_db_statement_cache():
+    from saiorm.MySQL import PositionDB
+    db = PositionDB("127.0.0.1", 3306, "x", prefix="p_", statement_cache_size=4)
+    cursor = FakeCursor()
+    db._cursor = lambda: cursor
+    for _ in range(2):
+        db.insert("user", "id, name", 1, "a")
+    assert cursor.executed == ["INSERT INTO p_user (id,name) VALUES (%s,%s)"] * 2
+    assert db.cache_info()["misses"] == 1 and db.cache_info()["hits"] == 1  # one lookup for every insert
+
+    for i in range(5):  # raw queries are replaced without caching,they never evict the generated ones
+        db.query("SELECT * FROM ###user WHERE id={}".format(i))
+    assert cursor.executed[-1] == "SELECT * FROM p_user WHERE id=4"
+    db.insert("user", "id, name", 1, "a")
+    assert db.cache_info()["misses"] == 1 and db.cache_info()["hits"] == 2
+
+    assert db.mk_select_query("user", "id", "") == db.mk_select_query("user", "id", "") == "SELECT id FROM p_user "
+
+def test_aggregate():
+    DB = connect()
+    table = create_xxx(DB, rows=10)
+    assert table.where({"a": 1}).count() == 2
+    assert table.where({"a": 9}).exists() is False
+    assert table.where({"a": 1}).exists() is True
+    assert table.max("id") == 10
+    assert table.where({"a": 1}).avg("id") == 3.5
+    assert table.order_by("id DESC").limit(3).pluck("b") == ["10", "9", "8"]
+
+    # a failed statement does not leak its conditions
+    try:
+        table.where({"a": 1}).count("no_such_field")
+    except Exception:
+        pass
+    assert table.count() == 10
+
+    # executed by the common query path,so they are collected in batch
+    with DB.batch():
+        count = table.where({"a": 1}).count()
+        exists = table.inner_join("yyy").exists()
+        pluck = table.order_by("id").limit(2).pluck("id")
+    assert count.result() == 2
+    assert "INNER JOIN yyy" in exists.sql
+    assert pluck.result() == [1, 2]
+
+def test_in_chunks():
+    DB = connect()
+    table = create_xxx(DB, rows=2000)
+    ids = list(range(1, 1501)) + [1, 2]  # longer than max_params,with duplicates
+    assert len(table.where({"id": ("IN", ids)}).select("id")) == 1500
+    assert table.where({"id": ("IN", ids)}).count() == 1500
+    assert table.where({"id": ("IN", ids)}).exists() is True
+    assert table.where({"id": ("IN", ids)}).max("id") == 1500
+    assert table.where({"id": ("IN", ids)}).sum("id") == 1500 * 1501 // 2
+    assert table.where({"id": ("IN", ids)}).avg("id") == 1501 / 2.0  # weighted by counts of chunks
+    assert table.where({"id": ("IN", ids + [5000]), "b": ("<>", "7")}).avg("id") == (1500 * 1501 // 2 - 7) / 1499.0
+    assert table.where({"id": ("IN", list(range(3001, 4002)))}).avg("id") is None
+    assert len(table.where({"id": ("IN", ids)}).pluck("id")) == 1500
+    assert table.where({"id": ("IN", ids)}).update({"b": "x"})["rowcount"] == 1500
+    assert table.where({"id": ("IN", ids), "a": 0}).increase("a", 10)["rowcount"] == 300
+    assert table.where({"id": ("IN", ids)}).delete()["rowcount"] == 1500
+    assert table.count() == 500
+
+    # NOT IN can not be split,it's stopped before sent
+    try:
+        table.where({"id": ("NOT IN", ids)}).count()
+        raise AssertionError("too many params are sent")
+    except ValueError:
+        pass
+    assert table.count() == 500
+
+def test_single_flight():
+    import threading
+    from saiorm import singleflight
+    group = singleflight.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait()
+        return [{"id": 1}]
+
+    results = []
+
+    def call():
+        results.append(group.do("k", slow))
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait()
+    followers = [threading.Thread(target=call) for _ in range(3)]
+    for t in followers:
+        t.start()
+    while group.stats()["coalesced"] < 3:
+        time.sleep(0.001)
+    release.set()
+    for t in [leader] + followers:
+        t.join()
+    assert sorted(shared for rows, shared in results) == [False, True, True, True]
+    results[0][0][0]["id"] = 2  # changing one caller's rows does not affect the others
+    assert [rows[0]["id"] for rows, shared in results[1:]] == [1, 1, 1]
+
+    async def main():
+        return await asyncio.gather(group.do_async("a", slow), group.do_async("a", slow))
+
+    (rows1, shared1), (rows2, shared2) = asyncio.run(main())
+    assert (shared1, shared2) == (False, True) and rows1 == rows2 and rows1 is not rows2
+
+    # identical queries to different servers do not share
+    DB1 = saiorm.init(driver="MySQL")
+    DB2 = saiorm.init(driver="MySQL")
+    DB1.db = types.SimpleNamespace(host="127.0.0.1", database="test", _db_args={"port": 3306, "user": "a"})
+    DB2.db = types.SimpleNamespace(host="127.0.0.1", database="test", _db_args={"port": 3307, "user": "a"})
+    assert DB1.get_schema_key() != DB2.get_schema_key()
+
+
+def test_retry_policy():
+    from saiorm import errors
+
+    class Flaky(object):
+        retry_policy = errors.RetryPolicy(base_delay=0)
+
+        def __init__(self, kind):
+            self.kind = kind
+            self.calls = 0
+
+        def classify_error(self, e):
+            return self.kind
+
+        def close(self):
+            pass
+
+        def fail_once(self):
+            self.calls += 1
+            if self.calls == 1:
+                raise Exception(self.kind)
+            return "ok"
+
+        @errors.retryable
+        def query(self):
+            return self.fail_once()
+
+        @errors.retryable
+        def execute(self):
+            return self.fail_once()
+
+    # reads and deadlocks are retried,writes on connection lost are not by default
+    for kind, method, retried in [(errors.CONNECTION_LOST, "query", True),
+                                  (errors.DEADLOCK, "execute", True),
+                                  (errors.CONNECTION_LOST, "execute", False),
+                                  (errors.STATEMENT, "query", False)]:
+        conn = Flaky(kind)
+        try:
+            assert getattr(conn, method)() == "ok" and retried
+        except Exception as e:
+            assert not retried and str(e) == kind
+    conn = Flaky(errors.CONNECTION_LOST)
+    conn.retry_policy = errors.RetryPolicy(base_delay=0, retry_writes=True)
+    assert conn.execute() == "ok"
+
+
+def test_forksafe():
+    import socket
+    from saiorm import forksafe
+    if not hasattr(os, "fork"):
+        return
+
+    class FakeRaw(object):
+        def __init__(self, sock):
+            self._sock = sock
+
+        def close(self):  # like COM_QUIT or Terminate sent by the driver
+            try:
+                self._sock.sendall(b"QUIT")
+            except OSError:
+                pass
+            self._sock.close()
+
+    class FakeConnection(object):
+        def __init__(self, sock):
+            self._db = FakeRaw(sock)
+            forksafe.register(self)
+
+    client, server = socket.socketpair()
+    conn = FakeConnection(client)
+    raw = conn._db
+    path = tempfile.mktemp(suffix=".db")
+    DB = connect(path)
+    table = create_xxx(DB, rows=3)
+    DB.db._db.commit()
+
+    pid = os.fork()
+    if pid == 0:  # child
+        code = 1
+        try:
+            assert conn._db is None and DB.db._db is None
+            assert table.count() == 3  # a new connection is opened
+            raw.close()  # garbage collected
+            code = 0
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+
+    # nothing is sent on the socket of parent,and it still works
+    server.setblocking(False)
+    try:
+        server.recv(16)
+        raise AssertionError("child sent on the socket of parent")
+    except BlockingIOError:
+        pass
+    conn._db._sock.sendall(b"ping")
+    server.setblocking(True)
+    assert server.recv(16) == b"ping"
+    assert table.count() == 3
+    client.close()
+    server.close()
+    os.remove(path)
+
+
+def test_parallel_scan():
+    path = tempfile.mktemp(suffix=".db")
+    DB = connect(path)
+    table = create_xxx(DB, rows=1000)
+    DB.db._db.commit()
+
+    opened = []
+    closed = []
+    connect_sqlite = sqlite3.connect
+
+    class RecordedConnection(sqlite3.Connection):
+        def close(self):
+            super().close()
+            closed.append((self, threading.get_ident()))
+
+    def record(*args, **kwargs):
+        conn = connect_sqlite(*args, factory=RecordedConnection, **kwargs)
+        opened.append((conn, threading.get_ident()))
+        return conn
+
+    sqlite3.connect = record
+    try:
+        rows = []
+        for batch in table.where({"a": 1}).parallel_scan("id, a", workers=3, chunk_rows=100):
+            rows += batch
+        assert sorted(i["id"] for i in rows) == list(range(1, 1001, 5))
+        batches = list(table.where({"a": 1}).parallel_scan("id", workers=2, chunk_rows=100, ordered=True))
+        assert [i["id"] for batch in batches for i in batch] == list(range(1, 1001, 5))
+        scan = table.parallel_scan("id", workers=2, chunk_rows=100)
+        next(scan)
+        scan.close()  # stopped in the middle
+    finally:
+        sqlite3.connect = connect_sqlite
+    assert opened
+    # every connection is closed in the thread opening it
+    assert sorted((id(c), t) for c, t in opened) == sorted((id(c), t) for c, t in closed)
+    DB.db.close()
+    os.remove(path)
+
+
+def test_result_guard():
+    import copy
+    from saiorm import errors
+    from saiorm.guard import ResultGuard
+    for mode in ("raise", "truncate", "spill"):
+        DB = connect(result_guard=ResultGuard(max_rows=10, mode=mode))
+        table = create_xxx(DB, rows=25)
+        assert len(table.limit(10).select()) == 10
+        if mode == "raise":
+            try:
+                table.select()
+                raise AssertionError("result is not guarded")
+            except errors.ResultTooLargeError:
+                pass
+        elif mode == "truncate":
+            rows = table.select()
+            assert len(rows) == 10 and rows.truncated
+        else:
+            rows = table.order_by("id").select()
+            assert len(rows) == 25 and rows.spilled
+            assert [i["id"] for i in rows[8:12]] == [9, 10, 11, 12] and rows[-1]["id"] == 25
+            assert [i["id"] for i in copy.deepcopy(rows)] == list(range(1, 26))
+        assert table.count() == 25  # connection still works
+
+
+class FakeSSCursor(object):
+    """server side cursor,close reads all the unread rows like pymysql"""
+    description = [("id",)]
+    _executed = "SELECT id FROM xxx"
+
+    def __init__(self, rows):
+        self._result = iter([(i,) for i in range(rows)])
+        self.read = 0
+
+    def execute(self, query, parameters):
+        pass
+
+    def __iter__(self):
+        for row in self._result:
+            self.read += 1
+            yield row
+
+    def close(self):
+        if self._result is not None:
+            for _ in self._result:
+                self.read += 1
+
+
+def test_result_guard_mysql():
+    from saiorm import errors
+    from saiorm.MySQL import Connection
+    from saiorm.guard import ResultGuard
+
+    closed = []
+
+    class FakeConnection(Connection):
+        def _query_cursor(self):
+            return self.cursor
+
+        def close(self):
+            closed.append(True)
+
+        def classify_error(self, exception):
+            return errors.STATEMENT
+
+    for mode in ("raise", "truncate"):
+        conn = FakeConnection("127.0.0.1", 3306, "x", result_guard=ResultGuard(max_rows=10, mode=mode))
+        del closed[:]
+        conn.cursor = FakeSSCursor(100000)
+        try:
+            assert conn.query_return_detail("SELECT id FROM xxx")["data"].truncated
+        except errors.ResultTooLargeError:
+            assert mode == "raise"
+        assert conn.cursor.read == 11 and closed  # the rest rows are dropped with the connection
+        del closed[:]
+
+
+def test_result_guard_postgresql():
+    from saiorm import errors
+    from saiorm.PostgreSQL import Connection
+    from saiorm.guard import ResultGuard, is_select
+
+    class FakeNamedCursor(FakeSSCursor):
+        def close(self):  # CLOSE drops the unread rows in server
+            pass
+
+    class FakePG(object):
+        def __init__(self):
+            self.cursors = []
+
+        def cursor(self, name=None, withhold=False):
+            cursor = FakeNamedCursor(100000)
+            cursor.name = name
+            cursor.query = b"SELECT id FROM xxx"
+            self.cursors.append(cursor)
+            return cursor
+
+    class FakeConnection(Connection):
+        def _ensure_connected(self):
+            pass
+
+        def classify_error(self, exception):
+            return errors.STATEMENT
+
+    conn = FakeConnection("127.0.0.1", 5432, "x", result_guard=ResultGuard(max_rows=10, mode="truncate"))
+    conn._db = FakePG()
+    res = conn.query_return_detail("/*+ IndexScan(xxx) */ SELECT id FROM xxx;")
+    assert res["data"].truncated and len(res["data"]) == 10
+    cursor = conn._db.cursors[0]
+    assert cursor.name and cursor.read == 11  # server side cursor,the rest rows are not fetched
+    conn.result_guard = None
+    conn.query_return_detail("SELECT id FROM xxx;")
+    assert conn._db.cursors[1].name is None  # client cursor without guard
+
+    assert is_select("WITH x AS (SELECT 1)\nSELECT * FROM x") and is_select("-- c\nVALUES (1)")
+    assert not is_select("INSERT INTO xxx VALUES (1) RETURNING id") and not is_select("/* x")
+
+
+def test_batch_writer():
+    from saiorm.writer import BatchWriter
+    DB = saiorm.init(driver="SQLite")
+    DB.connect({"host": ":memory:"})
+    writer = BatchWriter(DB, "xxx", batch_size=100, interval=0.05)
+    share_memory_db(writer.db)
+    create_xxx(writer.db)  # in-memory database of the cloned connection
+    futures = [writer.insert({"a": 1, "b": "1"}), writer.insert({"a": 2, "b": "2"}),
+               writer.insert({"a": 3, "b": "3"}, return_id=True),
+               writer.insert({"a": 4, "b": "4"}), writer.insert({"a": 5})]
+    writer.flush()
+    assert [i.result()["rowcount"] for i in futures] == [1] * 5
+    assert futures[2].result()["lastrowid"] == 3
+    rows = writer.db.table("xxx").order_by("id").select("id, a")
+    assert [(i["id"], i["a"]) for i in rows] == [(1, 1), (2, 2), (3, 3), (4, 4), (5, 5)]  # in order of insert
+
+    # a duplicate line fails alone,the lines around it are inserted once
+    futures = [writer.insert({"id": 6, "a": 6}), writer.insert({"id": 1, "a": 1}), writer.insert({"id": 7, "a": 7})]
+    writer.flush()
+    assert futures[0].result()["lastrowid"] == 6 and futures[2].result()["lastrowid"] == 7
+    assert isinstance(futures[1].exception(), sqlite3.IntegrityError)
+    assert writer.db.table("xxx").count() == 7
+
+    bad = writer.insert({"no_such_field": 1})
+    writer.close()
+    try:
+        bad.result()
+        raise AssertionError("bad line is inserted")
+    except sqlite3.OperationalError:
+        pass
+    try:
+        writer.insert({"a": 1})
+        raise AssertionError("insert after close")
+    except RuntimeError:
+        pass
+
+
+class FakeMySQLChainDB(object):
+    """ChainDB of MySQL,insert_many is one statement,records the statements"""
+    insert_many_in_one_statement = True
+
+    def __init__(self, consecutive_ids, fail):
+        from saiorm import errors
+        self.db = types.SimpleNamespace(retry_policy=errors.RetryPolicy(), close=lambda: None,
+                                        classify_error=lambda e: e.args[0])
+        self.consecutive_ids = consecutive_ids
+        self.fail = fail  # kinds of errors to raise in order
+        self.statements = []
+        self.next_id = 1
+
+    def clone(self):
+        return self
+
+    def consecutive_insert_ids(self):
+        return self.consecutive_ids
+
+    def table(self, name):
+        return self
+
+    def insert_many(self, lines):
+        self.statements.append(("insert_many", len(lines)))
+        if self.fail:
+            raise Exception(self.fail.pop(0))
+        if any("bad" in i.values() for i in lines):
+            raise Exception("statement")
+        self.next_id += len(lines) + 10  # not consecutive when interleaved
+        return {"lastrowid": self.next_id - len(lines) - 10, "rowcount": len(lines), "query": ""}
+
+    def insert(self, line):
+        self.statements.append(("insert", 1))
+        if "bad" in line.values():
+            raise Exception("statement")
+        self.next_id += 1
+        return {"lastrowid": self.next_id - 1, "rowcount": 1, "query": ""}
+
+
+def test_batch_writer_mysql():
+    from saiorm import errors
+    from saiorm.writer import BatchWriter
+
+    db = FakeMySQLChainDB(consecutive_ids=False, fail=["deadlock"])
+    writer = BatchWriter(db, "xxx", interval=0.05, retry_policy=errors.RetryPolicy(base_delay=0))
+    assert db.db.retry_policy.max_retries == 0  # one retry layer,the writer
+    futures = [writer.insert({"a": 1}), writer.insert({"a": 2}, return_id=True), writer.insert({"a": 3})]
+    writer.close()
+    # ids are not derived without consecutive ids,the return_id line is inserted alone
+    assert db.statements == [("insert_many", 1), ("insert_many", 1), ("insert", 1), ("insert_many", 1)]
+    assert [i.result()["lastrowid"] for i in futures] == [0, 12, 0]
+
+    db = FakeMySQLChainDB(consecutive_ids=True, fail=[])
+    writer = BatchWriter(db, "xxx", interval=0.05)
+    futures = [writer.insert({"a": 1}), writer.insert({"a": 2}, return_id=True), writer.insert({"a": 3})]
+    writer.flush()
+    assert db.statements == [("insert_many", 3)]
+    assert [i.result()["lastrowid"] for i in futures] == [1, 2, 3]
+    futures = [writer.insert({"a": 1}), writer.insert({"a": "bad"}), writer.insert({"a": 3})]
+    writer.close()  # nothing of the batch is inserted,retried line by line
+    assert db.statements[1:] == [("insert_many", 3), ("insert", 1), ("insert", 1), ("insert", 1)]
+    assert futures[1].exception() is not None and futures[2].result()["lastrowid"] == 15
+
+
+def test_deferred():
+    from saiorm import deferred
+    DB = connect()
+    table = create_xxx(DB, rows=10)
+    DB.defer("xxx", ["b"])
+    DB.in_chunk_size = 4
+    rows = table.where({"a": ("<", 3)}).order_by("id").select()
+    assert list(rows[0].keys()) == ["id", "a"]
+    DB.in_chunk_size = None  # chunk size of the time selected is used
+    DB.table("other")
+    assert rows[0]["b"] == "1" and [i["b"] for i in rows] == ["1", "2", "5", "6", "7", "10"]
+
+    rows = DB.table("xxx").order_by("id").select()  # one statement without chunk size
+    deferred.load_deferred(rows)
+    assert [i["b"] for i in rows] == [str(i) for i in range(1, 11)]
+    assert len(DB.table("xxx").select("id, b")[0]) == 2  # only select("*") is deferred
+    try:
+        DB.table("xxx").select()[0].b
+        raise AssertionError("GraceDict has attribute access")
+    except AttributeError:
+        pass
+    DB.grace_result = False
+    rows = DB.table("xxx").order_by("id").select()
+    assert "b" not in rows[0] and rows[1].b == "2" and rows[0]["b"] == "1"  # loaded by attribute
+    DB.grace_result = True
+    DB.defer("xxx")
+    assert "b" in DB.table("xxx").limit(1).select()[0]
+
+
+def test_sample():
+    DB = connect()
+    table = create_xxx(DB, rows=1000)
+    rows = table.where({"a": 1}).sample(10, seed=1)
+    assert len(rows) == 10 and all(i["a"] == 1 for i in rows)
+    assert [i["id"] for i in rows] == [i["id"] for i in table.where({"a": 1}).sample(10, seed=1)]
+    assert "IN" in DB.last_query  # sampled by primary key
+    assert len(table.sample(0.01)) == 10
+
+    DB.in_chunk_size = None  # one statement like ANY of PostgreSQL
+    assert len(table.sample(300, seed=2)) == 300
+    try:
+        table.where({"no_such_field": 1}).sample(10)
+        raise AssertionError("unknown field is accepted")
+    except sqlite3.OperationalError:
+        pass
+    assert table.count() == 1000  # the chain is reset after failure
+
+    # "point" is not an integer type,sample by random order
+    DB.execute("CREATE TABLE yyy (id POINT PRIMARY KEY, a INTEGER);")
+    DB.table("yyy").insert_many([{"id": "p" + str(i), "a": i} for i in range(20)])
+    schema.schema_cache.invalidate(DB.get_schema_key(), "yyy")
+    assert len(DB.table("yyy").sample(5)) == 5
+    assert "RANDOM" in DB.last_query.upper()
+
+    for data_type, expected in [("int", True), ("bigint unsigned", True), ("int(11)", True), ("int8", True),
+                                ("integer", True), ("tinyint(1)", False), ("point", False), ("interval", False)]:
+        assert schema.is_integer_type(data_type) is expected, data_type
+
+
+def test_lazy_connect():
+    import sys
+    import saiorm.MySQL
+    assert "pymysql" not in sys.modules  # imported on the first connection
+    DB = saiorm.init(driver="MySQL")
+    DB.connect({"host": "127.0.0.1", "port": 1, "database": "x", "user": "x", "password": "x"})
+    assert DB.db._db is None  # nothing is opened before the first statement
+
+    DB = connect()
+    assert DB.db._db is None
+    saiorm.warmup(DB, connect())
+    create_xxx(DB, rows=3)
+    assert DB.db._db is not None and DB.table("xxx").count() == 3
+
+
+def test_select_arrow():
+    from saiorm import columnar
+    DB = connect()
+    table = create_xxx(DB, rows=25)
+    batches = list(table.order_by("id").iter_batches("id, b", batch_size=10))
+    assert [len(rows) for _, rows in batches] == [10, 10, 5] and batches[0][0] == ["id", "b"]
+    df = columnar.to_dataframe(table.order_by("id").iter_batches("id, b", batch_size=10))
+    assert list(df["id"]) == list(range(1, 26))
+    if not columnar.has_arrow():
+        return
+
+    arrow = table.where({"a": 1}).order_by("id").select_arrow("id, b", batch_size=2)
+    assert arrow.column_names == ["id", "b"] and arrow.column("id").to_pylist() == [1, 6, 11, 16, 21]
+    assert list(table.select_dataframe("id, a", batch_size=7)["a"]) == [i % 5 for i in range(1, 26)]
+    assert table.where({"a": 9}).select_arrow("id").num_rows == 0
+    for file_format in ("ipc", "parquet"):
+        path = tempfile.mktemp(suffix="." + file_format)
+        assert table.select_arrow("id, b", batch_size=10, path=path, file_format=file_format) == 25
+        os.remove(path)
+
+
+def test_csv():
+    import io
+    DB = connect()
+    table = create_xxx(DB, rows=7)
+    for path in (tempfile.mktemp(suffix=".csv"), tempfile.mktemp(suffix=".csv.gz")):
+        progress = []
+        assert table.order_by("id").export_csv(path, "id, a, b", batch_size=3, progress=progress.append) == 7
+        assert progress == [3, 6, 7]
+        DB.execute("DELETE FROM xxx;")
+        assert table.import_csv(path, chunk_size=3) == 7
+        assert table.order_by("id").pluck("b") == [str(i) for i in range(1, 8)]
+        os.remove(path)
+
+    f = io.StringIO("8,,x\n9,4,y\n")
+    assert table.import_csv(f, fields=["id", "a", "b"], header=False) == 2
+    assert DB.db.query_column("SELECT a FROM xxx WHERE id = 8;")["data"] == [None]  # empty value is NULL
+    try:
+        table.import_csv(io.StringIO("1,2,3\n"), header=False)
+        raise AssertionError("imported without fields")
+    except ValueError:
+        pass
+
+
+def test_bulk_load_mysql():
+    import datetime
+    from saiorm.csvio import escape_tsv_value
+
+    class FakeConnection(object):
+        local_infile = True
+
+        def load_data(self, query, path):
+            with open(path, "rb") as f:
+                self.loaded = f.read()
+            return {"lastrowid": 0, "rowcount": self.loaded.count(b"\n"), "rownumber": 0,
+                    "query": query, "warnings": []}
+
+    DB = saiorm.init(driver="MySQL")
+    DB.db = FakeConnection()
+    rows = ({"id": i, "b": "x\ty" if i == 1 else None} for i in range(3))  # generator
+    res = DB.table("xxx").bulk_load(rows, on_duplicate="replace", batch_size=2)
+    assert res["rowcount"] == 3
+    assert DB.db.loaded == b"0\t\\N\n1\tx\\ty\n2\t\\N\n"
+    assert "REPLACE INTO TABLE xxx" in res["query"] and res["query"].endswith("(id,b);")
+
+    assert DB.table("xxx").bulk_rows(["id", "b"], [[1, "a"]])["rowcount"] == 1
+    assert escape_tsv_value(True) == b"1" and escape_tsv_value(b"a\0\\") == b"a\\0\\\\"
+    assert escape_tsv_value(datetime.datetime(2018, 1, 2, 3, 4, 5)) == b"2018-01-02 03:04:05"
+    try:
+        DB.table("xxx").bulk_load([], on_duplicate="update")
+        raise AssertionError("bad on_duplicate is accepted")
+    except ValueError:
+        pass
+
+
+def test_timeout():
+    from saiorm import errors
+    endless = "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT COUNT(*) AS n FROM c;"
+    DB = connect()
+    table = create_xxx(DB, rows=3)
+    start = time.time()
+    try:
+        DB.timeout(0.05).query(endless)
+        raise AssertionError("statement is not cancelled")
+    except errors.QueryTimeoutError:
+        pass
+    assert time.time() - start < 5
+    assert table.count() == 3  # the connection is kept,timeout is for the next statement only
+
+    DB = connect(timeout=0.05)  # default of all statements
+    try:
+        DB.query(endless)
+        raise AssertionError("statement is not cancelled")
+    except errors.QueryTimeoutError:
+        pass
+
+
+def test_scatter():
+    from saiorm.scatter import MultiDB, ScatterError
+    dbs = []
+    for rows in (5, 8, 0):
+        DB = connect()
+        share_memory_db(DB)  # used by the thread of the source
+        create_xxx(DB, rows=rows)
+        dbs.append(DB)
+    tenants = MultiDB(dbs, names=["a", "b", "c"])
+    rows = tenants.table("xxx").where({"a": ("<", 3)}).order_by("id DESC").limit("1, 4").select("id, a")
+    assert [i["id"] for i in rows] == [6, 5, 5, 2] and not tenants.errors
+    assert tenants.table("xxx").count() == 13
+    assert tenants.table("xxx").sum("id") == 15 + 36
+    assert tenants.table("xxx").max("id") == 8 and tenants.table("xxx").min("id") == 1
+    assert tenants.table("xxx").avg("id") == 51 / 13.0
+    assert sorted(tenants.table("xxx").where({"a": 0}).pluck("id")) == [5, 5]
+    assert tenants.table("xxx").where({"id": 8}).exists() is True
+
+    dbs[2].execute("DROP TABLE xxx;")  # failed source is left out
+    assert tenants.table("xxx").count() == 13 and list(tenants.errors) == ["c"]
+    tenants.raise_error = True
+    try:
+        tenants.table("xxx").count()
+        raise AssertionError("failed source is not raised")
+    except ScatterError as e:
+        assert list(e.errors) == ["c"]
+    try:
+        tenants.on("x")
+        raise AssertionError("unknown chain method is accepted")
+    except AttributeError:
+        pass
+    tenants.close()
+
+
+def test_blob():
+    import io
+    from saiorm import base, blob
+    DB = connect()
+    DB.execute("CREATE TABLE doc (id INTEGER PRIMARY KEY, content BLOB);")
+    DB.table("doc").insert_many([{"id": 1, "content": None}, {"id": 2, "content": None}])
+    data = bytes(range(256)) * 100
+    DB.table("doc").where({"id": 1}).write_blob("content", data, chunk_size=1000)
+    with DB.table("doc").where({"id": 1}).open_blob("content", chunk_size=1000) as f:
+        assert f.read() == data
+    with base.ChainDB.open_blob(DB.table("doc").where({"id": 1}), "content", chunk_size=999) as f:  # by SUBSTR
+        assert f.read() == data
+
+    DB.table("doc").where({"id": 2}).write_blob("content", io.BytesIO(data[:5000]), chunk_size=1024)
+    assert DB.table("doc").where({"id": 2}).open_blob("content").read() == data[:5000]
+    DB.table("doc").where({"id": 2}).write_blob("content", "text" * 1000, chunk_size=300)  # appended by chunks
+    assert DB.table("doc").where({"id": 2}).open_blob("content").read() == b"text" * 1000
+    assert DB.table("doc").where({"id": 3}).open_blob("content").read() == b""  # no line
+
+    reader = DB.table("doc d").where({"d.id": 1}).open_blob("content", chunk_size=1000)  # aliased table
+    assert isinstance(reader, blob.BlobReader) and reader.chunk_size == 1000
+    assert reader.read(10) == data[:10] and reader.read() == data[10:]
+    res = DB.table("doc d").where({"d.content": data}).write_blob("content", b"new" * 1000)  # where on the value
+    assert res["rowcount"] == 1
+    assert DB.table("doc").where({"id": 1}).open_blob("content").read() == b"new" * 1000
+
+
+def test_counter():
+    from saiorm.counter import CounterBuffer
+    DB = connect()
+    table = create_xxx(DB, rows=5)
+    assert table.where({"id": ("<", 3)}).increase("a", 10)["rowcount"] == 2  # where applies
+    assert table.order_by("id").pluck("a") == [11, 12, 3, 4, 0]
+    assert table.where({"id": ("IN", [1, 2])}).decrease("a", 10)["rowcount"] == 2
+    DB.max_params = 4  # split into statements
+    assert table.where({"a": ("<", 4)}).increase_many("a", {1: 5, 2: -2, 3: 1, 4: 100})["rowcount"] == 3
+    assert table.order_by("id").pluck("a") == [6, 0, 4, 4, 0]
+
+    counters = CounterBuffer(connect(), interval=60)
+    share_memory_db(counters.db)
+    create_xxx(counters.db, rows=3)  # in-memory database of the cloned connection
+    for _ in range(3):
+        counters.increase("xxx", 1, "a")
+    counters.decrease("xxx", 2, "a", 2)
+    counters.increase("no_such_table", 1, "a")
+    assert counters.pending() == 3
+    assert counters.flush(timeout=5)
+    assert counters.db.table("xxx").order_by("id").pluck("a") == [4, 0, 3]
+    assert counters.pending() == 1  # failed deltas are put back
+    counters.close()
+    try:
+        counters.increase("xxx", 1, "a")
+        raise AssertionError("increase after close")
+    except RuntimeError:
+        pass
+
+
+def test_insert_columns():
+    from saiorm import columnar
+    DB = connect()
+    table = create_xxx(DB)
+    assert table.insert_many({"id": [1, 2], "a": [1, None], "b": ["x", "y"]})["rowcount"] == 2
+    assert not columnar.is_columnar({"id": 1, "b": "x"}) and not columnar.is_columnar({"fields": [], "values": []})
+    assert not table.insert_many({"id": [], "a": []})
+    if not columnar.has_arrow():
+        return
+    import numpy
+    import pandas
+    import pyarrow
+    df = pandas.DataFrame({"id": [3, 4, 5], "a": [1.0, float("nan"), 3.0], "b": ["p", None, "r"]})
+    assert table.insert_columns(df, chunk_size=2)["rowcount"] == 3
+    array = numpy.array([(6, 6.0, "s"), (7, numpy.nan, "t")], dtype=[("id", "i8"), ("a", "f8"), ("b", "U1")])
+    assert table.insert_many(array)["rowcount"] == 2
+    arrow = pyarrow.table({"id": [8, 9], "a": [float("nan"), 9.0], "b": ["u", "v"]})
+    assert table.insert_many(arrow)["rowcount"] == 2
+    rows = table.order_by("id").select("id, a, b")
+    assert [dict.get(i, "a") for i in rows] == [1, None, 1, None, 3, 6, None, None, 9]  # NaN is NULL
+    assert [dict.get(i, "b") for i in rows] == ["x", "y", "p", None, "r", "s", "t", "u", "v"]
+
+
+def test_hint():
+    DB = connect()
+    table = create_xxx(DB, rows=10)
+    DB.execute("CREATE INDEX idx_a ON xxx (a);")
+    assert len(table.hint("idx_a").where({"a": 1}).select()) == 2
+    assert "FROM xxx INDEXED BY idx_a" in DB.last_query
+    table.select("id")
+    assert "INDEXED BY" not in DB.last_query  # for the next SELECT only
+    try:
+        table.hint("no_such_index").select()
+        raise AssertionError("unknown index is accepted")
+    except sqlite3.OperationalError:
+        pass
+
+    expected = {
+        "MySQL": "SELECT /*+ NO_ICP(t) */ id FROM t FORCE INDEX (i1,i2) ;",
+        "PostgreSQL": "/*+ IndexScan(t i1 i2) NO_ICP(t) */ SELECT id FROM t ;",
+        "SQLServer": "SELECT id FROM t WITH (INDEX(i1,i2))  OPTION (NO_ICP(t))",
+    }
+    for driver, sql in expected.items():
+        DB = saiorm.init(driver=driver)
+        assert DB.table("t").hint(["i1", "i2"], force=True, optimizer="NO_ICP(t)").build_select("id")[0] == sql
+
+    assert table.hint("idx_a").where({"a": 1}).exists() is True
+    assert "FROM xxx INDEXED BY idx_a" in table.last_query  # exists takes the index hint
+    DB = saiorm.init(driver="SQLServer")
+    assert DB.table("t").hint("i1").gen_exists("") == "SELECT TOP 1 1 FROM t WITH (INDEX(i1)) ;"
+
+    DB = saiorm.init(driver="MongoDB")
+    DB.db = FakeMongoConnection()
+    DB.table("xxx").hint("idx_a").timeout(2).exists()
+    DB.table("xxx").exists()  # hint and timeout are for one statement
+    assert [(i["hint"], i["timeout"]) for i in DB.db.conditions] == [("idx_a", 2), (None, None)]
+
+
+def test_update_many():
+    DB = connect()
+    table = create_xxx(DB, rows=6)
+    statements = []
+    deadline = DB.db.deadline
+
+    def record(seconds=None):
+        statements.append(seconds)
+        return deadline(seconds)
+
+    DB.db.deadline = record
+    DB.max_params = 10  # split into statements by the real params
+    lines = [{"id": 1, "a": 10, "b": "x1"}, {"id": 2, "a": ("`a+?", 20)}, {"id": 3, "b": "x3"},
+             {"id": 4, "a": 40, "b": "x4"}, {"id": 5, "a": 50}, {"id": 6, "b": "`b||'!'"}]
+    res = table.timeout(5).where({"id": ("<>", 5)}).update_many(lines)
+    assert res["rowcount"] == 5  # where applies
+    assert len(statements) > 1 and statements == [5] * len(statements)  # timeout of every chunk
+    assert table.order_by("id").select("a, b") == [
+        {"a": 10, "b": "x1"}, {"a": 22, "b": "2"}, {"a": 3, "b": "x3"},
+        {"a": 40, "b": "x4"}, {"a": 0, "b": "5"}, {"a": 1, "b": "6!"}]
+    assert statements[-1] is None  # conditions are reset after the last chunk
+
+    del statements[:]
+    table.timeout(5).upsert_many([{"id": i, "a": i} for i in range(5, 12)])
+    table.timeout(5).increase_many("a", {i: 1 for i in range(1, 12)})
+    assert len(statements) > 2 and statements == [5] * len(statements)
+    assert table.count() == 11 and table.where({"id": 11}).get("a")["a"] == 12
+
+    DB = saiorm.init(driver="PostgreSQL")  # key refers to the alias
+    sql, values = DB.table("xxx x").gen_update_many([{"id": 1, "a": 2}], "id", ["a"], "")
+    assert "WHERE x.id=saiorm_v.c0" in sql and values == [1, 2]
+
+
+if __name__ == "__main__":
+    for name, func in sorted(globals().items()):
+        if name.startswith("test_") and callable(func):
+            print("-" * 30 + "TEST::" + name + "-" * 30)
+            func()